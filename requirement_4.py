@@ -32,6 +32,8 @@
 - **Процесс**:
   - Формирование HMAC подписи с использованием api_key, secret_key, и имени пользователя.
   - Проверка подписи и активности подписки сервером перед выдачей JWT токена.
+  - API ключ вместе с пользователем, TypeID и подпиской загружается одним запросом один раз за запрос к API и кратковременно кэшируется в процессе; кэш сбрасывается при изменении APIKey, Subscription или TypeID.
+  - JWT содержит TypeID, срок окончания подписки и статус ключа, поэтому доступ проверяется без обращения к базе. Токены подписываются ключами с идентификаторами (`kid`) с возможностью ротации; при удалении или деактивации ключа его токены отзываются через список отзыва в памяти.
 
 - **Функции API**:
   - `POST /api/v1/auth`: Авторизация пользователя и выдача JWT токена.
@@ -40,10 +42,12 @@
 - **Загрузка и сравнение текстов**:
   - Тексты загружаются и сравниваются в формате Base64.
   - Для каждого запроса используются параметры TypeID для формирования запросов к модели LLM.
+  - Повторная загрузка того же файла возвращает существующий `reference_id` без извлечения текста; подготовленный промпт эталона и число его токенов кэшируются.
 
 - **Функции API**:
   - `POST /api/v1/reference`: Загрузка эталонного текста.
   - `POST /api/v1/compare/{reference_id}`: Сравнение загруженного текста с эталонным.
+  - `POST /api/v1/compare/{reference_id}?stream=1`: Сравнение с потоковой выдачей отчёта по мере генерации (Server-Sent Events или NDJSON).
 
 ### 5. Дополнительные функции
 - **Проверка подписки**:
@@ -52,6 +56,108 @@
 - **Функции API**:
   - `GET /api/v1/subscription/{api_key}`: Проверка статуса подписки.
 
+### 6. Кэширование результатов сравнения
+- **Повторные сравнения**:
+  - Результат сравнения кэшируется по хэшу эталонного текста, сравниваемого текста и параметров TypeID (system, user, model, llm).
+  - Попадание в кэш не вызывает провайдера LLM и не списывает токены.
+  - Хранилище подключаемое (LRU в памяти процесса или Redis), с TTL и ограничением размера.
+  - Кэш для TypeID сбрасывается при его редактировании.
+
+- **Функции API**:
+  - `GET /api/v1/cache/stats`: Счётчики попаданий и промахов кэша (только администраторы).
+
+### 7. Асинхронное сравнение текстов
+- **Неблокирующие запросы**:
+  - Извлечение текста и запрос к LLM выполняются в ограниченном пуле воркеров, клиент сразу получает ID задачи.
+  - Результат получается опросом статуса задачи или через `callback_url`; число незавершённых задач на API ключ ограничено.
+  - Задачи, прерванные перезапуском, через заданное время переводятся в `failed` и не занимают лимит; загруженные файлы удаляются после завершения задачи.
+  - `callback_url` принимается только по https и только для публичных адресов (или хостов из списка разрешённых), перенаправления не выполняются.
+
+- **Функции API**:
+  - `POST /api/v1/compare/{reference_id}?async=1`: Асинхронное сравнение, сразу возвращает ID задачи.
+  - `GET /api/v1/jobs/{job_id}`: Статус и результат асинхронной задачи сравнения.
+
+### 8. Пакетное сравнение текстов
+- **Один эталон — много документов**:
+  - Эталон и TypeID загружаются один раз, запросы к провайдеру выполняются параллельно с ограничением, токены резервируются на весь пакет.
+  - Архив распаковывается потоково с лимитом по фактическому размеру; временные файлы удаляются и резерв токенов корректируется при любом исходе, в том числе при отключении клиента до начала чтения.
+
+- **Функции API**:
+  - `POST /api/v1/compare/{reference_id}/batch`: Пакетное сравнение множества файлов (или одного zip архива) с эталонным текстом, результаты возвращаются построчно в формате NDJSON.
+
+### 9. Потоковое извлечение текста
+- **Ограниченное потребление памяти**:
+  - Base64 декодируется потоково, текст из .txt, .docx и .pdf извлекается постранично без внешних процессов, с ограничениями на размер, число страниц и время извлечения.
+
+### 10. Кэширование промптов на стороне провайдера
+- **Стабильный префикс промпта**:
+  - Эталонная часть промпта идёт первой и побайтно совпадает между запросами, чтобы её переиспользовал кэш провайдера (автоматический кэш OpenAI, `CachedContent` Gemini с TTL).
+  - Для биллинга учитываются входные токены, из них закэшированные провайдером, и выходные токены.
+
+### 11. Реестр провайдеров LLM
+- **Переиспользование клиентов**:
+  - Для каждой пары (провайдер, `llm_api_key`) создаётся один долгоживущий клиент с пулом соединений и настраиваемым таймаутом; число клиентов в процессе ограничено (LRU).
+  - Ошибка создания кэша контекста Gemini не прерывает сравнение: запрос выполняется без кэша.
+  - Новый провайдер (например, локальный OpenAI-совместимый сервер) подключается через реестр или настройки без изменения представлений.
+
+### 12. Сравнение больших документов по фрагментам
+- **Map-reduce режим**:
+  - TypeID задаёт режим разбиения (`none`, `headings`, `paragraphs`) и бюджет токенов на фрагмент.
+  - Выровненные пары фрагментов сравниваются параллельно, частичные отчёты объединяются в один; результаты фрагментов кэшируются, поэтому правка одного раздела пересчитывает только затронутые фрагменты.
+  - Каждый фрагмент укладывается в бюджет: изменённые диапазоны делятся на пары абзацев, слишком длинные разделы и абзацы — на части.
+
+### 13. Локальная предварительная оценка сходства
+- **Сравнение без LLM для очевидных случаев**:
+  - Перед запросом к LLM сходство оценивается локально по сигнатурам MinHash; сигнатура эталона вычисляется при загрузке.
+  - Копии эталона и документы, не относящиеся к эталону, получают детерминированный отчёт по порогам TypeID без обращения к провайдеру и без списания токенов.
+  - Локальная оценка (`local_score`) возвращается в каждом ответе сравнения.
+
+### 14. Ограничение частоты и параллелизма запросов
+- **Защита общей квоты провайдера**:
+  - Для каждого API ключа ограничиваются частота запросов (token bucket) и число одновременных запросов; лимиты задаются в APIKey или TypeID.
+  - Обращения к каждой модели провайдера со всех ключей ограничиваются лимитами RPM/TPM аккаунта у провайдера.
+  - При превышении возвращается 429 с заголовком `Retry-After`; счётчики хранятся в памяти процесса или в Redis.
+
+### 15. Устойчивые обращения к провайдерам LLM
+- **Таймауты, повторы и резервирование**:
+  - Каждое обращение к провайдеру ограничено общим дедлайном; временные ошибки (таймауты, 429, 5xx) повторяются с экспоненциальной задержкой и случайным разбросом.
+  - Для каждой пары (провайдер, модель) работает автоматический выключатель; TypeID может задать резервные провайдер и модель на время недоступности основной. Опционально — хеджирование медленных запросов.
+  - Ошибка провайдера возвращается клиенту как ошибка (502/503), а не как текст отчёта. Поведение проверяется на локальном провайдере `fake` с внесением задержек и ошибок.
+
+### 16. Потоковая выдача отчёта
+- **Отчёт по мере генерации**:
+  - Фрагменты отчёта передаются клиенту по мере их получения от провайдера (потоковый режим OpenAI и Gemini) как Server-Sent Events или NDJSON.
+  - Токены корректируются по фактическому расходу после окончания потока; при разрыве соединения запрос к провайдеру прерывается и оплачивается только уже сгенерированная часть.
+
+### 17. Журнал действий (Logs)
+- **Асинхронная запись**:
+  - Авторизация, загрузка эталонов и сравнения (задержка, токены, попадание в кэш) журналируются через ограниченную очередь в памяти и записываются фоновым потоком пакетами (`COPY` или `bulk_create`), без задержки запроса.
+  - Таблица секционирована по месяцам; секции создаются заранее (первые — миграцией) и удаляются целиком по истечении срока хранения. Строки, попавшие в секцию по умолчанию, переносятся в месячные секции при их создании.
+
+### 18. Биллинг и агрегаты использования
+- **Готовые агрегаты**:
+  - Число сравнений, ошибок и попаданий в кэш, входные и выходные токены и задержка суммируются по ключу за час и за сутки; агрегаты обновляются пакетами вместе с журналом.
+  - `GET /api/v1/billing/{api_key}` читает только агрегаты (параметры `period`, `from`, `to`) и возвращает `ETag`; неизменившиеся данные отдаются ответом `304 Not Modified`.
+  - Пересчёт агрегатов заменяет только сутки, за которые сохранился журнал; агрегаты старше срока хранения журнала не стираются.
+
+### 19. Метрики и профилирование
+- **Наблюдаемость горячего пути**:
+  - Длительность авторизации, проверки JWT, обращений к базе, извлечения текста, сравнения, вызова провайдера и списания токенов записывается в гистограммы с метками провайдера, модели и TypeID; счётчики учитывают токены провайдера, ошибки и попадания в кэш.
+  - `GET /metrics`: метрики в формате Prometheus (доступ по токену).
+  - Администратор может включить сэмплирующий профилировщик для отдельного запроса заголовком `X-Profile`.
+
+### 20. Нагрузочное тестирование
+- **Бенчмарк без затрат на провайдера**:
+  - Локальный mock сервер, совместимый с API OpenAI и Gemini, с настраиваемыми распределением задержки, долей ошибок и зависаний.
+  - Воспроизводимый корпус документов .txt, .docx и .pdf разных размеров.
+  - Команда `manage.py benchmark` нагружает загрузку эталона, авторизацию и сравнение на фиксированной параллельности и сообщает p50/p95/p99 задержки, запросы в секунду, запросы к базе и пиковый RSS; результаты сравниваются с прогоном базового коммита.
+
+### 21. Компактное хранение текстов
+- **Сжатие и отложенная загрузка**:
+  - Извлечённый текст эталона хранится сжатым (zstd) в базе или в файловом хранилище; запросы метаданных и списки в админке не загружают тело текста.
+  - Большие тексты из файлового хранилища читаются через mmap.
+  - Неиспользуемые файлы хранилища удаляются командой очистки; файл, который переиспользует новая загрузка, не удаляется.
+
 ### Интеграция и безопасность
 - **HTTPS**: все запросы к API должны использовать HTTPS для защиты данных.
 - **Обновление токенов и мониторинг**: реализация механизмов для обновления токенов и мониторинга активности по API ключам.
@@ -72,6 +178,7 @@
 from django.http import JsonResponse
 from django.views import View
 from .models import TypeID
+from .comparison_cache import get_comparison_cache
 import json
 
 class TypeIDView(View):
@@ -83,7 +190,10 @@ class TypeIDView(View):
             user=data['user'],
             model=data['model'],
             llm=data['llm'],
-            description=data.get('description', '')
+            description=data.get('description', ''),
+            chunking=data.get('chunking', 'none'),
+            chunk_tokens=data.get('chunk_tokens', 8000),
+            merge_prompt=data.get('merge_prompt', ''),
         )
         return JsonResponse({'typeid': new_typeid.pk, 'status': 'success'}, status=201)
 
@@ -94,6 +204,8 @@ class TypeIDView(View):
             for key, value in data.items():
                 setattr(typeid_instance, key, value)
             typeid_instance.save()
+            # Отчёты, полученные со старыми параметрами, больше не актуальны
+            get_comparison_cache().invalidate_typeid(typeid_instance.pk)
             return JsonResponse({'status': 'success'})
         except TypeID.DoesNotExist:
             return JsonResponse({'error': 'TypeID not found'}, status=404)
@@ -101,6 +213,7 @@ class TypeIDView(View):
     def delete(self, request, typeid):
         try:
             typeid_instance = TypeID.objects.get(pk=typeid)
+            get_comparison_cache().invalidate_typeid(typeid_instance.pk)
             typeid_instance.delete()
             return JsonResponse({'status': 'success'})
         except TypeID.DoesNotExist:
@@ -168,6 +281,10 @@ class APIKey(models.Model):
     tokens_remaining = models.IntegerField(default=10000)
     token_limit = models.IntegerField(default=10000)
     status = models.CharField(max_length=10, choices=[('active', 'Active'), ('inactive', 'Inactive')])
+    # Накопительные счётчики расхода по данным провайдера для биллинга
+    input_tokens_used = models.BigIntegerField(default=0)
+    cached_input_tokens_used = models.BigIntegerField(default=0)  # часть input_tokens_used из кэша провайдера
+    output_tokens_used = models.BigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username} - {self.key}"
@@ -182,6 +299,7 @@ class APIKey(models.Model):
 - **Безопасность**: Использовать HMAC-SHA256 для генерации подписей, чтобы обеспечить безопасную авторизацию пользователя.
 - **JWT токены**: После успешной верификации подписи и подписки пользователя, сервер должен генерировать JWT токен, который будет использоваться для дальнейшей аутентификации запросов.
 - **Многоуровневая проверка**: Помимо проверки подписи, необходима проверка статуса подписки пользователя, прежде чем предоставлять доступ к API.
+- **Проверка токена без обращения к БД**: JWT содержит TypeID, срок окончания подписки и статус ключа, поэтому эндпоинты текстов проверяют доступ без запроса к базе. Токены подписываются ключами с идентификаторами (`kid`) и поддерживают ротацию ключей; отзыв выполняется через список отзыва в памяти при удалении или деактивации ключа.
 
 #### Функции клиента для авторизации:
 ```python
@@ -216,42 +334,443 @@ from .models import APIKey
 import jwt
 import datetime
 
-def validate_hmac_signature(api_key, signature, username):
+def validate_hmac_signature(api_key_obj, signature, username):
     """Проверка HMAC подписи."""
-    try:
-        api_key_obj = APIKey.objects.get(key=api_key)
-        secret_key = api_key_obj.secret_key
-        expected_signature = hmac.new(secret_key.encode(), f"{api_key}.{username}".encode(), hashlib.sha256).hexdigest()
-        return signature == expected_signature
-    except APIKey.DoesNotExist:
+    if api_key_obj is None:
         return False
+    secret_key = api_key_obj.secret_key
+    expected_signature = hmac.new(secret_key.encode(), f"{api_key_obj.key}.{username}".encode(), hashlib.sha256).hexdigest()
+    # Сравнение за постоянное время: подпись нельзя подобрать по времени ответа
+    return hmac.compare_digest(expected_signature.encode(), str(signature or '').encode())
 
+@timed('auth')  # участки и метрики — раздел 19
 def handle_auth_request(request):
     """Обработка запроса на авторизацию."""
     api_key = request.data.get("api_key")
     signature = request.data.get("signature")
     username = request.data.get("username")
 
-    if validate_hmac_signature(api_key, signature, username):
-        if check_subscription(api_key):  # Допустим, у нас есть функция для проверки подписки
-            token = jwt.encode({
-                "api_key": api_key,
-                "username": username,
-                "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=24)  # срок действия токена - 24 часа
-            }, 'your_secret_key', algorithm="HS256")
+    # Ключ загружается один раз и используется и для подписи, и для проверки подписки
+    api_key_obj = resolve_api_key(request, api_key)
+    if validate_hmac_signature(api_key_obj, signature, username):
+        if check_subscription(api_key_obj):
+            # Claims токена позволяют проверять доступ без обращения к базе (см. ниже)
+            token = issue_token(api_key_obj, username)
+            log_event(api_key_obj.pk, 'auth', username=username)
             return JsonResponse({"token": token}, status=200)
         else:
+            log_event(api_key_obj.pk, 'auth', username=username, error='subscription_inactive')
             return JsonResponse({"error": "Subscription inactive"}, status=403)
     else:
+        if api_key_obj is not None:
+            log_event(api_key_obj.pk, 'auth', username=username, error='invalid_signature')
         return JsonResponse({"error": "Invalid authentication"}, status=401)
 
-def check_subscription(api_key):
+def check_subscription(api_key_obj):
     """Проверка активности подписки."""
+    # subscription загружена через select_related в resolve_api_key, дополнительного запроса нет.
+    # Ключ без строки Subscription считается ключом с неактивной подпиской (403, а не 500)
+    subscription = getattr(api_key_obj, 'subscription', None) if api_key_obj is not None else None
+    return subscription is not None and subscription.is_active
+```
+
+#### Контекст авторизации запроса:
+Один запрос к API раньше выполнял `APIKey.objects.get(key=...)` до четырёх раз (`enforce_subscription_and_tokens`, `update_token_usage`, `CompareTextView`, `check_subscription`), а `.subscription` и `.typeid` подгружались отдельными ленивыми запросами. Теперь ключ загружается функцией `resolve_api_key` одним запросом с `select_related('user', 'typeid', 'subscription')` и сохраняется в `request.api_key_obj`; все последующие проверки в рамках запроса используют этот объект.
+
+Загруженные ключи дополнительно кэшируются в памяти процесса на короткое время (`AUTH_CONTEXT_TTL`, по умолчанию 30 секунд). Кэш сбрасывается сигналами при изменении или удалении APIKey, Subscription и TypeID (в том числе через Django Admin). Сигналы сбрасывают кэш только в текущем процессе, в остальных воркерах данные обновятся по истечении TTL. Баланс токенов в кэшированном объекте используется только для порога в `enforce_subscription_and_tokens`; само списание выполняется атомарно в базе.
+
+Для `select_related` подписка связана с ключом через `OneToOneField`:
+```python
+class Subscription(models.Model):
+    api_key = models.OneToOneField('APIKey', on_delete=models.CASCADE, related_name='subscription')
+    type = models.CharField(max_length=50)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    status = models.CharField(max_length=10, choices=[('active', 'Active'), ('inactive', 'Inactive')])
+
+    @property
+    def is_active(self):
+        return self.status == 'active' and self.start_date <= datetime.date.today() <= self.end_date
+```
+
+```python
+# settings.py
+CACHES = {
+    'default': {...},
+    'auth': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth-context'},
+}
+AUTH_CONTEXT_TTL = 30
+```
+
+```python
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import APIKey, Subscription, TypeID
+
+auth_cache = caches['auth']
+
+def _auth_cache_key(api_key):
+    return f"apikey:{api_key}"
+
+@timed('api_key_lookup')
+def resolve_api_key(request, api_key):
+    """Загрузка APIKey вместе с user, typeid и subscription один раз на запрос."""
+    api_key_obj = getattr(request, 'api_key_obj', None)
+    if api_key_obj is not None and api_key_obj.key == api_key:
+        return api_key_obj
+    if not api_key:
+        return None
+
+    api_key_obj = auth_cache.get(_auth_cache_key(api_key))
+    if api_key_obj is None:
+        try:
+            api_key_obj = APIKey.objects.select_related('user', 'typeid', 'subscription').get(key=api_key)
+        except APIKey.DoesNotExist:
+            return None
+        auth_cache.set(_auth_cache_key(api_key), api_key_obj, getattr(settings, 'AUTH_CONTEXT_TTL', 30))
+    request.api_key_obj = api_key_obj
+    return api_key_obj
+
+def invalidate_api_keys(keys):
+    auth_cache.delete_many([_auth_cache_key(key) for key in keys])
+
+@receiver([post_save, post_delete], sender=APIKey)
+def _invalidate_api_key(sender, instance, signal, **kwargs):
+    invalidate_api_keys([instance.key])
+    # Выданные токены содержат статус ключа, поэтому при деактивации и удалении они отзываются
+    if signal is post_delete or instance.status != 'active':
+        revoke_tokens([instance.key])
+
+@receiver([post_save, post_delete], sender=Subscription)
+def _invalidate_subscription(sender, instance, signal, **kwargs):
+    keys = list(APIKey.objects.filter(pk=instance.api_key_id).values_list('key', flat=True))
+    invalidate_api_keys(keys)
+    if signal is post_delete or not instance.is_active:
+        revoke_tokens(keys)
+
+@receiver([post_save, post_delete], sender=TypeID)
+def _invalidate_typeid(sender, instance, **kwargs):
+    invalidate_api_keys(APIKey.objects.filter(typeid=instance).values_list('key', flat=True))
+```
+
+#### Подпись токенов и проверка без обращения к БД:
+Раньше каждый запрос к эндпоинтам текстов декодировал JWT, подписанный общим жёстко заданным ключом `'your_secret_key'`, и затем всё равно загружал APIKey из базы, чтобы проверить статус ключа и подписку. Теперь всё, что нужно для авторизации, содержится в самом токене, а подпись проверяется по набору ключей с идентификаторами (`kid`).
+
+1. **Claims токена** (`issue_token`):
+   - `api_key`, `username`, `key_id` (PK APIKey), `typeid` (PK TypeID), `key_status`, `sub_exp` (окончание подписки, unix time), `iat`, `exp`.
+   - `exp` не позже окончания подписки и не дольше `JWT_TTL` от момента выдачи.
+2. **Проверка** (`verify_token`):
+   - По `kid` из заголовка токена выбирается ключ из `JWT_SIGNING_KEYS`. Неизвестный `kid` — 401.
+   - Проверяются подпись и `exp`, затем `key_status`, `sub_exp` и список отзыва. Обращения к базе нет.
+   - Результат сохраняется в `request.auth_claims`. Эндпоинты, которым нужен только владелец (загрузка эталона, статус задачи), используют `key_id` из токена и не загружают APIKey. Параметры TypeID и `llm_api_key` для сравнения берутся через `resolve_api_key` (кэш процесса).
+3. **Ротация ключей**:
+   - Новые токены подписываются ключом `JWT_ACTIVE_KID`. Для ротации в `JWT_SIGNING_KEYS` добавляется новый ключ и на него переключается `JWT_ACTIVE_KID`. Старый ключ удаляется не раньше, чем через `JWT_TTL`: к этому времени подписанные им токены истекут.
+   - Ключи подписи задаются через переменные окружения, как и ключи LLM.
+4. **Отзыв** (`TokenDenylist`):
+   - При удалении или деактивации APIKey и при деактивации или удалении подписки ключ попадает в список отзыва в памяти процесса вместе с моментом отзыва. Токены этого ключа, выданные не позже этого момента, отклоняются. Токены, выданные после повторной активации, действуют.
+   - Записи старше `JWT_TTL` удаляются: выданные до них токены уже истекли, поэтому список остаётся небольшим.
+   - Если задан `JWT_REVOCATION_REDIS_URL`, отзыв публикуется в канал Redis, и остальные воркеры применяют его через фоновый поток-подписчик (`start_revocation_listener` вызывается из `AppConfig.ready`). Без Redis, а также для воркеров, запущенных после отзыва, окно действия отозванного токена ограничено `JWT_TTL`.
+5. **Подпись HMAC** при выдаче токена сравнивается через `hmac.compare_digest`, время проверки не зависит от совпадающего префикса подписи.
+
+```python
+# settings.py
+JWT_SIGNING_KEYS = {
+    '2024-06': os.environ['JWT_SIGNING_KEY_2024_06'],
+    '2024-01': os.environ['JWT_SIGNING_KEY_2024_01'],  # удалить после JWT_TTL с момента ротации
+}
+JWT_ACTIVE_KID = '2024-06'
+JWT_TTL = 60 * 60
+JWT_REVOCATION_REDIS_URL = None  # например, 'redis://localhost:6379/1'
+```
+
+```python
+import datetime
+import json
+import threading
+import time
+
+import jwt
+from django.conf import settings
+from django.utils import timezone
+
+REVOCATION_CHANNEL = 'jwt-revocations'
+
+
+class TokenError(Exception):
+    """Токен отсутствует, повреждён, истёк или отозван."""
+    status = 401
+
+
+class TokenForbidden(TokenError):
+    """Токен действителен, но ключ неактивен или подписка истекла."""
+    status = 403
+
+
+class TokenDenylist:
+    """Отзыв токенов API ключа: токены, выданные до момента отзыва, отклоняются."""
+
+    def __init__(self):
+        self._revoked = {}  # api_key -> момент отзыва (unix time)
+        self._lock = threading.Lock()
+
+    def revoke(self, api_key, revoked_at):
+        with self._lock:
+            self._revoked[api_key] = max(revoked_at, self._revoked.get(api_key, 0))
+            # Токены, выданные раньше JWT_TTL назад, уже истекли, их записи не нужны
+            horizon = time.time() - settings.JWT_TTL
+            self._revoked = {key: at for key, at in self._revoked.items() if at >= horizon}
+
+    def is_revoked(self, api_key, issued_at):
+        revoked_at = self._revoked.get(api_key)
+        return revoked_at is not None and issued_at <= revoked_at
+
+
+token_denylist = TokenDenylist()
+
+
+def issue_token(api_key_obj, username):
+    """Выдача JWT с claims, достаточными для авторизации без обращения к базе."""
+    now = int(time.time())
+    subscription_end = datetime.datetime.combine(
+        api_key_obj.subscription.end_date + datetime.timedelta(days=1), datetime.time.min,
+        tzinfo=timezone.get_current_timezone(),
+    )
+    sub_exp = int(subscription_end.timestamp())
+    claims = {
+        'api_key': api_key_obj.key,
+        'username': username,
+        'key_id': api_key_obj.pk,
+        'typeid': api_key_obj.typeid_id,
+        'key_status': api_key_obj.status,
+        'sub_exp': sub_exp,
+        'iat': now,
+        'exp': min(now + settings.JWT_TTL, sub_exp),
+    }
+    kid = settings.JWT_ACTIVE_KID
+    return jwt.encode(claims, settings.JWT_SIGNING_KEYS[kid], algorithm='HS256', headers={'kid': kid})
+
+
+@timed('jwt_verify')
+def verify_token(request):
+    """Проверка JWT из заголовка Authorization без запросов к базе; возвращает claims."""
+    claims = getattr(request, 'auth_claims', None)
+    if claims is not None:
+        return claims
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme != 'Bearer' or not token:
+        raise TokenError('Missing bearer token')
     try:
-        api_key_obj = APIKey.objects.get(key=api_key)
-        return api_key_obj.subscription.is_active
-    except APIKey.DoesNotExist:
-        return False
+        signing_key = settings.JWT_SIGNING_KEYS[jwt.get_unverified_header(token).get('kid')]
+        claims = jwt.decode(
+            token, signing_key, algorithms=['HS256'],
+            options={'require': ['exp', 'iat', 'api_key', 'key_id', 'key_status', 'sub_exp']},
+        )
+    except jwt.ExpiredSignatureError:
+        raise TokenError('Token expired')
+    except (jwt.InvalidTokenError, KeyError):
+        raise TokenError('Invalid token')
+
+    if token_denylist.is_revoked(claims['api_key'], claims['iat']):
+        raise TokenError('Token revoked')
+    if claims['key_status'] != 'active':
+        raise TokenForbidden('API key is inactive')
+    if claims['sub_exp'] <= time.time():
+        raise TokenForbidden('Subscription is inactive or expired')
+    request.auth_claims = claims
+    return claims
+
+
+def _revocation_client():
+    url = getattr(settings, 'JWT_REVOCATION_REDIS_URL', None)
+    if not url:
+        return None
+    import redis
+    return redis.Redis.from_url(url)
+
+
+def revoke_tokens(keys):
+    """Отзыв токенов ключей в текущем процессе и публикация отзыва для остальных воркеров."""
+    keys = list(keys)
+    if not keys:
+        return
+    revoked_at = time.time()
+    for key in keys:
+        token_denylist.revoke(key, revoked_at)
+    client = _revocation_client()
+    if client is not None:
+        client.publish(REVOCATION_CHANNEL, json.dumps({'keys': keys, 'revoked_at': revoked_at}))
+
+
+def start_revocation_listener():
+    """Фоновый поток, применяющий отзывы из других воркеров; вызывается из AppConfig.ready."""
+    client = _revocation_client()
+    if client is None:
+        return
+
+    def listen():
+        import redis
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(REVOCATION_CHANNEL)
+                for message in pubsub.listen():
+                    data = json.loads(message['data'])
+                    for key in data['keys']:
+                        token_denylist.revoke(key, data['revoked_at'])
+            except redis.RedisError:
+                # Отзывы, пропущенные за время разрыва, перекрываются сроком жизни токена
+                time.sleep(1)
+
+    threading.Thread(target=listen, name='jwt-revocation', daemon=True).start()
+```
+
+Отзыв токенов выполняется в тех же сигналах, которые сбрасывают кэш ключей (см. выше).
+
+Задержка проверки авторизации до и после измеряется скриптом `bench_auth.py`: «до» — декодирование токена и загрузка APIKey с подпиской из базы, «после» — `verify_token`.
+```python
+"""Задержка проверки авторизации: JWT + загрузка APIKey из базы против проверки claims токена.
+
+Запуск: DJANGO_SETTINGS_MODULE=project.settings python bench_auth.py <api_key> <username>
+"""
+import statistics
+import sys
+import time
+
+import django
+
+django.setup()
+
+import jwt
+from django.test import RequestFactory
+
+from api.models import APIKey
+from api.views import check_subscription, issue_token, verify_token
+
+REPEATS = 2000
+
+
+def legacy_auth(request, token):
+    claims = jwt.decode(token, 'your_secret_key', algorithms=['HS256'])
+    api_key_obj = APIKey.objects.select_related('user', 'typeid', 'subscription').get(key=claims['api_key'])
+    return check_subscription(api_key_obj)
+
+
+def fast_auth(request, token):
+    return verify_token(request)
+
+
+def measure(check, token):
+    timings = []
+    for _ in range(REPEATS):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        start = time.perf_counter()
+        check(request, token)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+if __name__ == '__main__':
+    api_key_obj = APIKey.objects.select_related('subscription').get(key=sys.argv[1])
+    legacy_token = jwt.encode({'api_key': api_key_obj.key}, 'your_secret_key', algorithm='HS256')
+    print(f"{'path':10} {'p50, us':>10} {'p99, us':>10}")
+    for name, check, token in (
+        ('before', legacy_auth, legacy_token),
+        ('after', fast_auth, issue_token(api_key_obj, sys.argv[2])),
+    ):
+        p50, p99 = measure(check, token)
+        print(f"{name:10} {p50:10.1f} {p99:10.1f}")
+```
+
+Количество запросов к БД на каждый эндпоинт фиксируется тестами:
+```python
+import hashlib
+import hmac
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase, override_settings
+
+@override_settings(JWT_SIGNING_KEYS={'test': 'test-signing-key-0123456789abcdef'}, JWT_ACTIVE_KID='test', JWT_TTL=3600)
+class AuthContextQueryCountTest(TestCase):
+    def setUp(self):
+        auth_cache.clear()
+        reference_cache.clear()
+        get_comparison_cache().backend = LRUCacheBackend(max_entries=100)
+        user = User.objects.create(username='tester')
+        typeid = TypeID.objects.create(scale='1', system='Эталон: ', user='Работа: ', model='gpt-4o', llm='openai')
+        self.api_key = APIKey.objects.create(
+            user=user, key='test-key', secret_key='secret', typeid=typeid,
+            llm_api_key='sk-test', tokens_remaining=1000000, status='active',
+        )
+        Subscription.objects.create(
+            api_key=self.api_key, type='basic', status='active',
+            start_date=datetime.date.today(), end_date=datetime.date.today() + datetime.timedelta(days=30),
+        )
+        self.reference_bytes = 'Эталонный текст'.encode('utf-8')
+        self.reference = Text.objects.create(
+            api_key=self.api_key, text='Эталонный текст',
+            content_hash=hashlib.sha256(self.reference_bytes).hexdigest(),
+        )
+        token = issue_token(self.api_key, 'tester')
+        self.auth_headers = {'HTTP_AUTHORIZATION': f'Bearer {token}', 'HTTP_X_API_KEY': self.api_key.key}
+
+    def compare(self):
+        payload = {'file': SimpleUploadedFile('work.txt', 'Текст работы'.encode('utf-8'))}
+        usage = LLMUsage(input_tokens=8, output_tokens=2)
+        with mock.patch('api.views.request_llm_report', return_value=('report', usage)):
+            return self.client.post(f'/api/v1/compare/{self.reference.id}', payload, **self.auth_headers)
+
+    def test_compare_cold_caches(self):
+        # APIKey+user+typeid+subscription, владелец Text, текст эталона, резерв токенов, корректировка резерва
+        with self.assertNumQueries(5):
+            self.compare()
+
+    def test_compare_warm_caches(self):
+        resolve_api_key(RequestFactory().get('/'), self.api_key.key)
+        get_reference_prompt(self.reference.id, self.api_key.typeid)
+        # Владелец Text, резерв токенов, корректировка резерва
+        with self.assertNumQueries(3):
+            self.compare()
+
+    def test_upload_duplicate(self):
+        payload = {'file': SimpleUploadedFile('reference.txt', self.reference_bytes)}
+        # APIKey для лимитов и порога токенов в AdmissionControlMiddleware и поиск по content_hash;
+        # само представление ключ не загружает, текст не извлекается и не сохраняется
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/v1/reference', payload, **self.auth_headers)
+        self.assertEqual(response.json(), {'reference_id': self.reference.id, 'duplicate': True})
+
+    def test_auth(self):
+        signature = hmac.new(b'secret', b'test-key.tester', hashlib.sha256).hexdigest()
+        payload = {'api_key': 'test-key', 'signature': signature, 'username': 'tester'}
+        # Подпись и подписка проверяются по одному загруженному ключу
+        with self.assertNumQueries(1):
+            self.client.post('/api/v1/auth', payload, content_type='application/json')
+
+    def test_auth_without_subscription(self):
+        Subscription.objects.filter(api_key=self.api_key).delete()
+        signature = hmac.new(b'secret', b'test-key.tester', hashlib.sha256).hexdigest()
+        payload = {'api_key': 'test-key', 'signature': signature, 'username': 'tester'}
+        response = self.client.post('/api/v1/auth', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_revoked_token_rejected(self):
+        self.api_key.status = 'inactive'
+        self.api_key.save()
+        response = self.client.post(f'/api/v1/compare/{self.reference.id}', {}, **self.auth_headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_signed_with_retired_key(self):
+        with override_settings(JWT_SIGNING_KEYS={'old': 'old-signing-key-0123456789abcdef'}, JWT_ACTIVE_KID='old'):
+            token = issue_token(self.api_key, 'tester')
+        # После удаления ключа 'old' из набора токен не принимается
+        response = self.client.get('/api/v1/jobs/00000000-0000-0000-0000-000000000000', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 401)
 ```
 ### 4. Работа с текстами
 Блок описывает работу с текстами в системе, включая загрузку текстов и их сравнение с использованием мод
@@ -275,14 +794,23 @@ def check_subscription(api_key):
 #### Функции работы с текстами:
 
 ##### Загрузка и декодирование файлов:
+Файлы принимаются в multipart форме (поле `file`) или телом запроса в Base64 (`Content-Type: application/base64`, имя файла в заголовке `X-File-Name`). Текст извлекается постранично нативными парсерами с ограничениями по страницам, размеру и времени (раздел 9).
 ```python
-import textract
+import os
+
+from django.core.files import File
 from django.http import JsonResponse
 
-def decode_file(file_path):
-    """Декодирование текста из файла, поддерживающее различные форматы."""
-    text = textract.process(file_path)
-    return text.decode('utf-8')
+from .extraction import ExtractionError, ExtractionLimits, decode_file, spool_base64_upload
+
+def receive_upload(request):
+    """Получение загруженного файла из multipart формы или из тела запроса в Base64."""
+    if 'file' in request.FILES:
+        return request.FILES['file']
+    limits = ExtractionLimits.from_settings()
+    # Base64 декодируется по частям во временный файл, тело запроса целиком в память не читается
+    spooled = spool_base64_upload(request, limits.max_bytes)
+    return File(spooled, name=os.path.basename(request.headers.get('X-File-Name', 'document.txt')))
 ```
 
 ##### Загрузка эталонного текста:
@@ -293,95 +821,400 @@ import jwt
 
 class UploadReferenceTextView(View):
     def post(self, request):
-        token = request.headers.get('Authorization', '').split(' ')[1]
-        api_key_details = jwt.decode(token, 'your_secret_key', algorithms=["HS256"])
-        api_key = api_key_details['api_key']
+        # Статус ключа и подписка проверяются по claims токена, APIKey из базы не загружается
+        try:
+            api_key_id = verify_token(request)['key_id']
+        except TokenError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        try:
+            file = receive_upload(request)
+            # Повторная загрузка того же файла возвращает существующий reference_id без извлечения текста
+            content_hash = hash_upload(file)
+            existing_id = find_reference_by_hash(api_key_id, content_hash)
+            if existing_id is not None:
+                log_event(api_key_id, 'reference_upload', reference_id=existing_id, duplicate=True)
+                return JsonResponse({'reference_id': existing_id, 'duplicate': True}, status=200)
 
-        file = request.FILES['file']
-        file_path = handle_file_upload(file)  # Функция для сохранения файла на сервере
-        text = decode_file(file_path)
+            file_path = handle_file_upload(file)  # Функция для сохранения файла на сервере
+            text = decode_file(file_path)
+        except ExtractionError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
 
         # Сохранение эталонного текста
-        reference_text = Text.objects.create(api_key_id=api_key, text=text)
+        try:
+            with transaction.atomic():
+                reference_text = Text.objects.create(
+                    api_key_id=api_key_id,
+                    text=text,
+                    content_hash=content_hash,
+                    signature=compute_signature(text),  # для локальной оценки сходства при сравнении
+                )
+        except IntegrityError:
+            # Параллельная загрузка того же файла успела сохранить текст первой
+            existing_id = find_reference_by_hash(api_key_id, content_hash)
+            log_event(api_key_id, 'reference_upload', reference_id=existing_id, duplicate=True)
+            return JsonResponse({'reference_id': existing_id, 'duplicate': True}, status=200)
+        # Запись журнала выполняется фоновым потоком пакетами (раздел 17)
+        log_event(api_key_id, 'reference_upload', reference_id=reference_text.id)
         return JsonResponse({'reference_id': reference_text.id}, status=201)
 ```
 
+##### Дедупликация загрузок и кэш эталонных текстов:
+Для каждого эталонного текста хранится SHA-256 исходного файла (`content_hash`) с уникальным индексом в пределах API ключа. Повторная загрузка тех же байтов возвращает существующий `reference_id` без сохранения файла и извлечения текста.
+
+При сравнении эталонный текст не читается из базы на каждый запрос. Часть промпта, зависящая только от эталона и TypeID (`system + reference_text`), вместе с числом её токенов и хэшем текста собирается один раз и хранится в кэше процесса (`ReferencePrompt`). Повторные сравнения с «горячим» эталоном выполняют только работу по сравниваемому тексту: проверка владельца эталона выполняется запросом без тела текста, а ключ кэша результатов (раздел 6) использует готовый хэш эталона вместо повторного хэширования текста.
+
+Сам текст хранится сжатым в столбце `body` или в файловом хранилище и не загружается запросами метаданных (раздел 21).
+
+```python
+from .text_storage import decode_text, encode_text
+
+
+class TextManager(models.Manager):
+    def get_queryset(self):
+        # Тело текста не загружается вместе с метаданными, читается только свойством text
+        return super().get_queryset().defer('body')
+
+
+class Text(models.Model):
+    api_key = models.ForeignKey('APIKey', on_delete=models.CASCADE)
+    # SHA-256 исходного файла; NULL у эталонов, загруженных до дедупликации (их файлы не сохранены)
+    content_hash = models.CharField(max_length=64, null=True)
+    signature = models.BinaryField(null=True, editable=False)  # MinHash сигнатура текста (раздел 13)
+    # Хранение текста (раздел 21): сжатое тело в базе или путь в файловом хранилище
+    text_hash = models.CharField(max_length=64, default='')  # SHA-256 текста в UTF-8
+    text_length = models.IntegerField(default=0)
+    compression = models.CharField(max_length=8, default='none')
+    body = models.BinaryField(null=True, editable=False)
+    body_path = models.CharField(max_length=255, blank=True, default='')
+    body_size = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = TextManager()
+
+    class Meta:
+        base_manager_name = 'objects'  # связи и каскадное удаление тоже не загружают body
+        constraints = [
+            models.UniqueConstraint(fields=['api_key', 'content_hash'], name='unique_text_content_per_key'),
+        ]
+
+    @property
+    def text(self):
+        """Текст целиком: тело загружается и распаковывается отдельным запросом."""
+        if '_text' not in self.__dict__:
+            body, body_path, compression = Text.objects.values_list('body', 'body_path', 'compression').get(pk=self.pk)
+            self._text = decode_text(body, body_path, compression)
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._text_changed = True
+
+    def save(self, *args, **kwargs):
+        # Text.objects.create(text=...) сжимает и сохраняет текст здесь
+        if self.__dict__.pop('_text_changed', False):
+            for name, value in encode_text(self._text).items():
+                setattr(self, name, value)
+        super().save(*args, **kwargs)
+```
+
+```python
+# settings.py
+CACHES = {
+    ...
+    'references': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'reference-prompts',
+        'OPTIONS': {'MAX_ENTRIES': 200},
+    },
+}
+REFERENCE_PROMPT_TTL = 60 * 60
+```
+
+Исходные файлы уже загруженных эталонов не сохранялись, поэтому их `content_hash` восстановить нельзя: хэш извлечённого текста не совпадёт с хэшем файла при повторной загрузке, а у двух эталонов одного ключа с одинаковым текстом нарушил бы уникальность. Поле добавляется допускающим NULL, существующие строки остаются с NULL и не участвуют в дедупликации (NULL не совпадает с другими значениями в уникальном индексе). Ограничение создаётся после добавления столбца, отдельной операцией:
+```python
+# api/migrations/00xx_text_content_hash.py
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [('api', '00xx_previous')]
+    operations = [
+        migrations.AddField('text', 'content_hash', models.CharField(max_length=64, null=True)),
+        migrations.AddConstraint(
+            'text',
+            models.UniqueConstraint(fields=['api_key', 'content_hash'], name='unique_text_content_per_key'),
+        ),
+    ]
+```
+
+```python
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+
+from .models import Text
+
+reference_cache = caches['references']
+
+
+def hash_upload(file):
+    """SHA-256 загруженного файла, считается по частям."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def find_reference_by_hash(api_key_id, content_hash):
+    return Text.objects.filter(api_key_id=api_key_id, content_hash=content_hash).values_list('id', flat=True).first()
+
+
+def count_tokens(text, model):
+    """Число токенов текста для модели; без tiktoken или для неизвестной модели — оценка по длине."""
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model)
+    except (ImportError, KeyError):
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class ReferencePrompt:
+    """Подготовленная часть промпта с эталонным текстом для пары (Text, TypeID)."""
+
+    __slots__ = ('prefix', 'prefix_tokens', 'digest', 'system_length', 'signature')
+
+    def __init__(self, prefix, prefix_tokens, digest, system_length=0, signature=None):
+        self.prefix = prefix                # typeid.system + reference_text
+        self.prefix_tokens = prefix_tokens
+        self.digest = digest                # SHA-256 эталонного текста
+        self.system_length = system_length  # длина typeid.system в начале prefix
+        self.signature = signature          # MinHash сигнатура эталона (раздел 13)
+
+    @property
+    def text(self):
+        """Эталонный текст без system части (нужен для разбиения на фрагменты, раздел 12)."""
+        return self.prefix[self.system_length:]
+
+
+@timed('reference_lookup')
+def get_reference_prompt(text_id, typeid):
+    """Загрузка подготовленного промпта эталона из кэша или из базы."""
+    # Отпечаток параметров TypeID в ключе: после редактирования TypeID промпт собирается заново
+    fingerprint = hashlib.sha256(f"{typeid.model}\0{typeid.system}".encode('utf-8')).hexdigest()[:16]
+    cache_key = f"refprompt:{text_id}:{typeid.pk}:{fingerprint}"
+    prompt = reference_cache.get(cache_key)
+    if prompt is None:
+        body, body_path, compression, text_hash, signature = Text.objects.values_list(
+            'body', 'body_path', 'compression', 'text_hash', 'signature',
+        ).get(pk=text_id)
+        reference_text = decode_text(body, body_path, compression)
+        prefix = typeid.system + reference_text
+        prompt = ReferencePrompt(
+            prefix=prefix,
+            prefix_tokens=count_tokens(prefix, typeid.model),
+            digest=text_hash,  # хэш текста сохранён при загрузке (раздел 21)
+            system_length=len(typeid.system),
+            # Для эталонов, загруженных до появления сигнатур, она вычисляется при сборке промпта
+            signature=bytes(signature) if signature is not None else compute_signature(reference_text),
+        )
+        reference_cache.set(cache_key, prompt, getattr(settings, 'REFERENCE_PROMPT_TTL', 60 * 60))
+    return prompt
+```
+
 ##### Сравнение текстов:
 ```python
 class CompareTextView(View):
     def post(self, request, reference_id):
-        token = request.headers.get('Authorization', '').split(' ')[1]
-        api_key_details = jwt.decode(token, 'your_secret_key', algorithms=["HS256"])
-        api_key = api_key_details['api_key']
-
-        file = request.FILES['file']
-        file_path = handle_file_upload(file)
-        compare_text = decode_file(file_path)
+        try:
+            claims = verify_token(request)
+        except TokenError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
 
+        # Параметры TypeID и llm_api_key для запроса к провайдеру берутся из кэша ключей
+        api_key_obj = resolve_api_key(request, claims['api_key'])
+        if api_key_obj is None:
+            return JsonResponse({'error': 'Reference text or API key not found'}, status=404)
         try:
-            api_key_obj = APIKey.objects.get(key=api_key)
-            reference_text = Text.objects.get(id=reference_id, api_key=api_key_obj)
+            # Проверка владельца без загрузки самого текста, текст берётся из кэша промптов
+            reference_text = Text.objects.only('id', 'api_key').get(id=reference_id, api_key=api_key_obj)
             typeid = api_key_obj.typeid
-        except (Text.DoesNotExist, APIKey.DoesNotExist):
+        except Text.DoesNotExist:
             return JsonResponse({'error': 'Reference text or API key not found'}, status=404)
 
-        # Сравнение текстов
-        similarity_report = compare_texts_llm(reference_text.text, compare_text, typeid)
-        return JsonResponse({'report': similarity_report}, status=200)
+        try:
+            file = receive_upload(request)
+            file_path = handle_file_upload(file)
+
+            # Асинхронный режим: извлечение текста и вызов LLM выполняются в пуле воркеров (раздел 7)
+            if request.GET.get('async') == '1':
+                return submit_compare_job(api_key_obj, reference_text, file_path, request.GET.get('callback_url'))
+
+            compare_text = decode_file(file_path)
+        except ExtractionError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        # Сравнение текстов: очевидные копии и посторонние документы отсекаются без LLM (раздел 13)
+        reference = get_reference_prompt(reference_text.id, typeid)
+        # Потоковый режим: фрагменты отчёта передаются клиенту по мере генерации (раздел 16)
+        if request.GET.get('stream') == '1':
+            return stream_compare_response(request, api_key_obj, reference, compare_text, typeid)
+        try:
+            similarity_report, local_score = compare_with_prefilter(reference, compare_text, typeid, api_key_obj)
+        except LLMError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        return JsonResponse({'report': similarity_report, 'local_score': local_score.as_dict()}, status=200)
 ```
 
+##### Учёт токенов:
+Токены списываются по фактическому расходу провайдера (`usage` в ответе LLM). Перед вызовом провайдера резервируется оценка расхода одним условным `UPDATE`, после ответа резерв корректируется на разницу с фактическим расходом. Обе операции выполняются в базе без чтения строки в Python, поэтому учёт остаётся корректным при сотнях параллельных запросов на один ключ.
+
+```python
+from django.conf import settings
+from django.db.models import F
+
+@timed('token_usage')
 def update_token_usage(api_key, cost=1):
-    """Обновление использования токенов при каждом запросе."""
-    try:
-        api_key_obj = APIKey.objects.get(key=api_key)
-        if api_key_obj.tokens_remaining >= cost:
-            api_key_obj.tokens_remaining -= cost
-            api_key_obj.save()
-            return True
-        else:
-            return False
-    except APIKey.DoesNotExist:
-        return False
+    """Атомарное списание токенов: UPDATE ... SET tokens_remaining = tokens_remaining - cost WHERE tokens_remaining >= cost."""
+    # Условие проверяется самой базой под блокировкой строки, поэтому параллельные
+    # запросы на один ключ не теряют списания и не уводят баланс в минус
+    updated = APIKey.objects.filter(key=api_key, tokens_remaining__gte=cost).update(
+        tokens_remaining=F('tokens_remaining') - cost
+    )
+    return updated == 1
+
+def settle_token_usage(api_key, reserved, usage=None):
+    """Корректировка резерва по фактическому расходу токенов провайдера и учёт расхода для биллинга."""
+    usage = usage or LLMUsage()
+    # Одним UPDATE возвращается неиспользованный остаток резерва (или доначисляется перерасход)
+    # и увеличиваются счётчики входных, закэшированных входных и выходных токенов
+    APIKey.objects.filter(key=api_key).update(
+        tokens_remaining=F('tokens_remaining') + (reserved - usage.total_tokens),
+        input_tokens_used=F('input_tokens_used') + usage.input_tokens,
+        cached_input_tokens_used=F('cached_input_tokens_used') + usage.cached_input_tokens,
+        output_tokens_used=F('output_tokens_used') + usage.output_tokens,
+    )
+
+def estimate_request_tokens(reference, compare_text, typeid):
+    """Оценка расхода токенов на запрос для резервирования до вызова провайдера."""
+    # Токены эталонной части посчитаны заранее, для сравниваемого текста около 4 символов на токен
+    compare_tokens = (len(typeid.user) + len(compare_text)) // 4
+    output_reserve = getattr(settings, 'LLM_OUTPUT_TOKEN_RESERVE', 1024)
+    tokens = reference.prefix_tokens + compare_tokens + output_reserve
+    if typeid.chunking != 'none':
+        # Верхняя оценка числа фрагментов: каждый повторяет system и user и получает свой ответ,
+        # а ответы фрагментов становятся входом шага объединения
+        chunks = (reference.prefix_tokens + compare_tokens) // max(typeid.chunk_tokens // 4, 1) + 1
+        tokens += chunks * ((len(typeid.system) + len(typeid.user)) // 4 + 2 * output_reserve)
+    return tokens
+```
 
 
 ###  функция compare_texts_llm
 
 ```python
-def compare_texts_llm(reference_text, compare_text, typeid, api_key):
-    """Функция для сравнения текстов с использованием LLM на основе параметров TypeID."""
-    # Проверка и обновление токенов
-    if not update_token_usage(api_key):
+class LLMError(Exception):
+    """Ошибка провайдера LLM или неподдерживаемый провайдер."""
+    status = 502
+
+
+class LLMUsage:
+    """Расход токенов одного запроса к провайдеру."""
+
+    __slots__ = ('input_tokens', 'cached_input_tokens', 'output_tokens', 'fallback_used')
+
+    def __init__(self, input_tokens=0, cached_input_tokens=0, output_tokens=0):
+        self.input_tokens = input_tokens
+        self.cached_input_tokens = cached_input_tokens  # входит в input_tokens
+        self.output_tokens = output_tokens
+        self.fallback_used = False  # ответ получен от резервной модели TypeID (раздел 15)
+
+    @property
+    def total_tokens(self):
+        return self.input_tokens + self.output_tokens
+
+    def add(self, other):
+        self.input_tokens += other.input_tokens
+        self.cached_input_tokens += other.cached_input_tokens
+        self.output_tokens += other.output_tokens
+        self.fallback_used = self.fallback_used or other.fallback_used
+
+    def as_dict(self):
+        return {
+            'input_tokens': self.input_tokens,
+            'cached_input_tokens': self.cached_input_tokens,
+            'output_tokens': self.output_tokens,
+        }
+
+
+@timed('compare')
+def compare_texts_llm(reference, compare_text, typeid, api_key_obj):
+    """Функция для сравнения текстов с использованием LLM на основе параметров TypeID.
+
+    reference — подготовленный промпт эталона (ReferencePrompt), см. get_reference_prompt.
+    """
+    api_key = api_key_obj.key
+    started = time.monotonic()
+    # Повторное сравнение отдаётся из кэша: без обращения к провайдеру и без списания токенов
+    cache = get_comparison_cache()
+    cache_key = cache.make_key(reference, compare_text, typeid)
+    cached_report = cache.get(cache_key)
+    if cached_report is not None:
+        log_comparison(api_key_obj, started, cache_hit=True)
+        return cached_report
+
+    # Резервирование оценки токенов, после ответа резерв корректируется по фактическому расходу
+    reserved = estimate_request_tokens(reference, compare_text, typeid)
+    if not update_token_usage(api_key, cost=reserved):
+        log_comparison(api_key_obj, started, error='token_limit')
         return "Token limit reached. Subscription renewal required."
 
-    system = typeid.system
-    user = typeid.user
-    model = typeid.model
-    llm_provider = typeid.llm
+    usage = LLMUsage()
+    try:
+        report = run_comparison(reference, compare_text, typeid, api_key_obj.llm_api_key, usage)
+    except (LLMError, RateLimited) as e:
+        # Оплачиваются обращения к провайдеру, выполненные до ошибки (например, часть фрагментов);
+        # ошибка доходит до представления и не возвращается клиенту как текст отчёта
+        settle_token_usage(api_key, reserved, usage)
+        log_comparison(api_key_obj, started, usage, error=type(e).__name__)
+        raise
+    settle_token_usage(api_key, reserved, usage)
+    log_comparison(api_key_obj, started, usage)
 
-    if llm_provider == 'openai':
-        from openai import ChatCompletion
-        client = OpenAI()
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system + reference_text},
-                {"role": "user", "content": user + compare_text}
-            ]
-        )
-        return completion.choices[0].message['content']
+    # В кэш попадают только успешные отчёты основной модели TypeID (раздел 15)
+    if not usage.fallback_used:
+        cache.set(cache_key, report, typeid)
+    return report
 
-    elif llm_provider == 'gemini':
-        import genai
-        model = genai.GenerativeModel('gemini-pro')
-        request = f"{system}{reference_text} {user}{compare_text}"
-        try:
-            response = model.generate_content(request)
-            return response['result']
-        except Exception as e:
-            return str(e)
 
-    else:
-        return "Unsupported LLM provider"
+def run_comparison(reference, compare_text, typeid, llm_api_key, usage):
+    """Сравнение без кэша отчётов и без списания токенов; расход провайдера добавляется в usage."""
+    if typeid.chunking != 'none':
+        # Большие документы сравниваются по фрагментам с объединением отчётов (раздел 12)
+        return compare_texts_chunked(reference, compare_text, typeid, llm_api_key, usage)
+    report, call_usage = request_llm_report(reference, compare_text, typeid, llm_api_key)
+    usage.add(call_usage)
+    return report
+
+
+def request_llm_report(reference, compare_text, typeid, llm_api_key):
+    """Запрос отчёта у провайдера LLM, без кэша и без списания токенов.
+
+    Возвращает пару (отчёт, LLMUsage по данным провайдера).
+
+    Эталонная часть промпта (reference.prefix) всегда идёт первой и побайтно совпадает
+    между запросами, чтобы провайдер мог переиспользовать её из своего кэша (раздел 10).
+    """
+    # Адаптер провайдера с пулом соединений создаётся один раз на (провайдер, llm_api_key), раздел 11.
+    # Дедлайн, повторы, выключатель и резервная модель — раздел 15, лимиты RPM/TPM — раздел 14
+    return call_provider(reference, compare_text, typeid, llm_api_key)
 
 ```
 
@@ -414,83 +1247,5081 @@ from .models import APIKey
 @admin.register(APIKey)
 class APIKeyAdmin(admin.ModelAdmin):
     list_display = ['user', 'key', 'typeid', 'llm_api_key', 'tokens_remaining', 'token_limit', 'status']
-    fields = ['user', 'key', 'secret_key', 'typeid', 'llm_api_key', 'tokens_remaining', 'token_limit', 'status']
+    fields = ['user', 'key', 'secret_key', 'typeid', 'llm_api_key', 'tokens_remaining', 'token_limit', 'status',
+              'rate_limit_rpm', 'max_concurrency']
 	
 ##### Проверка статуса подписки и токенов:
 ```python
 def enforce_subscription_and_tokens(request):
     """Миддлваре для проверки подписки и токенов перед выполнением запросов."""
-    api_key = request.headers.get('X-API-Key')
-    api_key_obj = APIKey.objects.get(key=api_key)
-    if not api_key_obj or not api_key_obj.subscription.is_active:
-        return JsonResponse({'error': 'Subscription is inactive or expired'}, status=403)
+    # Статус ключа и срок подписки проверяются по claims токена без обращения к базе;
+    # claims сохраняются в request.auth_claims и переиспользуются представлениями
+    try:
+        claims = verify_token(request)
+    except TokenError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
 
+    # Баланс токенов меняется с каждым запросом, поэтому берётся из кэша ключей, а не из токена
+    api_key_obj = resolve_api_key(request, claims['api_key'])
+    if api_key_obj is None:
+        return JsonResponse({'error': 'API key not found'}, status=404)
     if api_key_obj.tokens_remaining < 500:
         return JsonResponse({'error': 'Token limit reached. Subscription renewal required.'}, status=429)
 
-    # Обновление использования токенов
-    if not update_token_usage(api_key):
-        return JsonResponse({'error': 'Insufficient tokens available.'}, status=429)
-
+    # Токены списываются в compare_texts_llm по фактическому расходу провайдера,
+    # поэтому здесь только проверка порога, без второго запроса и списания
     return None
 ```
 
 Это обновление учитывает проверку токенов в дополнение к статусу подписки, что позволяет более тщательно контролировать доступ к ресурсам API и обеспечивать соответствие использования услугам, оплаченным пользователем.
 
 
-### Дополнительные замечания:
+### 6. Кэширование результатов сравнения
 
-1. **Обработка ошибок**:
-   - Необходимо добавить обработку ошибок для каждого из вызовов LLM, чтобы предотвратить сбои приложения из-за возможных исключений при генерации контента.
+#### Бизнес требования:
+- **Повторные запросы без затрат**: Основная часть запросов на сравнение — повторная отправка того же документа против того же эталона. Такие запросы не должны обращаться к провайдеру LLM и расходовать квоту и токены пользователя.
+- **Ключ по содержимому**: Результат кэшируется по хэшу эталонного текста, сравниваемого текста и параметров TypeID (system, user, model, llm), поэтому изменение любого из них даёт новый ключ.
+- **Подключаемое хранилище**: Поддерживаются LRU кэш в памяти процесса и Redis (общий для всех воркеров). Выбор хранилища задаётся в настройках Django.
+- **Ограничение размера и времени жизни**: Для записей задаётся TTL, размер кэша ограничен с вытеснением давно не использованных записей.
+- **Инвалидация**: При редактировании или удалении TypeID через `TypeIDView` все закэшированные отчёты этого TypeID удаляются.
+- **Мониторинг**: Счётчики попаданий и промахов доступны администраторам.
 
-2. **Тестирование**:
-   - Проверьте форматы возвращаемых данных, так как предположения о структуре ответа могут отличаться.
+#### Описание работы функций:
+1. **Поиск в кэше**:
+   - `compare_texts_llm` вычисляет ключ кэша до проверки токенов. При попадании отчёт возвращается сразу, `update_token_usage` не вызывается.
+2. **Сохранение результата**:
+   - После успешного ответа провайдера отчёт сохраняется в кэш с тегом TypeID. Ошибки провайдера не кэшируются.
+3. **Сброс кэша**:
+   - `TypeIDView.put` и `TypeIDView.delete` вызывают `invalidate_typeid`, который удаляет все записи с тегом этого TypeID.
 
-3. **Хранение API ключей для LMM**:
-   - Хранение ключей для LLM в файле env.
+#### Настройки:
+```python
+COMPARE_CACHE = {
+    'BACKEND': 'lru',          # 'lru' или 'redis'
+    'TTL': 60 * 60 * 24,       # время жизни записи, секунды
+    'MAX_ENTRIES': 10000,      # только для 'lru'
+    'REDIS_URL': 'redis://localhost:6379/1',
+}
+```
 
+#### Пример реализации:
+```python
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 
-База данных должна обеспечивать хранение данных о пользователях, API ключах, конфигурациях моделей (TypeID), текстах для сравнения, и информации о подписках. Использование PostgreSQL обеспечит необходимую гибкость и масштабируемость. Предлагаемая структура базы данных:
+from django.conf import settings
 
-### Таблицы базы данных:
 
-1. **Users**
-   - **id** (PK)
-   - **username** (VARCHAR)
-   - **email** (VARCHAR)
-   - **hashed_password** (VARCHAR)
-   - **created_at** (TIMESTAMP)
-   - **updated_at** (TIMESTAMP)
+class LRUCacheBackend:
+    """Кэш в памяти процесса с TTL и вытеснением по LRU."""
 
-2. **APIKeys**
-   - **id** (PK)
-   - **user_id** (FK to Users)
-   - **key** (VARCHAR) - сам API ключ
-   - **secret_key** (VARCHAR) - секретный ключ для HMAC
-   - **typeid_id** (FK to TypeIDs)
-   - **created_at** (TIMESTAMP)
-   - **updated_at** (TIMESTAMP)
-   - **status** (ENUM: 'active', 'inactive') - статус ключа
-   - **tokens_remaining (INTEGER) - количество оставшихся токенов.
-   - **token_limit (INTEGER) - лимит токенов, обновляемый через систему биллинга или административный интерфейс.
-   - **llm_api_key (VARCHAR) - API ключ, используемый для взаимодействия с сервисами LLM.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, tag, value)
+        self._tags = {}             # tag -> set(key)
+        self._lock = threading.Lock()
 
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, _, value = item
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
 
-3. **TypeIDs**
-   - **id** (PK)
+    def set(self, key, value, ttl, tag=None):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, tag, value)
+            self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.max_entries:
+                self._remove(next(iter(self._data)))
+
+    def delete_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        _, tag, _ = self._data.pop(key)
+        keys = self._tags[tag]
+        keys.discard(key)
+        if not keys:
+            del self._tags[tag]
+
+
+class RedisCacheBackend:
+    """Кэш в Redis, общий для всех воркеров. Размер ограничивается maxmemory с политикой allkeys-lru."""
+
+    def __init__(self, url, prefix='compare:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl, tag=None):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, value, ex=ttl)
+        if tag is not None:
+            tag_key = f"{self.prefix}tag:{tag}"
+            pipe.sadd(tag_key, key)
+            pipe.expire(tag_key, ttl)
+        pipe.execute()
+
+    def delete_tag(self, tag):
+        tag_key = f"{self.prefix}tag:{tag}"
+        keys = [self.prefix + key.decode('utf-8') for key in self.client.smembers(tag_key)]
+        self.client.delete(tag_key, *keys)
+
+
+class ComparisonCache:
+    """Кэш отчётов compare_texts_llm со счётчиками попаданий и промахов."""
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(reference, compare_text, typeid):
+        digest = hashlib.sha256()
+        # Эталон представлен готовым хэшем из ReferencePrompt, повторно не хэшируется
+        parts = (
+            reference.digest, compare_text, typeid.system, typeid.user, typeid.model, typeid.llm,
+            typeid.chunking, str(typeid.chunk_tokens), typeid.merge_prompt,
+        )
+        for part in parts:
+            data = part.encode('utf-8')
+            # Длина перед каждой частью исключает совпадение ключей при разной разбивке строк
+            digest.update(len(data).to_bytes(8, 'big'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, report, typeid):
+        self.backend.set(key, report, self.ttl, tag=f"typeid:{typeid.pk}")
+
+    def invalidate_typeid(self, typeid_pk):
+        self.backend.delete_tag(f"typeid:{typeid_pk}")
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+
+_comparison_cache = None
+_comparison_cache_lock = threading.Lock()
+
+def get_comparison_cache():
+    """Возвращает общий для процесса экземпляр кэша, созданный по настройкам COMPARE_CACHE."""
+    global _comparison_cache
+    if _comparison_cache is None:
+        with _comparison_cache_lock:
+            if _comparison_cache is None:
+                config = getattr(settings, 'COMPARE_CACHE', {})
+                if config.get('BACKEND', 'lru') == 'redis':
+                    backend = RedisCacheBackend(config['REDIS_URL'])
+                else:
+                    backend = LRUCacheBackend(config.get('MAX_ENTRIES', 10000))
+                _comparison_cache = ComparisonCache(backend, config.get('TTL', 60 * 60 * 24))
+    return _comparison_cache
+```
+
+##### Статистика кэша:
+```python
+from django.http import JsonResponse
+from django.views import View
+
+class CacheStatsView(View):
+    def get(self, request):
+        if not request.user.is_staff:
+            return JsonResponse({'error': 'Forbidden'}, status=403)
+        return JsonResponse(get_comparison_cache().stats())
+```
+
+### 7. Асинхронное сравнение текстов
+
+#### Бизнес требования:
+- **Неблокирующие запросы**: Извлечение текста и запрос к LLM занимают 10–60 секунд. Синхронная обработка удерживает воркер Django на всё это время, и несколько медленных провайдеров исчерпывают пул gunicorn. Клиент должен иметь возможность получить ID задачи сразу, не дожидаясь отчёта.
+- **Ограниченный пул воркеров**: Извлечение текста и `compare_texts_llm` выполняются в пуле потоков фиксированного размера, а не в потоке обработки HTTP запроса.
+- **Получение результата**: Клиент опрашивает `GET /api/v1/jobs/{job_id}` или передаёт `callback_url`, на который сервер отправит отчёт после завершения задачи.
+- **Ограничение параллельности на ключ**: Количество незавершённых задач одного API ключа ограничено. При превышении лимита возвращается 429.
+- **Восстановление после перезапуска**: Пул воркеров живёт в процессе Django, поэтому задачи, прерванные перезапуском, не должны навсегда оставаться `queued`/`running` и занимать лимит ключа.
+- **Безопасность callback**: Сервер не должен отправлять запросы во внутреннюю сеть по адресу, переданному клиентом.
+
+#### Описание работы функций:
+1. **Постановка задачи**:
+   - `POST /api/v1/compare/{reference_id}?async=1` проверяет ключ и эталонный текст, сохраняет файл и создаёт запись `CompareJob` со статусом `queued`. Ответ `202 Accepted` содержит `job_id`.
+   - Проверка лимита и создание задачи выполняются в транзакции с блокировкой строки API ключа, чтобы параллельные запросы не превысили лимит.
+   - В той же транзакции задачи ключа, которые ждут в очереди или выполняются дольше `COMPARE_JOB_STALE_AFTER`, переводятся в `failed`: такие задачи прерваны перезапуском процесса и больше не выполняются. Для `queued` время отсчитывается от постановки (`created_at`), для `running` — от запуска (`started_at`). Их файлы удаляются после фиксации транзакции.
+   - `callback_url` проверяется до создания задачи, при недопустимом адресе возвращается 400.
+2. **Выполнение задачи**:
+   - Воркер переводит задачу в `running`, извлекает текст, вызывает `compare_texts_llm` и сохраняет отчёт со статусом `done` или ошибку со статусом `failed`.
+   - Результат сохраняется условным `UPDATE ... WHERE status = 'running'`. Если задача за время выполнения уже признана прерванной, её статус `failed` не перезаписывается и callback не отправляется.
+   - Загруженный файл удаляется после завершения задачи при любом исходе.
+3. **Уведомление**:
+   - Если указан `callback_url`, после завершения задачи на него отправляется POST с тем же JSON, что возвращает `GET /api/v1/jobs/{job_id}`. Ошибка доставки не меняет статус задачи.
+   - Допускается только схема `https`. Если задан `COMPARE_JOB_CALLBACK_HOSTS`, хост должен входить в этот список; иначе все адреса, в которые разрешается хост, должны быть публичными (не частными, не loopback, не link-local, не зарезервированными). Проверка повторяется непосредственно перед отправкой, перенаправления не выполняются.
+
+#### Настройки:
+```python
+COMPARE_JOB_WORKERS = 8               # размер пула воркеров в каждом процессе
+COMPARE_JOB_MAX_PER_KEY = 4           # незавершённых задач на один API ключ
+COMPARE_JOB_CALLBACK_TIMEOUT = 10     # таймаут отправки callback, секунды
+COMPARE_JOB_STALE_AFTER = 60 * 60     # секунды в очереди или выполнения, после которых задача считается прерванной;
+                                      # должно превышать наибольшее время сравнения, в том числе по фрагментам
+COMPARE_JOB_CALLBACK_HOSTS = []       # разрешённые хосты callback; пустой список — любые публичные адреса
+```
+
+#### Пример реализации:
+```python
+import uuid
+
+from django.db import models
+
+class CompareJob(models.Model):
+    STATUS_CHOICES = [('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    api_key = models.ForeignKey('APIKey', on_delete=models.CASCADE)
+    reference = models.ForeignKey('Text', on_delete=models.CASCADE)
+    file_path = models.CharField(max_length=1024)
+    callback_url = models.URLField(max_length=1024, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    report = models.TextField(null=True, blank=True)
+    local_score = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['api_key', 'status'])]
+
+    def as_dict(self):
+        return {
+            'job_id': str(self.id),
+            'status': self.status,
+            'report': self.report,
+            'local_score': self.local_score,
+            'error': self.error,
+        }
+```
+
+##### Пул воркеров и выполнение задач:
+```python
+import ipaddress
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+
+from .models import APIKey, CompareJob
+
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'COMPARE_JOB_WORKERS', 8),
+    thread_name_prefix='compare-job',
+)
+
+class InvalidCallbackURL(ValueError):
+    pass
+
+def validate_callback_url(url):
+    """Проверка callback_url: только https и только разрешённые или публичные адреса."""
+    parts = urlsplit(url)
+    if parts.scheme != 'https' or not parts.hostname:
+        raise InvalidCallbackURL('callback_url must be an https URL.')
+    allowed_hosts = getattr(settings, 'COMPARE_JOB_CALLBACK_HOSTS', [])
+    if allowed_hosts:
+        if parts.hostname not in allowed_hosts:
+            raise InvalidCallbackURL('callback_url host is not allowed.')
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, parts.port or 443, type=socket.SOCK_STREAM)}
+    except (socket.gaierror, UnicodeError):
+        raise InvalidCallbackURL('callback_url host cannot be resolved.')
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        # Адреса внутренней сети, loopback и метаданные облака (169.254.0.0/16) недоступны для callback
+        if not ip.is_global or ip.is_multicast:
+            raise InvalidCallbackURL('callback_url must resolve to a public address.')
+
+def discard_upload(path):
+    """Удаление временного файла загрузки."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def submit_compare_job(api_key_obj, reference_text, file_path, callback_url=None):
+    """Создание задачи сравнения и отправка её в пул воркеров."""
+    if callback_url:
+        try:
+            validate_callback_url(callback_url)
+        except InvalidCallbackURL as e:
+            discard_upload(file_path)
+            return JsonResponse({'error': str(e)}, status=400)
+
+    max_per_key = getattr(settings, 'COMPARE_JOB_MAX_PER_KEY', 4)
+    stale_before = timezone.now() - timedelta(seconds=getattr(settings, 'COMPARE_JOB_STALE_AFTER', 60 * 60))
+    with transaction.atomic():
+        # Блокировка строки ключа сериализует проверку лимита для параллельных запросов
+        APIKey.objects.select_for_update().get(pk=api_key_obj.pk)
+        # Задачи, прерванные перезапуском процесса, больше не выполняются и не должны занимать лимит.
+        # Выполняемая задача считается прерванной по времени запуска, а не постановки в очередь
+        stale_jobs = CompareJob.objects.filter(
+            Q(status='queued', created_at__lt=stale_before) | Q(status='running', started_at__lt=stale_before),
+            api_key=api_key_obj,
+        )
+        stale_paths = list(stale_jobs.values_list('file_path', flat=True))
+        if stale_paths:
+            stale_jobs.update(status='failed', error='Job was interrupted.', finished_at=timezone.now())
+            transaction.on_commit(lambda: [discard_upload(path) for path in stale_paths])
+        active_jobs = CompareJob.objects.filter(api_key=api_key_obj, status__in=ACTIVE_JOB_STATUSES).count()
+        if active_jobs >= max_per_key:
+            discard_upload(file_path)
+            return JsonResponse({'error': 'Too many concurrent compare jobs for this API key.'}, status=429)
+        job = CompareJob.objects.create(
+            api_key=api_key_obj,
+            reference=reference_text,
+            file_path=file_path,
+            callback_url=callback_url,
+        )
+    # Задача отправляется в пул только после фиксации транзакции, иначе воркер может её не найти
+    transaction.on_commit(lambda: _executor.submit(run_compare_job, job.id))
+    return JsonResponse({'job_id': str(job.id), 'status': job.status}, status=202)
+
+def run_compare_job(job_id):
+    """Выполнение задачи сравнения в потоке пула."""
+    close_old_connections()
+    try:
+        # Задача, уже признанная прерванной при постановке новых задач ключа, не выполняется
+        started = CompareJob.objects.filter(pk=job_id, status='queued').update(
+            status='running', started_at=timezone.now(),
+        )
+        if not started:
+            return
+        job = CompareJob.objects.select_related('api_key__typeid').get(pk=job_id)
+        try:
+            compare_text = decode_file(job.file_path)
+            reference = get_reference_prompt(job.reference_id, job.api_key.typeid)
+            job.report, local_score = compare_with_prefilter(reference, compare_text, job.api_key.typeid, job.api_key)
+            job.local_score = local_score.as_dict()
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            discard_upload(job.file_path)
+        job.finished_at = timezone.now()
+        # Задача, признанная прерванной за время выполнения, остаётся failed: её результат не сохраняется
+        saved = CompareJob.objects.filter(pk=job.pk, status='running').update(
+            status=job.status, report=job.report, local_score=job.local_score,
+            error=job.error, finished_at=job.finished_at,
+        )
+        if saved and job.callback_url:
+            notify_job_callback(job)
+    finally:
+        close_old_connections()
+
+def notify_job_callback(job):
+    """Отправка результата задачи на callback_url клиента."""
+    try:
+        # Адрес проверяется повторно: DNS запись хоста могла измениться после постановки задачи
+        validate_callback_url(job.callback_url)
+        requests.post(
+            job.callback_url,
+            json=job.as_dict(),
+            timeout=getattr(settings, 'COMPARE_JOB_CALLBACK_TIMEOUT', 10),
+            allow_redirects=False,
+        )
+    except (InvalidCallbackURL, requests.RequestException):
+        # Клиент всегда может получить результат через GET /api/v1/jobs/{job_id}
+        pass
+```
+
+##### Получение статуса задачи:
+```python
+class JobStatusView(View):
+    def get(self, request, job_id):
+        try:
+            api_key_id = verify_token(request)['key_id']
+        except TokenError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        try:
+            job = CompareJob.objects.get(id=job_id, api_key_id=api_key_id)
+        except CompareJob.DoesNotExist:
+            return JsonResponse({'error': 'Job not found'}, status=404)
+        return JsonResponse(job.as_dict(), status=200)
+```
+
+### 8. Пакетное сравнение текстов
+
+#### Бизнес требования:
+- **Один эталон — много документов**: Основной сценарий — проверка десятков и сотен работ против одного эталонного текста, загруженного через `UploadReferenceTextView`. Вместо N отдельных HTTP запросов (N декодирований JWT, N поисков APIKey и Text, N последовательных вызовов провайдера) используется один запрос `POST /api/v1/compare/{reference_id}/batch`.
+- **Форматы загрузки**: Запрос принимает несколько файлов в поле `files` или один zip архив в поле `archive`. Количество и суммарный размер документов ограничены настройками.
+- **Однократная загрузка контекста**: JWT, API ключ, эталонный текст и TypeID загружаются один раз на весь пакет.
+- **Параллельные запросы к провайдеру**: Документы обрабатываются в пуле потоков с ограниченной параллельностью.
+- **Потоковая выдача результатов**: Результат по каждому документу отправляется клиенту отдельной строкой NDJSON сразу после его готовности, не дожидаясь всего пакета.
+- **Резервирование токенов**: Оценка расхода токенов на весь пакет списывается одной операцией до начала обработки. Если токенов недостаточно, запрос отклоняется с 429 до запуска сравнений. После завершения пакета резерв корректируется по фактическому расходу провайдера: документы из кэша, завершившиеся ошибкой или не обработанные из-за разрыва соединения не оплачиваются.
+
+#### Описание работы функций:
+1. **Приём пакета**:
+   - Сервер сохраняет загруженные файлы (или распаковывает архив) и проверяет лимиты на количество и размер.
+   - Размеры из заголовков архива используются только для раннего отказа: члены архива распаковываются потоково, и лимит суммарного размера проверяется по фактически распакованным байтам, поэтому zip бомба не попадает ни в память, ни на диск целиком.
+   - Временные файлы удаляются при любом отказе (превышение лимитов, повреждённый архив, нехватка токенов) и после завершения потока результатов, в том числе если клиент отключился до чтения первой строки.
+2. **Обработка документов**:
+   - Для каждого документа извлекается текст, выполняется локальная оценка сходства (раздел 13), проверяется кэш результатов (раздел 6) и при промахе вызывается `request_llm_report`.
+3. **Формат ответа**:
+   - `Content-Type: application/x-ndjson`, по одной строке на документ в порядке завершения:
+     - `{"file": "work_01.docx", "report": "...", "cached": false, "local_score": {"shingle_similarity": 0.42, "word_similarity": 0.81, "verdict": null}}`
+     - `{"file": "work_02.pdf", "error": "..."}`
+
+#### Настройки:
+```python
+COMPARE_BATCH_CONCURRENCY = 8                   # параллельных запросов к провайдеру на один пакет
+COMPARE_BATCH_MAX_FILES = 500                   # документов в одном пакете
+COMPARE_BATCH_MAX_BYTES = 200 * 1024 * 1024     # суммарный размер документов (в том числе после распаковки архива)
+```
+
+#### Пример реализации:
+```python
+import json
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+
+from .models import APIKey, Text
+
+
+BATCH_COPY_CHUNK = 64 * 1024
+
+
+class BatchTooLarge(Exception):
+    pass
+
+
+def collect_batch_documents(request):
+    """Сохранение документов пакета на диск. Возвращает список пар (имя файла, путь)."""
+    max_files = getattr(settings, 'COMPARE_BATCH_MAX_FILES', 500)
+    max_bytes = getattr(settings, 'COMPARE_BATCH_MAX_BYTES', 200 * 1024 * 1024)
+
+    archive = request.FILES.get('archive')
+    if archive is None:
+        files = request.FILES.getlist('files')
+        if len(files) > max_files or sum(f.size for f in files) > max_bytes:
+            raise BatchTooLarge()
+        documents = []
+        try:
+            for f in files:
+                documents.append((f.name, handle_file_upload(f)))
+        except BaseException:
+            discard_documents(documents)
+            raise
+        return documents
+
+    documents = []
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            members = [m for m in zf.infolist() if not m.is_dir()]
+            # Заголовки архива дают только ранний отказ: file_size задаёт сам клиент
+            if len(members) > max_files or sum(m.file_size for m in members) > max_bytes:
+                raise BatchTooLarge()
+            remaining = max_bytes
+            for member in members:
+                name = os.path.basename(member.filename)
+                # Расширение сохраняется, по нему decode_file определяет формат
+                fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+                documents.append((name, path))
+                with os.fdopen(fd, 'wb') as out, zf.open(member) as src:
+                    # Член архива распаковывается блоками, лимит проверяется по фактически распакованным байтам
+                    while chunk := src.read(BATCH_COPY_CHUNK):
+                        remaining -= len(chunk)
+                        if remaining < 0:
+                            raise BatchTooLarge()
+                        out.write(chunk)
+    except BaseException:
+        discard_documents(documents)
+        raise
+    return documents
+
+
+def discard_documents(documents):
+    """Удаление временных файлов документов пакета."""
+    for _, path in documents:
+        discard_upload(path)
+
+
+class BatchCompareTextView(View):
+    def post(self, request, reference_id):
+        try:
+            claims = verify_token(request)
+        except TokenError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+        api_key_obj = resolve_api_key(request, claims['api_key'])
+        if api_key_obj is None:
+            return JsonResponse({'error': 'Reference text or API key not found'}, status=404)
+        try:
+            reference_text = Text.objects.only('id', 'api_key').get(id=reference_id, api_key=api_key_obj)
+        except Text.DoesNotExist:
+            return JsonResponse({'error': 'Reference text or API key not found'}, status=404)
+
+        try:
+            documents = collect_batch_documents(request)
+        except BatchTooLarge:
+            return JsonResponse({'error': 'Batch exceeds the allowed number of files or total size.'}, status=413)
+        except zipfile.BadZipFile:
+            return JsonResponse({'error': 'Invalid zip archive.'}, status=400)
+        if not documents:
+            return JsonResponse({'error': 'No files provided.'}, status=400)
+
+        # Резервирование токенов на весь пакет до начала сравнений
+        reference = get_reference_prompt(reference_text.id, api_key_obj.typeid)
+        reserved = estimate_batch_tokens(reference, api_key_obj.typeid, documents)
+        if not update_token_usage(api_key_obj.key, cost=reserved):
+            discard_documents(documents)
+            return JsonResponse({'error': 'Insufficient tokens available.'}, status=429)
+
+        # Django вызывает close() у потока при завершении ответа, даже если клиент не прочитал ни одной строки
+        stream = BatchResultStream(api_key_obj, reference, documents, reserved)
+        return StreamingHttpResponse(stream, content_type='application/x-ndjson')
+
+
+def estimate_batch_tokens(reference, typeid, documents):
+    """Оценка расхода токенов на пакет до извлечения текста документов."""
+    # Текст документа ещё не извлечён, вместо него оценка берётся по размеру файла
+    return sum(
+        estimate_request_tokens(reference, '', typeid) + os.path.getsize(path) // 4
+        for _, path in documents
+    )
+
+
+class BatchResultStream:
+    """Поток строк NDJSON в порядке завершения сравнений.
+
+    Резерв токенов корректируется и временные файлы удаляются ровно один раз: по завершении
+    итерации или в close(), который Django вызывает и для ответа, не прочитанного клиентом.
+    """
+
+    def __init__(self, api_key_obj, reference, documents, reserved):
+        self.api_key_obj = api_key_obj
+        self.reference = reference
+        self.documents = documents
+        self.reserved = reserved
+        # Расход учитывается отдельно на каждый документ, в том числе для завершившихся ошибкой
+        self.usages = [LLMUsage() for _ in documents]
+        self._executor = None
+        self._finished = False
+        self._results = self._iter_results()
+
+    def __iter__(self):
+        return self._results
+
+    def close(self):
+        # Закрытие начатого генератора выполняет его finally; не начатый генератор finally не выполняет
+        self._results.close()
+        self._finish()
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        if self._executor is not None:
+            # При разрыве соединения ожидающие задачи отменяются, уже выполняемые дожидаются завершения
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        # Оплачиваются только реальные обращения к провайдеру, включая не отправленные клиенту до разрыва
+        total_usage = LLMUsage()
+        for usage in self.usages:
+            total_usage.add(usage)
+        settle_token_usage(self.api_key_obj.key, self.reserved, total_usage)
+        discard_documents(self.documents)
+
+    def _iter_results(self):
+        self._executor = ThreadPoolExecutor(max_workers=getattr(settings, 'COMPARE_BATCH_CONCURRENCY', 8))
+        futures = {
+            self._executor.submit(self._compare_one, path, usage): name
+            for (name, path), usage in zip(self.documents, self.usages)
+        }
+        try:
+            for future in as_completed(futures):
+                try:
+                    report, cached, score = future.result()
+                except Exception as e:
+                    line = {'file': futures[future], 'error': str(e)}
+                else:
+                    line = {'file': futures[future], 'report': report, 'cached': cached, 'local_score': score.as_dict()}
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+        finally:
+            self._finish()
+
+    def _compare_one(self, compare_path, usage):
+        api_key_obj, reference = self.api_key_obj, self.reference
+        typeid = api_key_obj.typeid
+        cache = get_comparison_cache()
+        started = time.monotonic()
+        compare_text = decode_file(compare_path)
+        score = local_similarity(reference.signature, compare_text)
+        report = prefilter_report(score, typeid)
+        if report is not None:
+            log_comparison(api_key_obj, started, verdict=score.verdict)
+            return report, False, score
+        cache_key = cache.make_key(reference, compare_text, typeid)
+        report = cache.get(cache_key)
+        if report is not None:
+            log_comparison(api_key_obj, started, cache_hit=True)
+            return report, True, score
+        try:
+            report = run_comparison(reference, compare_text, typeid, api_key_obj.llm_api_key, usage)
+        except Exception as e:
+            log_comparison(api_key_obj, started, usage, error=type(e).__name__)
+            raise
+        log_comparison(api_key_obj, started, usage)
+        if not usage.fallback_used:
+            cache.set(cache_key, report, typeid)
+        return report, False, score
+```
+
+### 9. Потоковое извлечение текста из документов
+
+#### Бизнес требования:
+- **Ограниченное потребление памяти**: `textract.process` запускает внешний процесс и возвращает весь текст одной строкой; для PDF на 200 страниц в памяти одновременно находятся несколько полных копий документа, а загрузка в Base64 добавляет ещё одну. Извлечение текста не должно держать в памяти больше одной страницы исходного документа сверх собираемого результата.
+- **Без внешних процессов**: Форматы .txt, .docx и .pdf обрабатываются нативными Python парсерами в процессе приложения. Прочие форматы по-прежнему обрабатываются через textract.
+- **Постраничная выдача**: Извлечение реализовано генератором, который возвращает текст страница за страницей.
+- **Потоковое декодирование Base64**: Тело запроса в Base64 декодируется частями во временный файл (`SpooledTemporaryFile`), который остаётся в памяти только до заданного размера.
+- **Жёсткие ограничения**: Число страниц, размер файла, объём извлечённого текста и время извлечения ограничены. При превышении возвращается 413, при повреждённом файле или неверном Base64 — 400.
+- **Измеримость**: Прилагается микро-бенчмарк, сравнивающий пиковое потребление памяти (RSS) и время извлечения с textract.
+
+#### Описание работы функций:
+1. **Приём файла**:
+   - `receive_upload` возвращает загруженный multipart файл или результат `spool_base64_upload` для тела в Base64. Размер декодированных данных проверяется по мере декодирования.
+2. **Извлечение текста**:
+   - `iter_document_pages` выбирает парсер по расширению файла и возвращает генератор страниц:
+     - `.txt` — блоки текста фиксированного размера с инкрементальным декодированием UTF-8;
+     - `.pdf` — страницы `pypdf`, каждая страница разбирается только при обращении к ней;
+     - `.docx` — абзацы `python-docx`, сгруппированные по разрывам страниц.
+   - Генератор проверяет ограничения после каждой страницы. Время проверяется между страницами, поэтому одна очень тяжёлая страница может ненадолго превысить лимит.
+   - Любая ошибка разбора повреждённого файла (не zip архив или обрезанный .docx, нарушенная структура PDF) возвращается как `ExtractionError` с кодом 400, а не как 500.
+3. **Сборка результата**:
+   - `decode_file` собирает страницы в одну строку для передачи в `compare_texts_llm`.
+
+#### Настройки:
+```python
+EXTRACTION_MAX_BYTES = 50 * 1024 * 1024        # размер исходного файла
+EXTRACTION_MAX_PAGES = 1000                    # страниц в документе
+EXTRACTION_MAX_CHARS = 5 * 1024 * 1024         # символов извлечённого текста
+EXTRACTION_MAX_SECONDS = 30                    # время извлечения
+EXTRACTION_SPOOL_MEMORY = 1024 * 1024          # порог, после которого Base64 загрузка сбрасывается на диск
+```
+
+#### Пример реализации:
+```python
+# api/extraction.py
+import base64
+import binascii
+import codecs
+import os
+import tempfile
+import time
+import zipfile
+
+from django.conf import settings
+
+from .metrics import timed
+
+TXT_PAGE_BYTES = 64 * 1024
+BASE64_READ_CHUNK = 64 * 1024
+
+
+class ExtractionError(Exception):
+    """Документ не удалось прочитать."""
+    status = 400
+
+
+class ExtractionLimitExceeded(ExtractionError):
+    """Документ превышает ограничения на размер, число страниц или время извлечения."""
+    status = 413
+
+
+class ExtractionLimits:
+    def __init__(self, max_bytes=50 * 1024 * 1024, max_pages=1000, max_chars=5 * 1024 * 1024,
+                 max_seconds=30, spool_memory=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.max_chars = max_chars
+        self.max_seconds = max_seconds
+        self.spool_memory = spool_memory
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_bytes=getattr(settings, 'EXTRACTION_MAX_BYTES', 50 * 1024 * 1024),
+            max_pages=getattr(settings, 'EXTRACTION_MAX_PAGES', 1000),
+            max_chars=getattr(settings, 'EXTRACTION_MAX_CHARS', 5 * 1024 * 1024),
+            max_seconds=getattr(settings, 'EXTRACTION_MAX_SECONDS', 30),
+            spool_memory=getattr(settings, 'EXTRACTION_SPOOL_MEMORY', 1024 * 1024),
+        )
+
+
+def spool_base64_upload(stream, max_bytes, spool_memory=None):
+    """Декодирование Base64 из потока частями во временный файл."""
+    if spool_memory is None:
+        spool_memory = getattr(settings, 'EXTRACTION_SPOOL_MEMORY', 1024 * 1024)
+    spooled = tempfile.SpooledTemporaryFile(max_size=spool_memory)
+    pending = b''
+    written = 0
+    try:
+        while True:
+            chunk = stream.read(BASE64_READ_CHUNK)
+            if not chunk:
+                break
+            pending += b''.join(chunk.split())  # переводы строк допустимы в Base64
+            # Декодируется только часть, кратная 4 символам, остаток ждёт следующего блока
+            usable = len(pending) - len(pending) % 4
+            data = base64.b64decode(pending[:usable], validate=True)
+            pending = pending[usable:]
+            written += len(data)
+            if written > max_bytes:
+                raise ExtractionLimitExceeded('File exceeds the maximum allowed size.')
+            spooled.write(data)
+        if pending:
+            raise ExtractionError('Invalid base64 payload.')
+    except binascii.Error:
+        spooled.close()
+        raise ExtractionError('Invalid base64 payload.')
+    except ExtractionError:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled
+
+
+def _iter_txt_pages(fileobj):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        chunk = fileobj.read(TXT_PAGE_BYTES)
+        if not chunk:
+            break
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def _iter_pdf_pages(fileobj):
+    from pypdf import PdfReader
+    from pypdf.errors import PdfReadError
+
+    try:
+        reader = PdfReader(fileobj)
+        for page in reader.pages:
+            yield page.extract_text() or ''
+    except PdfReadError as e:
+        raise ExtractionError(f'Invalid PDF file: {e}')
+    except Exception:
+        # На повреждённой структуре pypdf может выбросить и ValueError, KeyError, TypeError и т.п.
+        raise ExtractionError('Invalid PDF file.')
+
+
+def _iter_docx_pages(fileobj):
+    import docx
+    from docx.opc.exceptions import PackageNotFoundError
+    from lxml.etree import XMLSyntaxError
+
+    try:
+        document = docx.Document(fileobj)
+    except (PackageNotFoundError, zipfile.BadZipFile, KeyError, ValueError, XMLSyntaxError):
+        # Не zip архив, обрезанный архив или архив без частей документа
+        raise ExtractionError('Invalid DOCX file.')
+    page = []
+    for paragraph in document.paragraphs:
+        page.append(paragraph.text)
+        if paragraph.contains_page_break:
+            yield '\n'.join(page)
+            page = []
+    if page:
+        yield '\n'.join(page)
+
+
+def _iter_textract_pages(fileobj):
+    # Форматы без нативного парсера (.doc, .rtf, .odt и т.п.) обрабатываются textract во внешнем процессе
+    import textract
+
+    yield textract.process(fileobj.name).decode('utf-8')
+
+
+NATIVE_PARSERS = {
+    '.txt': _iter_txt_pages,
+    '.pdf': _iter_pdf_pages,
+    '.docx': _iter_docx_pages,
+}
+
+
+def iter_document_pages(fileobj, extension, limits):
+    """Генератор страниц текста документа с проверкой ограничений."""
+    fileobj.seek(0, os.SEEK_END)
+    if fileobj.tell() > limits.max_bytes:
+        raise ExtractionLimitExceeded('File exceeds the maximum allowed size.')
+    fileobj.seek(0)
+
+    parser = NATIVE_PARSERS.get(extension, _iter_textract_pages)
+    deadline = time.monotonic() + limits.max_seconds
+    pages = 0
+    chars = 0
+    for page in parser(fileobj):
+        pages += 1
+        chars += len(page)
+        if pages > limits.max_pages:
+            raise ExtractionLimitExceeded('Document exceeds the maximum number of pages.')
+        if chars > limits.max_chars:
+            raise ExtractionLimitExceeded('Extracted text exceeds the maximum allowed length.')
+        if time.monotonic() > deadline:
+            raise ExtractionLimitExceeded('Text extraction timed out.')
+        yield page
+
+
+@timed('decode_file')
+def decode_file(file_path, limits=None):
+    """Декодирование текста из файла, поддерживающее различные форматы."""
+    limits = limits or ExtractionLimits.from_settings()
+    extension = os.path.splitext(file_path)[1].lower()
+    with open(file_path, 'rb') as fileobj:
+        return '\n'.join(iter_document_pages(fileobj, extension, limits))
+```
+
+##### Микро-бенчмарк извлечения:
+Каждое измерение выполняется в отдельном процессе, так как `ru_maxrss` — пиковое значение за всё время жизни процесса. Для textract учитывается и RSS запущенных им дочерних процессов.
+```python
+"""Сравнение пикового RSS и времени извлечения текста: textract против нативных парсеров.
+
+Запуск: python bench_extraction.py samples/*.pdf samples/*.docx samples/*.txt
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+REPEATS = 5
+
+CHILD = """
+import json, resource, sys, time
+method, path = sys.argv[1], sys.argv[2]
+start = time.perf_counter()
+if method == 'textract':
+    import textract
+    text = textract.process(path).decode('utf-8')
+else:
+    from api.extraction import ExtractionLimits, decode_file
+    text = decode_file(path, ExtractionLimits(max_pages=10 ** 6, max_chars=10 ** 9, max_seconds=10 ** 6))
+elapsed = time.perf_counter() - start
+peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+print(json.dumps({'seconds': elapsed, 'peak_rss_kb': peak_kb, 'chars': len(text)}))
+"""
+
+def measure(method, path):
+    runs = []
+    for _ in range(REPEATS):
+        output = subprocess.run([sys.executable, '-c', CHILD, method, path], capture_output=True, check=True, text=True)
+        runs.append(json.loads(output.stdout))
+    return {
+        'median_seconds': statistics.median(run['seconds'] for run in runs),
+        'peak_rss_mb': max(run['peak_rss_kb'] for run in runs) / 1024,
+        'chars': runs[0]['chars'],
+    }
+
+if __name__ == '__main__':
+    print(f"{'file':40} {'method':10} {'median, s':>10} {'peak RSS, MB':>13} {'chars':>10}")
+    for path in sys.argv[1:]:
+        for method in ('textract', 'native'):
+            result = measure(method, path)
+            print(f"{path:40} {method:10} {result['median_seconds']:10.3f} {result['peak_rss_mb']:13.1f} {result['chars']:10}")
+```
+
+### 10. Кэширование промптов на стороне провайдера
+
+#### Бизнес требования:
+- **Снижение стоимости входных токенов**: При больших эталонах основную часть входных токенов и задержки составляет эталонный текст, который отправляется провайдеру заново при каждом сравнении. Повторяющаяся часть промпта должна обрабатываться кэшем провайдера.
+- **Стабильный префикс**: Промпт строится так, что эталонная часть (`typeid.system + reference_text`) идёт первой и побайтно совпадает между запросами. Изменяемая часть (`typeid.user + compare_text`) всегда идёт после неё.
+- **Использование механизмов провайдеров**:
+  - OpenAI кэширует совпадающий префикс автоматически (для промптов от 1024 токенов). Параметр `prompt_cache_key` с хэшем эталона направляет запросы с одним эталоном на один кэш.
+  - Для Gemini эталонная часть сохраняется как `CachedContent` с TTL, и запросы к этому эталону выполняются через модель, созданную из кэша.
+- **Учёт для биллинга**: Для каждого запроса сохраняется число входных токенов, из них закэшированных провайдером, и выходных токенов. Счётчики накапливаются в полях APIKey тем же `UPDATE`, которым корректируется резерв токенов (раздел 4).
+- **Тестирование**: Разметка промпта и учёт токенов проверяются на локальном mock провайдере без обращения к внешним API.
+
+#### Описание работы функций:
+1. **OpenAI**:
+   - Сообщение `system` содержит `reference.prefix`, сообщение `user` — `typeid.user + compare_text`. Число закэшированных токенов берётся из `usage.prompt_tokens_details.cached_tokens`.
+2. **Gemini**:
+   - `reference.prefix` передаётся как `system_instruction` и в обычном режиме, и при создании `CachedContent`, поэтому ответы не зависят от наличия кэша.
+   - `CachedContent` создаётся только для эталонов не короче `context_cache_min_tokens` (меньшие префиксы Gemini не кэширует). Имя кэша хранится в кэше процесса чуть меньше его TTL.
+   - Если кэш на стороне Gemini уже удалён, запрос повторяется без него, а запись о кэше удаляется.
+   - Число закэшированных токенов берётся из `usage_metadata.cached_content_token_count`.
+
+#### Пример реализации:
+Управление `CachedContent` и разметка промпта реализованы в адаптерах `OpenAIProvider` и `GeminiProvider` (раздел 11). Пороги кэширования задаются в настройках адаптера Gemini:
+```python
+LLM_PROVIDERS = {
+    'gemini': {
+        'context_cache_min_tokens': 4096,
+        'context_cache_ttl': 60 * 60,  # секунды
+    },
+}
+```
+
+##### Проверка на mock провайдере:
+```python
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+
+class FakeCompletions:
+    """Локальный провайдер OpenAI: запоминает запросы и считает совпадающий префикс закэшированным."""
+
+    def __init__(self):
+        self.requests = []
+
+    def create(self, model, messages, **kwargs):
+        prefix = messages[0]['content']
+        cached = len(prefix) // 4 if any(r['messages'][0]['content'] == prefix for r in self.requests) else 0
+        self.requests.append({'model': model, 'messages': messages, **kwargs})
+        usage = SimpleNamespace(
+            prompt_tokens=sum(len(m['content']) for m in messages) // 4,
+            completion_tokens=5,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+        )
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='report'))], usage=usage)
+
+
+class PromptCachingTest(SimpleTestCase):
+    def test_reference_prefix_is_stable_and_cached_tokens_reported(self):
+        completions = FakeCompletions()
+        provider = OpenAIProvider('sk-test', client=SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+        typeid = SimpleNamespace(system='Эталон: ', user='Работа: ', model='gpt-4o', llm='openai')
+        reference = ReferencePrompt(prefix='Эталон: ' + 'текст ' * 2000, prefix_tokens=3000, digest='a' * 64)
+
+        _, first = provider.complete(reference, 'первая работа', typeid)
+        _, second = provider.complete(reference, 'вторая работа', typeid)
+
+        first_messages, second_messages = (r['messages'] for r in completions.requests)
+        self.assertEqual(first_messages[0]['content'].encode(), second_messages[0]['content'].encode())
+        self.assertEqual(completions.requests[0]['prompt_cache_key'], completions.requests[1]['prompt_cache_key'])
+        self.assertEqual(first.cached_input_tokens, 0)
+        self.assertGreater(second.cached_input_tokens, 0)
+```
+
+### 11. Реестр провайдеров LLM
+
+#### Бизнес требования:
+- **Переиспользование клиентов**: Клиент SDK провайдера (`OpenAI()`, клиент Gemini) не должен создаваться на каждый запрос: это повторяет TLS рукопожатие и инициализацию клиента. Для каждой пары (провайдер, `llm_api_key`) создаётся один долгоживущий клиент с пулом соединений, при первом обращении, и используется всеми последующими запросами из всех потоков.
+- **Расширяемость**: Провайдеры регистрируются в реестре. Добавление провайдера (например, локального OpenAI-совместимого сервера для тестирования) не требует изменения представлений и `compare_texts_llm`: достаточно класса адаптера или записи в настройках.
+- **Настраиваемые таймауты**: Таймаут запроса и размер пула соединений задаются отдельно для каждого провайдера.
+- **Модель из TypeID**: Модель для любого провайдера берётся из `typeid.model`, без зашитых в код имён моделей.
+- **Ключ провайдера**: Клиент создаётся с `llm_api_key` API ключа пользователя. Если ключ не задан, используется ключ из переменных окружения.
+
+#### Описание работы функций:
+1. **Выбор адаптера**:
+   - `get_provider(typeid.llm, llm_api_key)` возвращает адаптер из реестра процесса или создаёт его. Класс адаптера берётся из `LLM_PROVIDERS[name]['class']`, а если он не задан — из зарегистрированных через `@register_provider`.
+   - Реестр ограничен `LLM_PROVIDER_CACHE_SIZE` адаптерами и вытесняет давно не использованные (LRU), поэтому число пулов соединений не растёт с числом `llm_api_key`. Вытесненный адаптер не закрывается явно: его ещё может использовать запрос в другом потоке, пул освобождается вместе с последней ссылкой.
+   - Для неизвестного провайдера возбуждается `LLMError("Unsupported LLM provider")`.
+2. **Адаптер**:
+   - `complete(reference, compare_text, typeid, timeout=None)` выполняет запрос и возвращает `(отчёт, LLMUsage)`. Адаптер не хранит состояния запроса и безопасен для использования из нескольких потоков.
+   - `LLMProvider` — абстрактный класс (`abc.ABC`), `complete` — абстрактный метод. Адаптер без `complete` не создаётся: ошибка возникает в `get_provider` при первом создании, а не в первом запросе к провайдеру.
+3. **Встроенные провайдеры**:
+   - `openai` — OpenAI SDK поверх `httpx.Client` с ограниченным пулом keep-alive соединений.
+   - `gemini` — клиент `google-genai` со своим ключом и таймаутом на каждый `llm_api_key`. Если `CachedContent` эталона создать не удалось (квота, слишком короткий префикс, ошибка 4xx/5xx), ошибка записывается в журнал, запрос выполняется без кэша, а повторная попытка создания откладывается на `CACHE_RETRY_AFTER` секунд.
+   - `local` — любой OpenAI-совместимый сервер (vLLM, llama.cpp, mock сервер), адрес задаётся в `base_url`.
+
+#### Настройки:
+```python
+LLM_PROVIDERS = {
+    'openai': {'timeout': 60, 'max_connections': 20},
+    'gemini': {'timeout': 60, 'context_cache_min_tokens': 4096, 'context_cache_ttl': 60 * 60},
+    'local': {'base_url': 'http://127.0.0.1:8080/v1', 'timeout': 30},
+    # Сторонний адаптер подключается без изменения кода:
+    # 'anthropic': {'class': 'integrations.llm.AnthropicProvider', 'timeout': 60},
+}
+LLM_PROVIDER_CACHE_SIZE = 256  # адаптеров (пар провайдер, llm_api_key) в реестре процесса
+```
+
+#### Пример реализации:
+```python
+import hashlib
+import itertools
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_provider_classes = {}
+_providers = OrderedDict()  # (провайдер, llm_api_key) -> адаптер, в порядке последнего использования
+_providers_lock = threading.Lock()
+
+
+def register_provider(name):
+    """Декоратор регистрации класса адаптера под именем провайдера из TypeID.llm."""
+    def decorator(cls):
+        _provider_classes[name] = cls
+        return cls
+    return decorator
+
+
+def get_provider(name, llm_api_key):
+    """Долгоживущий адаптер провайдера для пары (провайдер, llm_api_key), создаётся при первом обращении."""
+    key = (name, llm_api_key)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is not None:
+            _providers.move_to_end(key)
+            return provider
+        options = dict(getattr(settings, 'LLM_PROVIDERS', {}).get(name, {}))
+        class_path = options.pop('class', None)
+        provider_class = import_string(class_path) if class_path else _provider_classes.get(name)
+        if provider_class is None:
+            raise LLMError("Unsupported LLM provider")
+        provider = provider_class(llm_api_key, **options)
+        _providers[key] = provider
+        # Вытесняется давно не использованный адаптер; запросы, которые его уже получили, завершатся с ним
+        while len(_providers) > getattr(settings, 'LLM_PROVIDER_CACHE_SIZE', 256):
+            _providers.popitem(last=False)
+    return provider
+
+
+class LLMProvider(ABC):
+    """Базовый адаптер провайдера LLM. Один экземпляр на llm_api_key, используется из разных потоков."""
+
+    def __init__(self, api_key, timeout=60):
+        self.api_key = api_key
+        self.timeout = timeout
+
+    @abstractmethod
+    def complete(self, reference, compare_text, typeid, timeout=None):
+        """Возвращает пару (отчёт, LLMUsage); timeout — предел времени этой попытки в секундах."""
+
+    def stream(self, reference, compare_text, typeid, usage, timeout=None):
+        """Генератор фрагментов отчёта; расход добавляется в usage после последнего фрагмента (раздел 16).
+
+        Адаптеры без потокового API выдают отчёт одним фрагментом.
+        """
+        report, call_usage = self.complete(reference, compare_text, typeid, timeout=timeout)
+        yield report
+        usage.add(call_usage)
+
+
+@register_provider('openai')
+class OpenAIProvider(LLMProvider):
+    # Параметр кэша префикса поддерживается только API OpenAI
+    send_prompt_cache_key = True
+
+    def __init__(self, api_key, timeout=60, max_connections=20, base_url=None, client=None):
+        super().__init__(api_key, timeout)
+        if client is None:
+            import httpx
+            from openai import OpenAI
+
+            client = OpenAI(
+                api_key=api_key or None,
+                base_url=base_url,
+                timeout=timeout,
+                max_retries=0,  # повторы выполняет call_provider (раздел 15)
+                http_client=httpx.Client(
+                    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                ),
+            )
+        self.client = client
+
+    def _request(self, reference, compare_text, typeid, timeout):
+        extra = {}
+        if self.send_prompt_cache_key:
+            # Запросы с одним эталоном направляются на один и тот же кэш префикса
+            extra['prompt_cache_key'] = reference.digest[:64]
+        if timeout is not None:
+            extra['timeout'] = timeout
+        return dict(
+            model=typeid.model,
+            messages=[
+                {"role": "system", "content": reference.prefix},
+                {"role": "user", "content": typeid.user + compare_text}
+            ],
+            **extra,
+        )
+
+    @staticmethod
+    def _usage(usage):
+        details = usage.prompt_tokens_details
+        return LLMUsage(
+            input_tokens=usage.prompt_tokens,
+            cached_input_tokens=(details.cached_tokens or 0) if details else 0,
+            output_tokens=usage.completion_tokens,
+        )
+
+    def complete(self, reference, compare_text, typeid, timeout=None):
+        completion = self.client.chat.completions.create(**self._request(reference, compare_text, typeid, timeout))
+        return completion.choices[0].message.content, self._usage(completion.usage)
+
+    def stream(self, reference, compare_text, typeid, usage, timeout=None):
+        # Расход приходит последним событием потока с пустым списком choices
+        stream = self.client.chat.completions.create(
+            stream=True, stream_options={'include_usage': True},
+            **self._request(reference, compare_text, typeid, timeout),
+        )
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage.add(self._usage(chunk.usage))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # При разрыве соединения клиентом закрывается и соединение с провайдером, генерация прекращается
+            stream.close()
+
+
+@register_provider('local')
+class OpenAICompatibleProvider(OpenAIProvider):
+    """Локальный OpenAI-совместимый сервер (vLLM, llama.cpp, mock сервер для тестов)."""
+
+    send_prompt_cache_key = False
+
+    def __init__(self, api_key, base_url, timeout=30, max_connections=20, client=None):
+        # Локальные серверы обычно не проверяют ключ, но SDK требует непустое значение
+        super().__init__(api_key or 'local', timeout, max_connections, base_url, client)
+
+
+@register_provider('gemini')
+class GeminiProvider(LLMProvider):
+    CACHE_TTL_MARGIN = 60  # запись о кэше в процессе истекает раньше, чем кэш на стороне Gemini
+    CACHE_RETRY_AFTER = 5 * 60  # после неудачного создания CachedContent эталон идёт без кэша
+
+    def __init__(self, api_key, timeout=60, context_cache_min_tokens=4096, context_cache_ttl=60 * 60,
+                 base_url=None, client=None):
+        super().__init__(api_key, timeout)
+        if client is None:
+            from google import genai
+            from google.genai import types
+
+            # base_url — для mock сервера бенчмарков (раздел 20), по умолчанию API Google
+            http_options = types.HttpOptions(base_url=base_url, timeout=int(timeout * 1000))
+            client = genai.Client(api_key=api_key or None, http_options=http_options)
+        self.client = client
+        self.context_cache_min_tokens = context_cache_min_tokens
+        self.context_cache_ttl = context_cache_ttl
+        # CachedContent принадлежит проекту Google, поэтому ключ кэша учитывает llm_api_key
+        self._key_fingerprint = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _config(reference, cached_content, timeout):
+        from google.genai import types
+
+        http_options = types.HttpOptions(timeout=int(timeout * 1000)) if timeout is not None else None
+        if cached_content is not None:
+            return types.GenerateContentConfig(cached_content=cached_content, http_options=http_options)
+        return types.GenerateContentConfig(system_instruction=reference.prefix, http_options=http_options)
+
+    @staticmethod
+    def _usage(usage):
+        return LLMUsage(
+            input_tokens=usage.prompt_token_count or 0,
+            cached_input_tokens=usage.cached_content_token_count or 0,
+            output_tokens=usage.candidates_token_count or 0,
+        )
+
+    def _call_with_cache(self, call, reference, typeid, timeout):
+        """Вызов с CachedContent эталона; если кэш уже удалён на стороне Gemini, повтор без него."""
+        from google.genai import errors
+
+        cached_content = self._get_cached_content(reference, typeid)
+        if cached_content is not None:
+            try:
+                return call(self._config(reference, cached_content, timeout))
+            except errors.ClientError as e:
+                if e.code != 404:
+                    raise
+                # Кэш удалён или истёк раньше срока на стороне Gemini, запрос повторяется без него
+                reference_cache.delete(self._cache_key(reference, typeid))
+        return call(self._config(reference, None, timeout))
+
+    def complete(self, reference, compare_text, typeid, timeout=None):
+        request = f"{typeid.user}{compare_text}"
+        response = self._call_with_cache(
+            lambda config: self.client.models.generate_content(model=typeid.model, contents=request, config=config),
+            reference, typeid, timeout,
+        )
+        return response.text, self._usage(response.usage_metadata)
+
+    def stream(self, reference, compare_text, typeid, usage, timeout=None):
+        request = f"{typeid.user}{compare_text}"
+
+        def start(config):
+            # Ошибка запроса (в том числе 404 кэша) приходит при получении первого фрагмента
+            chunks = iter(self.client.models.generate_content_stream(model=typeid.model, contents=request, config=config))
+            first = next(chunks, None)
+            return chunks if first is None else itertools.chain([first], chunks)
+
+        metadata = None
+        for chunk in self._call_with_cache(start, reference, typeid, timeout):
+            # usage_metadata в каждом фрагменте накопительный, итог — в последнем
+            metadata = chunk.usage_metadata or metadata
+            if chunk.text:
+                yield chunk.text
+        if metadata is not None:
+            usage.add(self._usage(metadata))
+
+    def _cache_key(self, reference, typeid):
+        fingerprint = hashlib.sha256(f"{typeid.model}\0{typeid.system}".encode('utf-8')).hexdigest()[:16]
+        return f"gemini-cached-content:{self._key_fingerprint}:{fingerprint}:{reference.digest}"
+
+    def _get_cached_content(self, reference, typeid):
+        """Имя CachedContent для эталона; создаётся при первом обращении.
+
+        Кэш контекста — только оптимизация: при ошибке создания возвращается None и запрос идёт без кэша.
+        """
+        if reference.prefix_tokens < self.context_cache_min_tokens:
+            return None
+        from google.genai import errors, types
+
+        cache_key = self._cache_key(reference, typeid)
+        name = reference_cache.get(cache_key)
+        if name is None:
+            try:
+                cached_content = self.client.caches.create(
+                    model=typeid.model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"reference-{reference.digest[:16]}",
+                        system_instruction=reference.prefix,
+                        ttl=f"{self.context_cache_ttl}s",
+                    ),
+                )
+            except errors.APIError as e:
+                logger.warning("Gemini context cache was not created for %s: %s", typeid.model, e)
+                # Пустое имя запоминается, чтобы не повторять неудачное создание на каждом запросе
+                reference_cache.set(cache_key, '', self.CACHE_RETRY_AFTER)
+                return None
+            name = cached_content.name
+            reference_cache.set(cache_key, name, self.context_cache_ttl - self.CACHE_TTL_MARGIN)
+        return name or None
+```
+
+### 12. Сравнение больших документов по фрагментам
+
+#### Бизнес требования:
+- **Документы больше окна контекста**: Длинные договоры и диссертации не помещаются в окно контекста модели или приводят к очень медленным и дорогим одиночным запросам. Для таких TypeID сравнение выполняется по фрагментам (map-reduce).
+- **Настройка в TypeID**: Режим задаётся полем `chunking`:
+  - `none` — весь текст одним запросом (по умолчанию);
+  - `headings` — тексты делятся на разделы по заголовкам, разделы сопоставляются по названию;
+  - `paragraphs` — тексты делятся на абзацы, абзацы сопоставляются по содержимому.
+  Размер фрагмента ограничивается бюджетом `chunk_tokens`.
+- **Выровненные фрагменты**: Разделы или абзацы эталона и сравниваемого текста сопоставляются друг с другом. Вставленные, удалённые и изменённые части попадают в один фрагмент со своим контекстом.
+- **Параллельное сравнение**: Пары фрагментов сравниваются параллельно с ограничением числа одновременных запросов.
+- **Объединение отчётов**: Частичные отчёты объединяются в один. Если у TypeID задан `merge_prompt`, объединение выполняется отдельным запросом к той же модели, иначе отчёты склеиваются по порядку фрагментов.
+- **Кэш фрагментов**: Результат каждой пары фрагментов кэшируется (раздел 6). Границы фрагментов определяются содержимым, поэтому после правки одного раздела заново сравниваются только затронутые фрагменты.
+
+#### Описание работы функций:
+1. **Разбиение**:
+   - `headings`: новая единица начинается со строки-заголовка (`# ...`, `1.2 ...`, `Глава ...`, `Раздел ...`, `Статья ...`). Если заголовков нет, используется разбиение по абзацам.
+   - `paragraphs`: единицы разделяются пустыми строками.
+2. **Выравнивание**:
+   - Последовательности единиц сопоставляются `difflib.SequenceMatcher` по ключам (нормализованный заголовок раздела или текст абзаца). Совпадающие единицы образуют пары один к одному.
+   - Диапазоны вставок, удалений и замен делятся на пары пропорционально: в каждой паре не больше одной единицы с каждой стороны. Если правлен каждый абзац, ключи не совпадают ни разу и весь документ — одна замена; она делится на пары абзацев по порядку, а не отправляется одним фрагментом.
+   - Пара, которая сама больше бюджета (очень длинный раздел или абзац), делится на части по границам строк и слов, пропорционально длине эталонной и сравниваемой стороны.
+3. **Упаковка во фрагменты**:
+   - Размер пары и фрагмента оценивается как число символов обеих сторон, делённое на 4. Пара добавляется во фрагмент, только если он после этого не превысит `chunk_tokens`, иначе фрагмент закрывается до неё. Поэтому каждый фрагмент укладывается в бюджет.
+   - В режиме `headings` каждая пара разделов — отдельный фрагмент.
+   - В режиме `paragraphs` пары накапливаются во фрагмент до бюджета или до границы по содержимому: хэш абзаца эталона делится на `CHUNK_BOUNDARY_MODULUS` и фрагмент уже не меньше четверти бюджета. Правка абзаца меняет только фрагмент, в который он попал; следующие фрагменты выравниваются на той же границе.
+4. **Map**:
+   - Для каждого фрагмента строится `ReferencePrompt` (system + фрагмент эталона) и выполняется запрос через реестр провайдеров (раздел 11) с проверкой кэша результатов.
+5. **Reduce**:
+   - Отчёты фрагментов объединяются в исходном порядке. Расход токенов всех запросов суммируется и списывается одной корректировкой резерва.
+
+#### Настройки:
+```python
+COMPARE_CHUNK_CONCURRENCY = 4   # параллельных запросов к провайдеру на одно сравнение
+```
+
+#### Пример реализации:
+```python
+import difflib
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import models
+
+HEADING_RE = re.compile(
+    r'^\s*(#{1,6}\s+\S.*|\d+(\.\d+)*\.?\s+\S.*|(глава|раздел|статья|chapter|section)\s+\S.*)$',
+    re.IGNORECASE,
+)
+PARAGRAPH_SPLIT_RE = re.compile(r'\n\s*\n')
+CHUNK_BOUNDARY_MODULUS = 4
+
+
+class TypeID(models.Model):
+    CHUNKING_CHOICES = [('none', 'None'), ('headings', 'Headings'), ('paragraphs', 'Paragraphs')]
+
+    # ... scale, system, user, model, llm, description
+    chunking = models.CharField(max_length=10, choices=CHUNKING_CHOICES, default='none')
+    chunk_tokens = models.IntegerField(default=8000)
+    merge_prompt = models.TextField(blank=True, default='')
+
+
+class ChunkPair:
+    """Выровненная пара фрагментов эталона и сравниваемого текста."""
+
+    __slots__ = ('reference_text', 'compare_text')
+
+    def __init__(self, reference_text, compare_text):
+        self.reference_text = reference_text
+        self.compare_text = compare_text
+
+
+def _split_units(text, mode):
+    """Разбиение текста на единицы выравнивания: разделы по заголовкам или абзацы."""
+    if mode == 'headings':
+        units, current = [], []
+        for line in text.splitlines():
+            if HEADING_RE.match(line) and current:
+                units.append('\n'.join(current).strip())
+                current = []
+            current.append(line)
+        if current:
+            units.append('\n'.join(current).strip())
+        if len(units) > 1:
+            return units
+    return [paragraph.strip() for paragraph in PARAGRAPH_SPLIT_RE.split(text) if paragraph.strip()]
+
+
+def _unit_key(unit, mode):
+    # Разделы сопоставляются по заголовку, абзацы — по содержимому без учёта пробелов и регистра
+    if mode == 'headings':
+        unit = unit.split('\n', 1)[0]
+    return ' '.join(unit.split()).lower()
+
+
+def split_aligned_chunks(reference_text, compare_text, typeid):
+    """Разбиение обоих текстов на выровненные пары фрагментов, каждый не больше typeid.chunk_tokens."""
+    mode = typeid.chunking
+    char_budget = typeid.chunk_tokens * 4
+    reference_units = _split_units(reference_text, mode)
+    compare_units = _split_units(compare_text, mode)
+    matcher = difflib.SequenceMatcher(
+        a=[_unit_key(unit, mode) for unit in reference_units],
+        b=[_unit_key(unit, mode) for unit in compare_units],
+        autojunk=False,
+    )
+    pairs = []
+    for _, i1, i2, j1, j2 in matcher.get_opcodes():
+        for reference_group, compare_group in _pair_groups(reference_units[i1:i2], compare_units[j1:j2]):
+            pairs.extend(_fit_pair('\n\n'.join(reference_group), '\n\n'.join(compare_group), char_budget))
+    return _pack_chunks(pairs, char_budget, one_per_pair=(mode == 'headings'))
+
+
+def _pair_groups(reference_items, compare_items):
+    """Пропорциональное деление диапазонов на пары, в каждой не больше одного элемента с каждой стороны."""
+    n, m = len(reference_items), len(compare_items)
+    groups = max(n, m)
+    # Для equal (n == m) пары один к одному, для замены с правкой каждого абзаца — тоже по порядку
+    return [
+        (reference_items[k * n // groups:(k + 1) * n // groups], compare_items[k * m // groups:(k + 1) * m // groups])
+        for k in range(groups)
+    ]
+
+
+def _split_text(text, limit):
+    """Разбиение текста на части не длиннее limit символов, по возможности по строкам, иначе по словам."""
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind('\n', limit // 2, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def _fit_pair(reference_part, compare_part, char_budget):
+    """Пара, не помещающаяся в бюджет, делится на части пропорционально длине сторон."""
+    total = len(reference_part) + len(compare_part)
+    if total <= char_budget:
+        return [(reference_part, compare_part)]
+    reference_limit = max(char_budget * len(reference_part) // total, 1)
+    compare_limit = max(char_budget - reference_limit, 1)
+    return [
+        ('\n'.join(reference_piece), '\n'.join(compare_piece))
+        for reference_piece, compare_piece in _pair_groups(
+            _split_text(reference_part, reference_limit), _split_text(compare_part, compare_limit),
+        )
+    ]
+
+
+def _pack_chunks(pairs, char_budget, one_per_pair):
+    chunks = []
+    reference_parts, compare_parts, chars = [], [], 0
+    for reference_part, compare_part in pairs:
+        # Разделители '\n\n' между частями учитываются, чтобы оценка совпадала с итоговым фрагментом
+        added = len(reference_part) + len(compare_part) + (4 if reference_parts else 0)
+        if reference_parts and chars + added > char_budget:
+            chunks.append(ChunkPair('\n\n'.join(reference_parts), '\n\n'.join(compare_parts)))
+            reference_parts, compare_parts, chars = [], [], 0
+            added -= 4
+        reference_parts.append(reference_part)
+        compare_parts.append(compare_part)
+        chars += added
+        # Граница зависит от содержимого пары, а не от позиции в тексте, поэтому правка одного
+        # абзаца не сдвигает границы остальных фрагментов и их результаты остаются в кэше
+        content_boundary = int(hashlib.sha1(reference_part.encode('utf-8')).hexdigest()[:8], 16) % CHUNK_BOUNDARY_MODULUS == 0
+        if one_per_pair or (content_boundary and chars >= char_budget // 4):
+            chunks.append(ChunkPair('\n\n'.join(reference_parts), '\n\n'.join(compare_parts)))
+            reference_parts, compare_parts, chars = [], [], 0
+    if reference_parts:
+        chunks.append(ChunkPair('\n\n'.join(reference_parts), '\n\n'.join(compare_parts)))
+    return chunks
+
+
+def _chunk_reference_prompt(reference_text, typeid):
+    prefix = typeid.system + reference_text
+    return ReferencePrompt(
+        prefix=prefix,
+        prefix_tokens=count_tokens(prefix, typeid.model),
+        digest=hashlib.sha256(reference_text.encode('utf-8')).hexdigest(),
+        system_length=len(typeid.system),
+    )
+
+
+def compare_texts_chunked(reference, compare_text, typeid, llm_api_key, usage):
+    """Map-reduce сравнение: пары фрагментов параллельно, затем объединение отчётов."""
+    cache = get_comparison_cache()
+    chunks = split_aligned_chunks(reference.text, compare_text, typeid)
+
+    def compare_chunk(chunk):
+        chunk_reference = _chunk_reference_prompt(chunk.reference_text, typeid)
+        cache_key = cache.make_key(chunk_reference, chunk.compare_text, typeid)
+        report = cache.get(cache_key)
+        if report is not None:
+            return report, None
+        report, chunk_usage = request_llm_report(chunk_reference, chunk.compare_text, typeid, llm_api_key)
+        if not chunk_usage.fallback_used:
+            cache.set(cache_key, report, typeid)
+        return report, chunk_usage
+
+    with ThreadPoolExecutor(max_workers=getattr(settings, 'COMPARE_CHUNK_CONCURRENCY', 4)) as executor:
+        futures = [executor.submit(compare_chunk, chunk) for chunk in chunks]
+    # Расход учитывается по всем выполненным запросам, даже если какой-то фрагмент завершился ошибкой
+    reports, error = [], None
+    for future in futures:
+        try:
+            report, chunk_usage = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+        if chunk_usage is not None:
+            usage.add(chunk_usage)
+        reports.append(report)
+    if error is not None:
+        raise error if isinstance(error, (LLMError, RateLimited)) else LLMError(str(error))
+
+    if len(reports) == 1:
+        return reports[0]
+    if not typeid.merge_prompt:
+        return '\n\n'.join(f"[{number}/{len(reports)}]\n{report}" for number, report in enumerate(reports, 1))
+
+    # Шаг reduce: частичные отчёты передаются той же модели с промптом объединения
+    merge_typeid = SimpleNamespace(system='', user='', model=typeid.model, llm=typeid.llm)
+    merge_reference = ReferencePrompt(
+        prefix=typeid.merge_prompt,
+        prefix_tokens=count_tokens(typeid.merge_prompt, typeid.model),
+        digest=hashlib.sha256(typeid.merge_prompt.encode('utf-8')).hexdigest(),
+    )
+    merged, merge_usage = request_llm_report(merge_reference, '\n\n'.join(reports), merge_typeid, llm_api_key)
+    usage.add(merge_usage)
+    return merged
+```
+
+##### Тесты:
+```python
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+
+class SplitAlignedChunksTest(SimpleTestCase):
+    def typeid(self, chunking='paragraphs', chunk_tokens=200):
+        return SimpleNamespace(chunking=chunking, chunk_tokens=chunk_tokens)
+
+    def assertFitsBudget(self, chunks, typeid):
+        for chunk in chunks:
+            self.assertLessEqual((len(chunk.reference_text) + len(chunk.compare_text)) // 4, typeid.chunk_tokens)
+
+    def test_every_paragraph_edited(self):
+        paragraphs = [f"Абзац {number}: " + 'слово ' * 40 for number in range(60)]
+        reference = '\n\n'.join(paragraphs)
+        # Правка в каждом абзаце: ни один ключ выравнивания не совпадает, весь документ — одна замена
+        compare = '\n\n'.join(paragraph.replace('слово', 'слово,', 1) for paragraph in paragraphs)
+        typeid = self.typeid()
+        chunks = split_aligned_chunks(reference, compare, typeid)
+        self.assertGreater(len(chunks), 1)
+        self.assertFitsBudget(chunks, typeid)
+        # Абзацы остаются парами по порядку: первый абзац эталона идёт со своей правленой версией
+        self.assertTrue(chunks[0].reference_text.startswith('Абзац 0:'))
+        self.assertTrue(chunks[0].compare_text.startswith('Абзац 0:'))
+
+    def test_oversized_section_is_split(self):
+        section = '# Раздел 1\n' + '\n'.join('строка ' * 20 for _ in range(100))
+        typeid = self.typeid(chunking='headings')
+        chunks = split_aligned_chunks(section + '\n# Раздел 2\nкратко', section + ' правка\n# Раздел 2\nкратко', typeid)
+        self.assertGreater(len(chunks), 2)
+        self.assertFitsBudget(chunks, typeid)
+```
+
+### 13. Локальная предварительная оценка сходства
+
+#### Бизнес требования:
+- **Очевидные случаи без LLM**: Заметная часть запросов сравнивает эталон с его точной или почти точной копией либо с документом, явно не относящимся к эталону. Для таких запросов обращение к LLM только добавляет задержку и расход токенов.
+- **Локальная оценка**: Перед `compare_texts_llm` выполняется быстрая локальная оценка сходства по сигнатурам MinHash. Если оценка выходит за пороги TypeID, клиент получает детерминированный отчёт без обращения к провайдеру и без списания токенов.
+- **Пороги в TypeID**: `prefilter_identical` — минимальное сходство по фразам, при котором документ считается копией эталона; `prefilter_unrelated` — максимальное сходство по словарю, при котором документ считается не относящимся к эталону. Пустое значение отключает соответствующую проверку (по умолчанию обе отключены).
+- **Сигнатура эталона**: Сигнатура эталона вычисляется один раз при загрузке в `UploadReferenceTextView` и хранится в `Texts.signature`.
+- **Оценка в ответе**: Локальная оценка (`local_score`) возвращается в каждом ответе сравнения — синхронном, асинхронном и пакетном — в том числе когда отчёт сформирован LLM.
+
+#### Описание работы функций:
+1. **Сигнатура** (`compute_signature`):
+   - Текст приводится к нижнему регистру и делится на слова.
+   - Строятся два множества: шинглы из `MINHASH_SHINGLE_SIZE` подряд идущих слов (сходство формулировок) и отдельные слова (сходство словаря).
+   - Для каждого множества вычисляется MinHash из `MINHASH_PERMUTATIONS` значений. Хэши шинглов обрабатываются блоками в numpy: все перестановки применяются к блоку одной матричной операцией, поэтому память не зависит от размера документа.
+   - Сигнатура — 1 КБ (`2 × 128 × uint32`), одинаковая во всех процессах: коэффициенты перестановок берутся из генератора с фиксированным зерном.
+2. **Оценка** (`local_similarity`):
+   - Сигнатура сравниваемого текста сопоставляется с сигнатурой эталона из `ReferencePrompt`. Доля совпавших значений MinHash — оценка коэффициента Жаккара для шинглов (`shingle_similarity`) и для слов (`word_similarity`).
+3. **Решение** (`prefilter_report`):
+   - `shingle_similarity >= prefilter_identical` — вердикт `identical`.
+   - `word_similarity <= prefilter_unrelated` — вердикт `unrelated`.
+   - Иначе вердикт пустой и сравнение выполняется через `compare_texts_llm`.
+
+#### Пример реализации:
+```python
+import re
+import zlib
+
+import numpy as np
+from django.db import models
+
+MINHASH_PERMUTATIONS = 128
+MINHASH_SHINGLE_SIZE = 3
+MINHASH_BLOCK_SIZE = 4096
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_UINT32_MASK = np.uint64(0xFFFFFFFF)
+# Фиксированное зерно: сигнатуры, сохранённые в базе, должны совпадать между процессами и релизами
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+WORD_RE = re.compile(r'\w+')
+
+
+class TypeID(models.Model):
+    # ... scale, system, user, model, llm, description, chunking, chunk_tokens, merge_prompt
+    prefilter_identical = models.FloatField(null=True, blank=True)
+    prefilter_unrelated = models.FloatField(null=True, blank=True)
+
+
+class LocalScore:
+    """Результат локальной оценки сходства сравниваемого текста с эталоном."""
+
+    __slots__ = ('shingle_similarity', 'word_similarity', 'verdict')
+
+    def __init__(self, shingle_similarity, word_similarity):
+        self.shingle_similarity = shingle_similarity
+        self.word_similarity = word_similarity
+        self.verdict = None  # 'identical', 'unrelated' или None, если нужен LLM
+
+    def as_dict(self):
+        return {
+            'shingle_similarity': round(self.shingle_similarity, 4),
+            'word_similarity': round(self.word_similarity, 4),
+            'verdict': self.verdict,
+        }
+
+
+def _minhash(hashes):
+    """MinHash множества 32-битных хэшей, перестановки применяются к блоку хэшей одной операцией."""
+    signature = np.full(MINHASH_PERMUTATIONS, _UINT32_MASK, dtype=np.uint64)
+    for start in range(0, len(hashes), MINHASH_BLOCK_SIZE):
+        block = hashes[start:start + MINHASH_BLOCK_SIZE]
+        values = (np.outer(_PERM_A, block) + _PERM_B[:, None]) % _MERSENNE_PRIME & _UINT32_MASK
+        signature = np.minimum(signature, values.min(axis=1))
+    return signature.astype(np.uint32)
+
+
+def _hash_set(items):
+    return np.fromiter({zlib.crc32(item.encode('utf-8')) for item in items}, dtype=np.uint64)
+
+
+def compute_signature(text):
+    """Сигнатура текста: MinHash шинглов из слов и MinHash отдельных слов (bytes, 1 КБ)."""
+    words = WORD_RE.findall(text.lower())
+    size = MINHASH_SHINGLE_SIZE
+    shingles = (' '.join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1)))
+    return _minhash(_hash_set(shingles)).tobytes() + _minhash(_hash_set(words)).tobytes()
+
+
+def local_similarity(reference_signature, compare_text):
+    """Оценка коэффициентов Жаккара сравниваемого текста с эталоном по сигнатурам."""
+    reference = np.frombuffer(reference_signature, dtype=np.uint32).reshape(2, MINHASH_PERMUTATIONS)
+    compare = np.frombuffer(compute_signature(compare_text), dtype=np.uint32).reshape(2, MINHASH_PERMUTATIONS)
+    shingle_similarity, word_similarity = (reference == compare).mean(axis=1)
+    return LocalScore(float(shingle_similarity), float(word_similarity))
+
+
+def prefilter_report(score, typeid):
+    """Детерминированный отчёт по порогам TypeID или None, если нужно сравнение через LLM."""
+    if typeid.prefilter_identical is not None and score.shingle_similarity >= typeid.prefilter_identical:
+        score.verdict = 'identical'
+        return (
+            f"The document is a near-identical copy of the reference "
+            f"(local similarity {score.shingle_similarity:.0%}); no substantive differences."
+        )
+    if typeid.prefilter_unrelated is not None and score.word_similarity <= typeid.prefilter_unrelated:
+        score.verdict = 'unrelated'
+        return (
+            f"The document is unrelated to the reference "
+            f"(vocabulary overlap {score.word_similarity:.0%}); comparison is not applicable."
+        )
+    return None
+
+
+def compare_with_prefilter(reference, compare_text, typeid, api_key_obj):
+    """Сравнение с локальной предварительной оценкой; возвращает пару (отчёт, LocalScore)."""
+    started = time.monotonic()
+    score = local_similarity(reference.signature, compare_text)
+    report = prefilter_report(score, typeid)
+    if report is None:
+        report = compare_texts_llm(reference, compare_text, typeid, api_key_obj)
+    else:
+        log_comparison(api_key_obj, started, verdict=score.verdict)
+    return report, score
+```
+
+### 14. Ограничение частоты и параллелизма запросов
+
+#### Бизнес требования:
+- **Справедливое распределение квоты провайдера**: Проверка `enforce_subscription_and_tokens` ограничивает только остаток токенов. Один API ключ может отправить много параллельных сравнений и израсходовать квоту провайдера LLM, общую для всех клиентов. Доступ к эндпоинтам текстов ограничивается по частоте запросов и по числу одновременно выполняемых запросов.
+- **Настройка лимитов**: Лимиты задаются в APIKey (`rate_limit_rpm`, `max_concurrency`). Если у ключа значение не задано, используется значение TypeID, иначе — значение по умолчанию из настроек.
+- **Глобальные лимиты провайдеров**: Запросы к каждой паре (провайдер, модель) со всех ключей ограничиваются лимитами, соответствующими лимитам аккаунта у провайдера: запросов в минуту (RPM) и токенов в минуту (TPM).
+- **Ответ при превышении**: `429 Too Many Requests` с заголовком `Retry-After` (секунды до появления свободной ёмкости).
+- **Хранение счётчиков**: В памяти процесса (по умолчанию, для одного процесса) или в Redis (общие лимиты для всех воркеров).
+
+#### Описание работы функций:
+1. **Миддлваре допуска** (`AdmissionControlMiddleware`):
+   - Применяется к путям из `RATE_LIMITED_PATHS`.
+   - Сначала выполняется `enforce_subscription_and_tokens` (раздел 5): токен, подписка и остаток токенов.
+   - Затем из корзины токенов ключа (token bucket) списывается один запрос. Корзина пополняется со скоростью `rate_limit_rpm / 60` в секунду, её ёмкость (допустимый всплеск) — `RATE_LIMIT_BURST_SECONDS` секунд пополнения.
+   - Затем занимается слот одновременного выполнения ключа. Слот освобождается после ответа, а для потоковых ответов (пакетное сравнение, раздел 8) — при закрытии ответа (`call_on_close`): после отправки последней строки или при разрыве соединения, в том числе до первой строки.
+2. **Лимиты провайдера** (`acquire_provider_capacity`):
+   - Перед каждым обращением к провайдеру, в том числе для каждого фрагмента (раздел 12), из корзин RPM и TPM пары (провайдер, модель) списываются один запрос и оценка входных токенов.
+   - Если ёмкости нет, вызов ждёт её появления не дольше `PROVIDER_LIMIT_MAX_WAIT` секунд, затем выбрасывается `RateLimited`. Резерв токенов ключа возвращается, клиент получает 429 с `Retry-After`; асинхронная задача и строка пакета завершаются ошибкой.
+3. **Хранилище счётчиков**:
+   - `LocalLimiterBackend` — словари под блокировкой в памяти процесса.
+   - `RedisLimiterBackend` — корзина обновляется атомарно Lua скриптом по времени сервера Redis. Слоты — отсортированное множество: каждый занятый слот хранится отдельным элементом с временем захвата, перед подсчётом элементы старше `SLOT_TTL` удаляются. Слот упавшего воркера истекает сам, даже если ключ всё время занят другими запросами, а освобождение удаляет только свой элемент и не может увести счётчик ниже нуля.
+
+#### Настройки:
+```python
+MIDDLEWARE = [
+    # ...
+    'api.middleware.AdmissionControlMiddleware',
+]
+RATE_LIMIT = {'BACKEND': 'local'}  # или {'BACKEND': 'redis', 'URL': 'redis://localhost:6379/2'}
+RATE_LIMITED_PATHS = ('/api/v1/reference', '/api/v1/compare')
+RATE_LIMIT_DEFAULT_RPM = 60
+RATE_LIMIT_DEFAULT_CONCURRENCY = 4
+RATE_LIMIT_BURST_SECONDS = 10
+LLM_PROVIDER_LIMITS = {
+    'openai': {'gpt-4o': {'rpm': 500, 'tpm': 30000}, '*': {'rpm': 500, 'tpm': 200000}},
+    'gemini': {'*': {'rpm': 360, 'tpm': 4000000}},
+}
+PROVIDER_LIMIT_MAX_WAIT = 5  # секунды
+```
+
+#### Пример реализации:
+```python
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import models
+from django.http import JsonResponse
+
+SLOT_TTL = 15 * 60  # секунды, слоты воркера, завершившегося без освобождения, истекают
+
+
+class APIKey(models.Model):
+    # ... user, key, secret_key, typeid, status, tokens_remaining, token_limit, llm_api_key
+    rate_limit_rpm = models.PositiveIntegerField(null=True, blank=True)
+    max_concurrency = models.PositiveIntegerField(null=True, blank=True)
+
+
+class TypeID(models.Model):
+    # ... scale, system, user, model, llm, description, chunking, prefilter_*
+    rate_limit_rpm = models.PositiveIntegerField(null=True, blank=True)
+    max_concurrency = models.PositiveIntegerField(null=True, blank=True)
+
+
+class RateLimited(Exception):
+    """Превышен лимит частоты или параллелизма; retry_after — секунды до появления ёмкости."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LocalLimiterBackend:
+    """Счётчики в памяти процесса."""
+
+    def __init__(self):
+        self._buckets = {}  # ключ -> (токенов в корзине, время обновления)
+        self._slots = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity, cost=1):
+        """Списание cost из корзины; возвращает 0 или число секунд до появления нужной ёмкости."""
+        cost = min(cost, capacity)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+        return wait
+
+    def acquire_slot(self, key, limit):
+        """Занятие слота; возвращает идентификатор слота для release_slot или None, если слотов нет."""
+        with self._lock:
+            if self._slots[key] >= limit:
+                return None
+            self._slots[key] += 1
+            return True
+
+    def release_slot(self, key, slot_id):
+        with self._lock:
+            self._slots[key] -= 1
+            if self._slots[key] <= 0:
+                del self._slots[key]
+
+
+class RedisLimiterBackend:
+    """Общие счётчики всех воркеров в Redis."""
+
+    TAKE_SCRIPT = """
+    local capacity, rate, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * rate)
+    local wait = 0
+    if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    # Слот — элемент множества со временем захвата; истёкшие слоты упавших воркеров удаляются по одному
+    ACQUIRE_SCRIPT = """
+    local limit, ttl, slot_id = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+    if redis.call('ZCARD', KEYS[1]) >= limit then return 0 end
+    redis.call('ZADD', KEYS[1], now, slot_id)
+    redis.call('EXPIRE', KEYS[1], ttl)
+    return 1
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(self.TAKE_SCRIPT)
+        self._acquire = self.client.register_script(self.ACQUIRE_SCRIPT)
+
+    def take(self, key, rate, capacity, cost=1):
+        return float(self._take(keys=[f"ratelimit:{key}"], args=[capacity, rate, min(cost, capacity)]))
+
+    def acquire_slot(self, key, limit):
+        slot_id = uuid.uuid4().hex
+        if not self._acquire(keys=[f"inflight:{key}"], args=[limit, SLOT_TTL, slot_id]):
+            return None
+        return slot_id
+
+    def release_slot(self, key, slot_id):
+        self.client.zrem(f"inflight:{key}", slot_id)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                options = getattr(settings, 'RATE_LIMIT', {})
+                if options.get('BACKEND') == 'redis':
+                    _limiter = RedisLimiterBackend(options['URL'])
+                else:
+                    _limiter = LocalLimiterBackend()
+    return _limiter
+
+
+def _first_set(*values):
+    return next(value for value in values if value is not None)
+
+
+def key_limits(api_key_obj):
+    """Лимиты ключа: значение APIKey, иначе TypeID, иначе настройки по умолчанию."""
+    typeid = api_key_obj.typeid
+    rpm = _first_set(api_key_obj.rate_limit_rpm, typeid.rate_limit_rpm, getattr(settings, 'RATE_LIMIT_DEFAULT_RPM', 60))
+    concurrency = _first_set(
+        api_key_obj.max_concurrency, typeid.max_concurrency, getattr(settings, 'RATE_LIMIT_DEFAULT_CONCURRENCY', 4),
+    )
+    return rpm, concurrency
+
+
+def too_many_requests(message, retry_after):
+    response = JsonResponse({'error': message}, status=429)
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class AdmissionControlMiddleware:
+    """Проверка подписки и токенов, лимит частоты и лимит одновременных запросов API ключа."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith(tuple(getattr(settings, 'RATE_LIMITED_PATHS', ()))):
+            return self.get_response(request)
+
+        response = enforce_subscription_and_tokens(request)
+        if response is not None:
+            return response
+
+        api_key_obj = request.api_key_obj
+        rpm, concurrency = key_limits(api_key_obj)
+        limiter = get_limiter()
+        capacity = max(1, math.ceil(rpm * getattr(settings, 'RATE_LIMIT_BURST_SECONDS', 10) / 60))
+        wait = limiter.take(f"key:{api_key_obj.pk}", rpm / 60, capacity)
+        if wait:
+            return too_many_requests('Request rate limit exceeded for this API key.', wait)
+
+        slot = f"key:{api_key_obj.pk}"
+        slot_id = limiter.acquire_slot(slot, concurrency)
+        if slot_id is None:
+            return too_many_requests('Too many concurrent requests for this API key.', 1)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            limiter.release_slot(slot, slot_id)
+            raise
+        if response.streaming:
+            # Потоковый ответ формируется после выхода из миддлваре, слот держится до его закрытия
+            call_on_close(response, lambda: limiter.release_slot(slot, slot_id))
+        else:
+            limiter.release_slot(slot, slot_id)
+        return response
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, RateLimited):
+            return too_many_requests(str(exception), exception.retry_after)
+        return None
+
+
+def _provider_limits(typeid):
+    limits = getattr(settings, 'LLM_PROVIDER_LIMITS', {}).get(typeid.llm, {})
+    return limits.get(typeid.model) or limits.get('*')
+
+
+def acquire_provider_capacity(typeid, prompt_tokens, max_wait=None):
+    """Ожидание ёмкости RPM и TPM пары (провайдер, модель), общей для всех ключей."""
+    limits = _provider_limits(typeid)
+    if not limits:
+        return
+    limiter = get_limiter()
+    if max_wait is None:
+        max_wait = getattr(settings, 'PROVIDER_LIMIT_MAX_WAIT', 5)
+    deadline = time.monotonic() + max_wait
+    scope = f"provider:{typeid.llm}:{typeid.model}"
+    for name, cost in (('rpm', 1), ('tpm', prompt_tokens)):
+        if name not in limits:
+            continue
+        while True:
+            wait = limiter.take(f"{scope}:{name}", limits[name] / 60, limits[name], cost)
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(f"LLM provider {name.upper()} limit reached, retry later.", wait)
+            time.sleep(wait)
+```
+
+```python
+# api/http.py
+def call_on_close(response, callback):
+    """Вызов callback при закрытии ответа: после выдачи последнего фрагмента или при разрыве соединения."""
+    # Сервер закрывает ответ и тогда, когда клиент отключился до первого фрагмента. В этом случае
+    # finally генератора-обёртки содержимого не выполнился бы и слот остался бы занятым
+    response._resource_closers.append(callback)
+```
+
+### 15. Устойчивые обращения к провайдерам LLM
+
+#### Бизнес требования:
+- **Ошибка — не отчёт**: Ошибка провайдера не должна возвращаться клиенту как текст отчёта. Клиент получает ошибку с кодом `502` (провайдер ответил ошибкой) или `503` (провайдер недоступен), резерв токенов возвращается.
+- **Дедлайн**: У каждого обращения к провайдеру есть общий дедлайн на все попытки. Таймаут каждой попытки не больше оставшегося времени, поэтому зависший провайдер не занимает воркер бесконечно.
+- **Повторы**: Временные ошибки (таймаут, разрыв соединения, 408, 429, 5xx) повторяются ограниченное число раз с экспоненциальной задержкой и случайным разбросом (full jitter). Если провайдер вернул `Retry-After`, задержка не меньше него. Ошибки запроса (400, 401, 404) не повторяются.
+- **Автоматический выключатель**: Для каждой пары (провайдер, модель) считаются подряд идущие временные ошибки. После `breaker_failures` ошибок выключатель размыкается на `breaker_reset` секунд, и запросы к этой модели сразу завершаются ошибкой без ожидания таймаутов. Затем пропускается один пробный запрос: успех замыкает выключатель, ошибка размыкает снова. Если проба завершилась без ответа провайдера (лимит RPM/TPM, истёкший дедлайн, ошибка до отправки), она освобождается без изменения счётчика ошибок, и пробным становится следующий запрос.
+- **Хеджирование**: Для провайдера можно задать `hedge_after`. Если ответ не получен за это время, отправляется второй такой же запрос и используется ответ, пришедший первым. Хеджирование сокращает хвост задержек ценой дополнительных запросов к провайдеру; токены второго запроса клиенту не списываются. По умолчанию выключено.
+  - Время `hedge_after` отсчитывается от фактического начала запроса, а не от постановки в пул потоков (`LLM_HEDGE_WORKERS`). Поэтому занятый пул сам по себе не порождает хеджирующих запросов.
+  - Хеджирующий запрос расходует ёмкость RPM/TPM провайдера (раздел 14). Если ёмкости нет, он не отправляется, и попытка ждёт первый запрос.
+  - При выходе из попытки запросы, ещё не начатые в пуле, отменяются.
+- **Резервная модель**: В TypeID можно указать `fallback_llm` и `fallback_model`. Если выключатель основной модели разомкнут или повторы исчерпаны, запрос выполняется резервной моделью. Отчёты резервной модели не кэшируются (раздел 6), чтобы после восстановления основной модели повторные сравнения получили её отчёт.
+- **Тестирование**: Поведение проверяется на локальном провайдере `fake`, который вносит задержки и ошибки с заданными вероятностями.
+
+#### Описание работы функций:
+1. **`call_provider`** вызывается из `request_llm_report` для каждого обращения к провайдеру, в том числе для фрагментов и объединения отчётов (раздел 12):
+   - Если выключатель основной модели разомкнут, сразу используется резервная модель. Если резервной модели нет, возбуждается `ProviderUnavailable`.
+   - Иначе выполняются попытки к основной модели (`_call_with_retries`). Если они завершились `ProviderUnavailable` и у TypeID есть резервная модель, запрос выполняется ею.
+   - Для резервной модели того же провайдера используется `llm_api_key` ключа. Для другого провайдера ключ берётся из `LLM_FALLBACK_API_KEYS` (из переменных окружения).
+2. **Попытка** (`_attempt`):
+   - Перед каждой попыткой списывается ёмкость RPM/TPM провайдера (раздел 14).
+   - Адаптер вызывается с `timeout = min(оставшееся до дедлайна время, таймаут провайдера)`. Собственные повторы OpenAI SDK отключены (`max_retries=0`), чтобы повторы не умножались.
+3. **Классификация ошибок** (`is_transient`):
+   - По коду ответа (`status_code` у исключений OpenAI, `code` у исключений google-genai) и по типу ошибки: `TimeoutError`, `ConnectionError`, ошибки транспорта `httpx` и `openai.APIConnectionError`.
+4. **Результат**:
+   - `LLMUsage.fallback_used` отмечает ответы резервной модели.
+   - Ошибки провайдера доходят до представления как `LLMError` (`status = 502`) или `ProviderUnavailable` (`status = 503`). Асинхронная задача получает статус `failed`, строка пакета — поле `error`.
+
+#### Настройки:
+```python
+LLM_RESILIENCE = {
+    '*': {
+        'deadline': 90,           # секунды на все попытки одного обращения
+        'max_retries': 3,
+        'backoff_base': 0.5,      # секунды, задержка перед n-м повтором — случайная в [0, base * 2^n]
+        'backoff_max': 8,
+        'hedge_after': None,      # секунды до отправки хеджирующего запроса, None — выключено
+        'breaker_failures': 5,
+        'breaker_reset': 30,      # секунды
+    },
+    'openai': {'hedge_after': 20},
+    'local': {'deadline': 30, 'max_retries': 1},
+}
+LLM_HEDGE_WORKERS = 16  # потоки для запросов с хеджированием в каждом процессе
+LLM_FALLBACK_API_KEYS = {
+    'gemini': os.environ.get('GEMINI_API_KEY', ''),
+}
+LLM_PROVIDERS = {
+    # ...
+    # Локальный провайдер с внесением задержек и ошибок, только для тестов и нагрузочных прогонов
+    'fake': {'latency': 0.2, 'latency_jitter': 0.1, 'error_rate': 0.05, 'error_status': 503, 'stall_rate': 0.01},
+}
+```
+
+#### Пример реализации:
+```python
+import functools
+import random
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import models
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+DEFAULT_RESILIENCE = {
+    'deadline': 90, 'max_retries': 3, 'backoff_base': 0.5, 'backoff_max': 8,
+    'hedge_after': None, 'breaker_failures': 5, 'breaker_reset': 30,
+}
+
+_hedge_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'LLM_HEDGE_WORKERS', 16),
+    thread_name_prefix='llm-hedge',
+)
+
+
+class TypeID(models.Model):
+    # ... scale, system, user, model, llm, description, chunking, prefilter_*, rate_limit_*
+    fallback_llm = models.CharField(max_length=50, blank=True, default='')
+    fallback_model = models.CharField(max_length=100, blank=True, default='')
+
+
+class ProviderUnavailable(LLMError):
+    """Провайдер недоступен: выключатель разомкнут, дедлайн истёк или повторы исчерпаны."""
+    status = 503
+
+
+class CircuitBreaker:
+    """Автоматический выключатель пары (провайдер, модель) в памяти процесса."""
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial = None  # метка пробного запроса полуоткрытого состояния
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Разрешение на запрос: False, True (выключатель замкнут) или метка пробного запроса.
+
+        Полученное разрешение возвращается через release() при любом исходе обращения.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial is not None or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            # Полуоткрытое состояние: пропускается один пробный запрос
+            self._trial = object()
+            return self._trial
+
+    def release(self, permit):
+        """Завершение пробного запроса без результата (лимит, дедлайн до попытки, ошибка запроса).
+
+        Счётчик ошибок не меняется, следующий запрос снова может стать пробным.
+        """
+        with self._lock:
+            if permit is not True and permit is self._trial:
+                self._trial = None
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial = None
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._trial is not None or self._consecutive_failures >= self.failures:
+                self._opened_at = time.monotonic()
+            self._trial = None
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def resilience_policy(llm):
+    options = getattr(settings, 'LLM_RESILIENCE', {})
+    return {**DEFAULT_RESILIENCE, **options.get('*', {}), **options.get(llm, {})}
+
+
+def get_breaker(llm, model):
+    breaker = _breakers.get((llm, model))
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get((llm, model))
+            if breaker is None:
+                policy = resilience_policy(llm)
+                breaker = CircuitBreaker(policy['breaker_failures'], policy['breaker_reset'])
+                _breakers[(llm, model)] = breaker
+    return breaker
+
+
+@functools.lru_cache(maxsize=None)
+def _transport_errors():
+    errors = [TimeoutError, ConnectionError]
+    try:
+        import httpx
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    try:
+        import openai
+        errors.append(openai.APIConnectionError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def _status_code(error):
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_transient(error):
+    """Временная ошибка провайдера, которую имеет смысл повторить."""
+    if isinstance(error, _transport_errors()):
+        return True
+    return _status_code(error) in RETRYABLE_STATUSES
+
+
+def retry_delay(error, attempt, policy):
+    """Экспоненциальная задержка с full jitter, не меньше Retry-After ответа провайдера."""
+    delay = random.uniform(0, min(policy['backoff_max'], policy['backoff_base'] * 2 ** attempt))
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        delay = max(delay, float(headers.get('retry-after', 0)))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+def _hedge_allowed(typeid, prompt_tokens):
+    """Хеджирующий запрос — отдельное обращение к провайдеру и расходует его RPM/TPM без ожидания."""
+    try:
+        acquire_provider_capacity(typeid, prompt_tokens, max_wait=0)
+    except RateLimited:
+        return False
+    return True
+
+
+def _attempt(provider, reference, compare_text, typeid, timeout, hedge_after, prompt_tokens):
+    """Одна попытка, при hedge_after — с дублирующим запросом, если первый не ответил вовремя."""
+    if not hedge_after or hedge_after >= timeout:
+        return provider.complete(reference, compare_text, typeid, timeout=timeout)
+
+    end = time.monotonic() + timeout
+    started = threading.Event()
+
+    def primary():
+        started.set()
+        return provider.complete(reference, compare_text, typeid, timeout=max(0.0, end - time.monotonic()))
+
+    pending = {_hedge_executor.submit(primary)}
+    try:
+        # hedge_after отсчитывается от начала запроса: ожидание свободного потока пула не считается
+        # медленным ответом провайдера и не порождает хеджирующих запросов
+        if not started.wait(max(0.0, end - time.monotonic())):
+            raise TimeoutError('LLM provider call was not started within the deadline')
+        done, pending = wait(pending, timeout=hedge_after)
+        if not done and _hedge_allowed(typeid, prompt_tokens):
+            remaining = end - time.monotonic()
+            pending.add(_hedge_executor.submit(provider.complete, reference, compare_text, typeid, timeout=remaining))
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+            if not pending:
+                raise error
+            done, pending = wait(pending, timeout=max(0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError('LLM provider did not respond within the deadline')
+    finally:
+        # Запросы, ещё ждущие потока пула, отменяются; выполняемые завершатся по своему таймауту
+        for future in pending:
+            future.cancel()
+
+
+@timed('provider_call')
+def _call_with_retries(reference, compare_text, typeid, llm_api_key, prompt_tokens, permit):
+    """Попытки к одной модели в пределах дедлайна с повторами временных ошибок.
+
+    permit — разрешение выключателя, полученное вызывающим; возвращается при любом выходе.
+    """
+    policy = resilience_policy(typeid.llm)
+    provider = get_provider(typeid.llm, llm_api_key)
+    breaker = get_breaker(typeid.llm, typeid.model)
+    deadline = time.monotonic() + policy['deadline']
+    last_error = None
+    try:
+        for attempt in range(policy['max_retries'] + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Лимиты RPM/TPM провайдера (раздел 14), каждая попытка — отдельный запрос
+            acquire_provider_capacity(typeid, prompt_tokens)
+            try:
+                result = _attempt(
+                    provider, reference, compare_text, typeid,
+                    min(remaining, provider.timeout), policy['hedge_after'], prompt_tokens,
+                )
+            except LLMError:
+                raise
+            except Exception as e:
+                record_provider_error(typeid, e)
+                if not is_transient(e):
+                    # Провайдер ответил, ошибка в самом запросе: состояние выключателя не меняется
+                    breaker.record_success()
+                    raise LLMError(str(e)) from e
+                breaker.record_failure()
+                last_error = e
+                delay = retry_delay(e, attempt, policy)
+                if attempt == policy['max_retries'] or time.monotonic() + delay >= deadline:
+                    break
+                permit = breaker.allow()
+                if not permit:
+                    break
+                time.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+    finally:
+        # RateLimited, дедлайн до попытки и LLMError не дают результата пробного запроса:
+        # проба освобождается, иначе выключатель остался бы разомкнутым до перезапуска процесса
+        breaker.release(permit)
+    raise ProviderUnavailable(f"LLM provider unavailable: {last_error or 'deadline exceeded'}")
+
+
+def _fallback_typeid(typeid):
+    fallback_llm = getattr(typeid, 'fallback_llm', '')
+    fallback_model = getattr(typeid, 'fallback_model', '')
+    if not fallback_llm and not fallback_model:
+        return None
+    return SimpleNamespace(
+        system=typeid.system, user=typeid.user,
+        llm=fallback_llm or typeid.llm, model=fallback_model or typeid.model,
+    )
+
+
+def _fallback_api_key(typeid, fallback, llm_api_key):
+    """llm_api_key ключа подходит для модели того же провайдера, ключ другого провайдера берётся из настроек."""
+    if fallback.llm == typeid.llm:
+        return llm_api_key
+    return getattr(settings, 'LLM_FALLBACK_API_KEYS', {}).get(fallback.llm, '')
+
+
+def call_provider(reference, compare_text, typeid, llm_api_key):
+    """Обращение к провайдеру с дедлайном, повторами, выключателем и резервной моделью TypeID."""
+    prompt_tokens = reference.prefix_tokens + count_tokens(typeid.user + compare_text, typeid.model)
+    fallback = _fallback_typeid(typeid)
+    permit = get_breaker(typeid.llm, typeid.model).allow()
+    if permit:
+        try:
+            return _call_with_retries(reference, compare_text, typeid, llm_api_key, prompt_tokens, permit)
+        except ProviderUnavailable:
+            if fallback is None:
+                raise
+    elif fallback is None:
+        raise ProviderUnavailable(f"LLM provider {typeid.llm}/{typeid.model} is temporarily unavailable")
+
+    fallback_permit = get_breaker(fallback.llm, fallback.model).allow()
+    if not fallback_permit:
+        raise ProviderUnavailable(f"LLM provider {typeid.llm}/{typeid.model} and its fallback are unavailable")
+    fallback_key = _fallback_api_key(typeid, fallback, llm_api_key)
+    report, usage = _call_with_retries(reference, compare_text, fallback, fallback_key, prompt_tokens, fallback_permit)
+    usage.fallback_used = True
+    return report, usage
+```
+
+##### Провайдер с внесением ошибок:
+```python
+class FakeProviderError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Fake provider error {status_code}")
+        self.status_code = status_code
+
+
+@register_provider('fake')
+class FaultInjectingProvider(LLMProvider):
+    """Локальный провайдер без сети: задержка, ошибки и зависания с заданными вероятностями."""
+
+    def __init__(self, api_key, timeout=30, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 error_status=503, stall_rate=0.0, fail_first=0, seed=None):
+        super().__init__(api_key, timeout)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stall_rate = stall_rate
+        self.fail_first = fail_first  # первые N запросов всегда завершаются ошибкой
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def complete(self, reference, compare_text, typeid, timeout=None):
+        timeout = timeout or self.timeout
+        with self._lock:
+            self.calls += 1
+            call_number = self.calls
+            roll = self._random.random()
+            delay = max(0.0, self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter))
+        if roll < self.stall_rate:
+            # Зависший провайдер: ответа нет до истечения таймаута клиента
+            time.sleep(timeout)
+            raise TimeoutError('Fake provider stalled')
+        if delay >= timeout:
+            time.sleep(timeout)
+            raise TimeoutError('Fake provider timed out')
+        time.sleep(delay)
+        if call_number <= self.fail_first or roll < self.stall_rate + self.error_rate:
+            raise FakeProviderError(self.error_status)
+        prompt_tokens = (len(reference.prefix) + len(typeid.user) + len(compare_text)) // 4
+        return f"fake report from {typeid.model}", LLMUsage(input_tokens=prompt_tokens, output_tokens=5)
+
+    def stream(self, reference, compare_text, typeid, usage, timeout=None):
+        # Отчёт выдаётся по словам, расход — только после последнего слова, как у реальных провайдеров
+        report, call_usage = self.complete(reference, compare_text, typeid, timeout=timeout)
+        for word in re.findall(r'\S+\s*', report):
+            yield word
+        usage.add(call_usage)
+```
+
+##### Тесты:
+```python
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+FAST_RETRIES = {'*': {'deadline': 2, 'max_retries': 3, 'backoff_base': 0, 'breaker_failures': 3, 'breaker_reset': 60}}
+
+
+@override_settings(LLM_RESILIENCE=FAST_RETRIES, LLM_PROVIDER_LIMITS={})
+class ResilientProviderCallTest(SimpleTestCase):
+    def setUp(self):
+        _breakers.clear()
+        self.reference = ReferencePrompt(prefix='Эталон: текст', prefix_tokens=4, digest='a' * 64)
+
+    def typeid(self, model='primary', **fallback):
+        return SimpleNamespace(system='Эталон: ', user='Работа: ', llm='fake', model=model, **fallback)
+
+    def provider(self, llm_api_key, **options):
+        with override_settings(LLM_PROVIDERS={'fake': options}):
+            return get_provider('fake', llm_api_key)
+
+    def test_transient_errors_are_retried(self):
+        provider = self.provider('retry', fail_first=2, error_status=503)
+        report, _ = call_provider(self.reference, 'работа', self.typeid(), 'retry')
+        self.assertEqual(report, 'fake report from primary')
+        self.assertEqual(provider.calls, 3)
+
+    def test_client_errors_are_not_retried(self):
+        provider = self.provider('bad-request', fail_first=10, error_status=400)
+        with self.assertRaises(LLMError) as raised:
+            call_provider(self.reference, 'работа', self.typeid(), 'bad-request')
+        self.assertNotIsInstance(raised.exception, ProviderUnavailable)
+        self.assertEqual(provider.calls, 1)
+
+    def test_stalled_provider_respects_deadline(self):
+        self.provider('stall', stall_rate=1.0, timeout=10)
+        started = time.monotonic()
+        with self.assertRaises(ProviderUnavailable):
+            call_provider(self.reference, 'работа', self.typeid(), 'stall')
+        self.assertLess(time.monotonic() - started, 3)
+
+    def test_open_circuit_uses_fallback_model(self):
+        provider = self.provider('fallback', fail_first=3, error_status=503)
+        typeid = self.typeid(fallback_llm='', fallback_model='backup')
+        # Три ошибки подряд: выключатель primary размыкается, запрос выполняет резервная модель
+        report, usage = call_provider(self.reference, 'работа', typeid, 'fallback')
+        self.assertEqual(report, 'fake report from backup')
+        self.assertTrue(usage.fallback_used)
+        calls = provider.calls
+        # Пока выключатель разомкнут, основная модель не вызывается
+        report, _ = call_provider(self.reference, 'работа', typeid, 'fallback')
+        self.assertEqual(report, 'fake report from backup')
+        self.assertEqual(provider.calls, calls + 1)
+
+    @override_settings(LLM_PROVIDER_LIMITS={'fake': {'half-open': {'rpm': 1}}}, PROVIDER_LIMIT_MAX_WAIT=0)
+    def test_rate_limited_trial_releases_half_open_breaker(self):
+        provider = self.provider('half-open')
+        breaker = get_breaker('fake', 'half-open')
+        breaker._opened_at = time.monotonic() - 60  # разомкнут, время до пробного запроса истекло
+        # Ёмкость RPM провайдера исчерпана: пробный запрос завершается RateLimited до обращения к провайдеру
+        get_limiter().take('provider:fake:half-open:rpm', 1 / 60, 1)
+        with self.assertRaises(RateLimited):
+            call_provider(self.reference, 'работа', self.typeid('half-open'), 'half-open')
+        self.assertEqual(provider.calls, 0)
+        # Проба освобождена: следующий запрос снова получает право на пробу
+        self.assertTrue(breaker.allow())
+
+    @override_settings(LLM_RESILIENCE={'*': {**FAST_RETRIES['*'], 'hedge_after': 0.1}})
+    def test_hedge_respects_provider_limits(self):
+        provider = self.provider('hedge', latency=0.3)
+        call_provider(self.reference, 'работа', self.typeid('hedge'), 'hedge')
+        self.assertEqual(provider.calls, 2)
+        # RPM модели исчерпан первым запросом: хеджирующий запрос не отправляется
+        provider = self.provider('hedge-limited', latency=0.3)
+        with override_settings(LLM_PROVIDER_LIMITS={'fake': {'hedge-limited': {'rpm': 1}}}):
+            call_provider(self.reference, 'работа', self.typeid('hedge-limited'), 'hedge-limited')
+        self.assertEqual(provider.calls, 1)
+```
+
+### 16. Потоковая выдача отчёта сравнения
+
+#### Бизнес требования:
+- **Отчёт по мере генерации**: В обычном режиме `CompareTextView` отвечает только после того, как модель сгенерировала весь отчёт. Интерфейс всё это время показывает индикатор загрузки, а длинные отчёты упираются в таймауты прокси. В потоковом режиме фрагменты отчёта передаются клиенту по мере их получения от провайдера.
+- **Формат**: `POST /api/v1/compare/{reference_id}?stream=1`. При заголовке `Accept: text/event-stream` ответ передаётся как Server-Sent Events, иначе — как NDJSON (`application/x-ndjson`, по одному JSON объекту на строку).
+- **Учёт токенов**: Резерв токенов списывается до начала потока и корректируется по фактическому расходу после его окончания. При разрыве соединения клиентом запрос к провайдеру прерывается, и оплачиваются промпт и уже сгенерированная часть отчёта.
+
+#### Описание работы функций:
+1. **События потока**:
+   - `meta` — `{"local_score": {...}}`, отправляется сразу, до обращения к провайдеру (раздел 13).
+   - `delta` — `{"text": "..."}`, очередной фрагмент отчёта.
+   - `done` — `{"cached": false, "usage": {...}}`, поток завершён, токены списаны.
+   - `error` — `{"error": "...", "status": 503}`, ошибка провайдера после начала потока. Ошибки до начала потока (лимит токенов, авторизация) возвращаются обычным JSON ответом.
+   - SSE: `event: delta\ndata: {"text": "..."}\n\n`. NDJSON: `{"event": "delta", "text": "..."}`.
+2. **Источник фрагментов**:
+   - Отчёт локальной оценки (раздел 13) и отчёт из кэша (раздел 6) передаются одним событием `delta` без обращения к провайдеру.
+   - OpenAI: `stream=True` с `stream_options={'include_usage': True}`, расход приходит последним событием.
+   - Gemini: `generate_content_stream`, расход берётся из `usage_metadata` последнего фрагмента.
+   - Адаптеры без потокового API (например, `fake`) и режим сравнения по фрагментам (раздел 12) выдают отчёт одним событием `delta`: частичные отчёты нельзя передать до их объединения.
+3. **Устойчивость** (`stream_llm_report`):
+   - Выключатель, резервная модель и лимиты провайдера работают как в разделе 15: резервная модель вызывается и при разомкнутом выключателе основной, и после исчерпания её повторов, пока клиенту не отправлен ни один фрагмент (`usage.fallback_used`).
+   - Временные ошибки повторяются только до получения первого фрагмента. После начала выдачи повтор невозможен, ошибка передаётся событием `error`.
+   - Хеджирование в потоковом режиме не используется.
+4. **Завершение и разрыв соединения**:
+   - Когда клиент закрывает соединение, Django закрывает генератор ответа, поток провайдера закрывается и генерация прекращается.
+   - Если провайдер не успел прислать итоговый расход, входные токены оцениваются по промпту, выходные — по уже выданному тексту.
+   - События выдаёт `ComparisonEventStream`. Резерв корректируется один раз и при нормальном завершении, и при ошибке, и при разрыве. Если клиент отключился до первого события, резерв корректирует `close()` ответа: `finally` не начатого генератора не выполняется.
+   - В кэш результатов попадает только полностью полученный отчёт основной модели TypeID.
+   - Слот одновременных запросов ключа (раздел 14) освобождается после окончания потока.
+   - Заголовок `X-Accel-Buffering: no` отключает буферизацию ответа в nginx.
+
+#### Пример реализации:
+```python
+import json
+import time
+from contextlib import closing
+
+from django.http import JsonResponse, StreamingHttpResponse
+
+
+def _sse_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _ndjson_event(name, data):
+    return json.dumps({'event': name, **data}, ensure_ascii=False) + '\n'
+
+
+def _open_stream(reference, compare_text, typeid, llm_api_key, prompt_tokens, permit):
+    """Открытие потока одной модели с повторами временных ошибок до первого фрагмента.
+
+    Возвращает (фрагменты, первый фрагмент, расход вызова); permit выключателя возвращается при любом выходе.
+    """
+    policy = resilience_policy(typeid.llm)
+    provider = get_provider(typeid.llm, llm_api_key)
+    breaker = get_breaker(typeid.llm, typeid.model)
+    deadline = time.monotonic() + policy['deadline']
+    call_usage = LLMUsage()
+    attempt = 0
+    try:
+        while True:
+            acquire_provider_capacity(typeid, prompt_tokens)
+            timeout = max(0.0, min(deadline - time.monotonic(), provider.timeout))
+            deltas = provider.stream(reference, compare_text, typeid, call_usage, timeout=timeout)
+            try:
+                first = next(deltas, None)
+            except Exception as e:
+                deltas.close()
+                record_provider_error(typeid, e)
+                if not is_transient(e):
+                    breaker.record_success()
+                    raise LLMError(str(e)) from e
+                breaker.record_failure()
+                delay = retry_delay(e, attempt, policy)
+                if attempt == policy['max_retries'] or time.monotonic() + delay >= deadline:
+                    raise ProviderUnavailable(f"LLM provider unavailable: {e}") from e
+                permit = breaker.allow()
+                if not permit:
+                    raise ProviderUnavailable(f"LLM provider unavailable: {e}") from e
+                attempt += 1
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            return deltas, first, call_usage
+    finally:
+        # Как в _call_with_retries: проба без результата (например, RateLimited) освобождается
+        breaker.release(permit)
+
+
+def stream_llm_report(reference, compare_text, typeid, llm_api_key, usage):
+    """Потоковый запрос отчёта: генератор фрагментов текста, расход добавляется в usage по завершении.
+
+    Временные ошибки повторяются только до первого фрагмента, дальше повтор невозможен. Резервная
+    модель TypeID используется так же, как в call_provider: при разомкнутом выключателе или после
+    исчерпания повторов основной модели, пока клиенту не отправлен ни один фрагмент.
+    """
+    prompt_tokens = reference.prefix_tokens + count_tokens(typeid.user + compare_text, typeid.model)
+    fallback = _fallback_typeid(typeid)
+    opened = None
+    permit = get_breaker(typeid.llm, typeid.model).allow()
+    if permit:
+        try:
+            opened = _open_stream(reference, compare_text, typeid, llm_api_key, prompt_tokens, permit)
+        except ProviderUnavailable:
+            if fallback is None:
+                raise
+    elif fallback is None:
+        raise ProviderUnavailable(f"LLM provider {typeid.llm}/{typeid.model} is temporarily unavailable")
+
+    if opened is None:
+        fallback_permit = get_breaker(fallback.llm, fallback.model).allow()
+        if not fallback_permit:
+            raise ProviderUnavailable(f"LLM provider {typeid.llm}/{typeid.model} and its fallback are unavailable")
+        fallback_key = _fallback_api_key(typeid, fallback, llm_api_key)
+        opened = _open_stream(reference, compare_text, fallback, fallback_key, prompt_tokens, fallback_permit)
+        typeid = fallback
+        usage.fallback_used = True
+    deltas, first, call_usage = opened
+
+    emitted = []
+    try:
+        if first is not None:
+            emitted.append(first)
+            yield first
+        for delta in deltas:
+            emitted.append(delta)
+            yield delta
+    except Exception as e:
+        raise LLMError(f"LLM stream interrupted: {e}") from e
+    finally:
+        # Выполняется и при закрытии генератора клиентом (GeneratorExit на yield)
+        deltas.close()
+        if not call_usage.total_tokens and emitted:
+            # Итоговый расход не получен: оплачиваются отправленный промпт и уже выданная часть отчёта
+            call_usage = LLMUsage(input_tokens=prompt_tokens, output_tokens=count_tokens(''.join(emitted), typeid.model))
+        usage.add(call_usage)
+
+
+class ComparisonEventStream:
+    """События потокового сравнения.
+
+    Резерв токенов корректируется и сравнение журналируется ровно один раз: по завершении
+    итерации или в close(), который Django вызывает и для ответа, не прочитанного клиентом.
+    """
+
+    def __init__(self, encode, api_key_obj, reference, compare_text, typeid, score, report, cache_key, reserved):
+        self.encode = encode
+        self.api_key_obj = api_key_obj
+        self.reference = reference
+        self.compare_text = compare_text
+        self.typeid = typeid
+        self.score = score
+        self.report = report
+        self.cache_key = cache_key
+        self.reserved = reserved
+        self.usage = LLMUsage()
+        # 'interrupted' остаётся, если клиент разорвал соединение до окончания потока
+        self.error = 'interrupted'
+        self._started = time.monotonic()
+        self._finished = False
+        self._events = self._iter_events()
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        # Как в BatchResultStream: не начатый генератор finally не выполняет
+        self._events.close()
+        self._finish()
+
+    def _finish(self):
+        if self._finished or self.report is not None:
+            return
+        self._finished = True
+        settle_token_usage(self.api_key_obj.key, self.reserved, self.usage)
+        log_comparison(self.api_key_obj, self._started, self.usage, error=self.error)
+
+    def _iter_events(self):
+        encode, api_key_obj, typeid = self.encode, self.api_key_obj, self.typeid
+        yield encode('meta', {'local_score': self.score.as_dict()})
+        if self.report is not None:
+            # Отчёт локальной оценки или из кэша: провайдер не вызывается, токены не резервировались
+            cached = self.cache_key is not None
+            log_comparison(api_key_obj, self._started, cache_hit=cached, verdict=self.score.verdict)
+            yield encode('delta', {'text': self.report})
+            yield encode('done', {'cached': cached, 'usage': LLMUsage().as_dict()})
+            return
+
+        parts = []
+        try:
+            if typeid.chunking != 'none':
+                # Отчёты фрагментов объединяются до отправки, поэтому отчёт выдаётся одним событием
+                parts.append(run_comparison(self.reference, self.compare_text, typeid, api_key_obj.llm_api_key, self.usage))
+                yield encode('delta', {'text': parts[0]})
+            else:
+                deltas = stream_llm_report(self.reference, self.compare_text, typeid, api_key_obj.llm_api_key, self.usage)
+                with closing(deltas):
+                    for delta in deltas:
+                        parts.append(delta)
+                        yield encode('delta', {'text': delta})
+            self.error = None
+        except (LLMError, RateLimited) as e:
+            self.error = type(e).__name__
+            yield encode('error', {'error': str(e), 'status': getattr(e, 'status', 429)})
+            return
+        finally:
+            self._finish()
+
+        if not self.usage.fallback_used:
+            get_comparison_cache().set(self.cache_key, ''.join(parts), typeid)
+        yield encode('done', {'cached': False, 'usage': self.usage.as_dict()})
+
+
+def stream_compare_response(request, api_key_obj, reference, compare_text, typeid):
+    """Потоковый ответ сравнения: SSE при Accept: text/event-stream, иначе NDJSON."""
+    score = local_similarity(reference.signature, compare_text)
+    report, cache_key, reserved = prefilter_report(score, typeid), None, 0
+    if report is None:
+        cache_key = get_comparison_cache().make_key(reference, compare_text, typeid)
+        report = get_comparison_cache().get(cache_key)
+        if report is None:
+            reserved = estimate_request_tokens(reference, compare_text, typeid)
+            if not update_token_usage(api_key_obj.key, cost=reserved):
+                return JsonResponse({'error': 'Token limit reached. Subscription renewal required.'}, status=429)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        encode, content_type = _sse_event, 'text/event-stream'
+    else:
+        encode, content_type = _ndjson_event, 'application/x-ndjson'
+    events = ComparisonEventStream(encode, api_key_obj, reference, compare_text, typeid, score, report, cache_key, reserved)
+    response = StreamingHttpResponse(events, content_type=content_type)
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+```
+
+##### Тесты:
+```python
+@override_settings(LLM_RESILIENCE=FAST_RETRIES, LLM_PROVIDER_LIMITS={}, LLM_PROVIDERS={'fake': {}})
+class StreamLLMReportTest(SimpleTestCase):
+    def setUp(self):
+        _breakers.clear()
+        self.reference = ReferencePrompt(prefix='Эталон: текст', prefix_tokens=4, digest='a' * 64)
+        self.typeid = SimpleNamespace(system='Эталон: ', user='Работа: ', llm='fake', model='primary')
+
+    def test_usage_reported_at_stream_end(self):
+        usage = LLMUsage()
+        deltas = list(stream_llm_report(self.reference, 'работа', self.typeid, 'stream', usage))
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual(''.join(deltas), 'fake report from primary')
+        self.assertEqual(usage.output_tokens, 5)
+
+    def test_client_disconnect_bills_emitted_part(self):
+        usage = LLMUsage()
+        deltas = stream_llm_report(self.reference, 'работа', self.typeid, 'stream', usage)
+        next(deltas)
+        deltas.close()  # разрыв соединения клиентом
+        self.assertEqual(usage.input_tokens, self.reference.prefix_tokens + count_tokens('Работа: работа', 'primary'))
+        self.assertEqual(usage.output_tokens, count_tokens('fake ', 'primary'))
+
+    def test_exhausted_retries_use_fallback_model(self):
+        with override_settings(LLM_PROVIDERS={'fake': {'fail_first': 3, 'error_status': 503}}):
+            get_provider('fake', 'stream-fallback')
+        typeid = SimpleNamespace(**vars(self.typeid), fallback_llm='', fallback_model='backup')
+        usage = LLMUsage()
+        # Три ошибки до первого фрагмента размыкают выключатель primary, поток открывает резервная модель
+        deltas = list(stream_llm_report(self.reference, 'работа', typeid, 'stream-fallback', usage))
+        self.assertEqual(''.join(deltas), 'fake report from backup')
+        self.assertTrue(usage.fallback_used)
+
+    @override_settings(LLM_PROVIDER_LIMITS={'fake': {'stream-half-open': {'rpm': 1}}}, PROVIDER_LIMIT_MAX_WAIT=0)
+    def test_rate_limited_trial_releases_half_open_breaker(self):
+        typeid = SimpleNamespace(**{**vars(self.typeid), 'model': 'stream-half-open'})
+        breaker = get_breaker('fake', 'stream-half-open')
+        breaker._opened_at = time.monotonic() - 60
+        get_limiter().take('provider:fake:stream-half-open:rpm', 1 / 60, 1)
+        with self.assertRaises(RateLimited):
+            list(stream_llm_report(self.reference, 'работа', typeid, 'stream', LLMUsage()))
+        self.assertTrue(breaker.allow())
+
+
+class ComparisonEventStreamTest(TestCase):
+    def test_close_before_first_event_returns_reservation(self):
+        user = User.objects.create(username='tester')
+        typeid = TypeID.objects.create(scale='1', system='Эталон: ', user='Работа: ', model='primary', llm='fake')
+        api_key = APIKey.objects.create(
+            user=user, key='test-key', secret_key='secret', typeid=typeid,
+            llm_api_key='stream', tokens_remaining=1000, status='active',
+        )
+        reference = ReferencePrompt(prefix='Эталон: текст', prefix_tokens=4, digest='a' * 64)
+        self.assertTrue(update_token_usage(api_key.key, cost=100))
+        events = ComparisonEventStream(
+            _ndjson_event, api_key, reference, 'работа', typeid, LocalScore(0.5, 0.5), None, 'key', 100,
+        )
+        events.close()  # клиент отключился до первого события
+        api_key.refresh_from_db()
+        self.assertEqual(api_key.tokens_remaining, 1000)
+```
+
+### 17. Журнал действий (Logs)
+
+#### Бизнес требования:
+- **Запись без задержки запроса**: Таблица Logs хранит действия по каждому API ключу: авторизацию, загрузку эталонов и сравнения. Синхронный `INSERT` в каждом запросе добавлял бы обращение к базе на каждый горячий путь. События ставятся в очередь в памяти процесса и записываются пакетами в фоновом потоке.
+- **Ограниченная очередь**: Очередь имеет предельный размер. При переполнении событие отбрасывается (`drop`, по умолчанию) либо запрос ждёт освобождения места не дольше `BLOCK_TIMEOUT` (`block`). Число отброшенных событий учитывается.
+- **Запись пакетами**: Пакет записывается одной командой `COPY` (PostgreSQL с psycopg 3) или `bulk_create` (остальные случаи), когда набрано `BATCH_SIZE` событий или прошло `FLUSH_INTERVAL` секунд.
+- **Завершение процесса**: При остановке воркера оставшиеся в очереди события записываются (`atexit`).
+- **Компактные записи**: В `details` попадают только идентификаторы и числа (задержка, токены, признак попадания в кэш, вердикт локальной оценки, тип ошибки). Тексты, отчёты и ключи не журналируются.
+- **Секционирование и хранение**: Таблица секционирована по месяцам (декларативное секционирование PostgreSQL). Секции создаются заранее, секции старше `RETENTION_MONTHS` удаляются целиком, без `DELETE`. Запросы за период читают только нужные секции.
+
+#### Описание работы функций:
+1. **`log_event(api_key_id, action, **details)`** ставит событие в очередь и сразу возвращает управление. Фоновый поток запускается при первом событии. Вызывается из `handle_auth_request` (`auth`) и `UploadReferenceTextView` (`reference_upload`).
+2. **`log_comparison`** — событие `compare` с задержкой и расходом токенов. Вызывается из `compare_texts_llm`, из ветки локальной оценки (раздел 13), для каждого документа пакета (раздел 8) и в конце потокового сравнения (раздел 16).
+3. **`LogWriter`** — поток-писатель: собирает пакет из очереди, записывает его, ошибки записи журналирует через `logging`, не прерывая работу.
+4. **Секции**:
+   - Миграция создаёт таблицу вместе с секциями текущего и следующего месяца, поэтому до первого запуска команды строки не попадают в `api_log_default`.
+   - `ensure_log_partitions` создаёт секции текущего и следующих месяцев, а также секции всех месяцев, строки которых оказались в `api_log_default`.
+   - PostgreSQL не создаёт секцию, если в секции DEFAULT есть строки её диапазона. Поэтому для такого месяца в одной транзакции секция DEFAULT отсоединяется, создаётся месячная секция, строки месяца переносятся в неё и удаляются из DEFAULT, после чего DEFAULT присоединяется обратно. Запись журнала на это время ждёт блокировки.
+   - `drop_expired_log_partitions` отсоединяет и удаляет секции старше срока хранения. Строки, попавшие в DEFAULT, к этому моменту уже перенесены в месячные секции и удаляются вместе с ними.
+   - Обе функции выполняет команда `manage.py log_partitions`, запускаемая по расписанию раз в сутки.
+   - Секция `api_log_default` принимает строки вне созданных диапазонов, чтобы запись журнала никогда не завершалась ошибкой.
+5. **Внешние ключи**: у таблицы нет ограничения внешнего ключа на APIKeys. Записи журнала удалённых ключей хранятся до истечения срока хранения, а запись пакетов не ждёт проверок ссылочной целостности.
+
+#### Настройки:
+```python
+AUDIT_LOG = {
+    'MAX_QUEUE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,   # секунды
+    'OVERFLOW': 'drop',      # или 'block'
+    'BLOCK_TIMEOUT': 0.05,   # секунды ожидания места в очереди при OVERFLOW = 'block'
+    'RETENTION_MONTHS': 6,
+}
+```
+
+#### Пример реализации:
+```python
+import atexit
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import close_old_connections, connection, models, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class Log(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    # Без ограничения внешнего ключа: журнал удалённых ключей хранится до истечения срока
+    api_key = models.ForeignKey('APIKey', on_delete=models.DO_NOTHING, db_constraint=False)
+    action = models.CharField(max_length=50)
+    timestamp = models.DateTimeField()
+    details = models.JSONField(default=dict)
+
+    class Meta:
+        managed = False  # таблица секционирована, создаётся миграцией ниже
+        db_table = 'api_log'
+
+
+class LogWriter:
+    """Фоновая пакетная запись событий журнала из ограниченной очереди."""
+
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=1.0, overflow='drop', block_timeout=0.05):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        if self._thread is None:
+            self._start()
+        try:
+            if self.overflow == 'block':
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._drain()
+            if batch:
+                self._write(batch)
+
+    def _drain(self):
+        """Пакет из очереди: до batch_size событий или всё, что пришло за flush_interval."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with transaction.atomic():
+                write_log_batch(batch)
+                # Агрегаты биллинга обновляются тем же пакетом (раздел 18)
+                update_usage_rollups(batch)
+        except Exception:
+            # Сбой записи журнала не должен влиять на обработку запросов
+            logger.exception("Failed to write %d audit log events", len(batch))
+        finally:
+            close_old_connections()
+
+    def stop(self, timeout=10):
+        """Запись оставшихся событий при остановке процесса."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    global _log_writer
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                options = getattr(settings, 'AUDIT_LOG', {})
+                _log_writer = LogWriter(
+                    max_queue=options.get('MAX_QUEUE', 10000),
+                    batch_size=options.get('BATCH_SIZE', 500),
+                    flush_interval=options.get('FLUSH_INTERVAL', 1.0),
+                    overflow=options.get('OVERFLOW', 'drop'),
+                    block_timeout=options.get('BLOCK_TIMEOUT', 0.05),
+                )
+    return _log_writer
+
+
+def log_event(api_key_id, action, **details):
+    """Постановка события в очередь журнала; запись выполняется фоновым потоком."""
+    get_log_writer().put((api_key_id, action, timezone.now(), details))
+
+
+def log_comparison(api_key_obj, started, usage=None, cache_hit=False, verdict=None, error=None):
+    """Событие сравнения: задержка и расход токенов; пустые поля не записываются."""
+    details = {'latency_ms': int((time.monotonic() - started) * 1000)}
+    if usage is not None and usage.total_tokens:
+        details.update(usage.as_dict())
+    typeid = api_key_obj.typeid
+    if usage is not None and usage.fallback_used:
+        details['fallback'] = True
+        fallback = _fallback_typeid(typeid)
+        if fallback is not None:
+            # Токены израсходовала резервная модель: метки llm и model — её, как у участка provider_call
+            typeid = SimpleNamespace(pk=typeid.pk, llm=fallback.llm, model=fallback.model)
+    if cache_hit:
+        details['cache_hit'] = True
+    if verdict:
+        details['verdict'] = verdict
+    if error:
+        details['error'] = error
+    # Счётчики Prometheus (раздел 19) обновляются по тем же событиям, что и журнал
+    record_comparison(typeid, usage, cache_hit, verdict, error)
+    log_event(api_key_obj.pk, 'compare', **details)
+
+
+def write_log_batch(batch):
+    """Запись пакета событий одной командой COPY или bulk_create."""
+    if connection.vendor == 'postgresql' and connection.features.is_psycopg3:
+        with connection.cursor() as cursor:
+            with cursor.copy("COPY api_log (api_key_id, action, timestamp, details) FROM STDIN") as copy:
+                for api_key_id, action, timestamp, details in batch:
+                    copy.write_row((api_key_id, action, timestamp, json.dumps(details)))
+        return
+    Log.objects.bulk_create([
+        Log(api_key_id=api_key_id, action=action, timestamp=timestamp, details=details)
+        for api_key_id, action, timestamp, details in batch
+    ])
+```
+
+##### Миграция и обслуживание секций:
+```python
+# api/migrations/00xx_log.py
+import datetime
+
+from django.db import migrations, models
+
+CREATE_PARTITIONED_LOG = """
+CREATE TABLE api_log (
+    id bigint GENERATED BY DEFAULT AS IDENTITY,
+    api_key_id bigint NOT NULL,
+    action varchar(50) NOT NULL,
+    timestamp timestamptz NOT NULL,
+    details jsonb NOT NULL DEFAULT '{}',
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+CREATE INDEX api_log_key_timestamp ON api_log (api_key_id, timestamp);
+CREATE TABLE api_log_default PARTITION OF api_log DEFAULT;
+"""
+
+
+def create_log_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_PARTITIONED_LOG)
+        # Секции текущего и следующего месяца: до первого запуска log_partitions строки не идут в DEFAULT
+        month = datetime.date.today().replace(day=1)
+        for _ in range(2):
+            following = (month + datetime.timedelta(days=32)).replace(day=1)
+            schema_editor.execute(
+                f"CREATE TABLE api_log_{month:%Y_%m} PARTITION OF api_log "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+            )
+            month = following
+    else:
+        # SQLite и другие базы разработки: обычная таблица без секций
+        schema_editor.create_model(apps.get_model('api', 'Log'))
+
+
+def drop_log_table(apps, schema_editor):
+    schema_editor.execute('DROP TABLE api_log')
+
+
+class Migration(migrations.Migration):
+    dependencies = [('api', '00xx_previous')]
+    operations = [
+        migrations.CreateModel(
+            name='Log',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True)),
+                ('api_key', models.ForeignKey('api.APIKey', on_delete=models.DO_NOTHING, db_constraint=False)),
+                ('action', models.CharField(max_length=50)),
+                ('timestamp', models.DateTimeField()),
+                ('details', models.JSONField(default=dict)),
+            ],
+            options={'managed': False, 'db_table': 'api_log'},
+        ),
+        migrations.RunPython(create_log_table, drop_log_table),
+    ]
+```
+
+```python
+import re
+
+LOG_PARTITION_RE = re.compile(r'^api_log_(\d{4})_(\d{2})$')
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def _log_partitions(cursor):
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'api_log'"
+    )
+    return [name for (name,) in cursor.fetchall()]
+
+
+def _create_log_partition(cursor, lower):
+    """Создание секции месяца; строки этого месяца из секции DEFAULT переносятся в неё."""
+    upper = _add_months(lower, 1)
+    create = (
+        f"CREATE TABLE api_log_{lower:%Y_%m} PARTITION OF api_log "
+        f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+    )
+    with transaction.atomic():
+        # Запись журнала ждёт до конца транзакции, новые строки месяца не попадут в DEFAULT после проверки
+        cursor.execute("LOCK TABLE api_log IN SHARE ROW EXCLUSIVE MODE")
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM api_log_default WHERE timestamp >= %s AND timestamp < %s)",
+            [lower, upper],
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(create)
+            return
+        # PostgreSQL отказывается создать секцию, пока строки её диапазона лежат в DEFAULT
+        cursor.execute("ALTER TABLE api_log DETACH PARTITION api_log_default")
+        cursor.execute(create)
+        cursor.execute(
+            "INSERT INTO api_log (id, api_key_id, action, timestamp, details) "
+            "SELECT id, api_key_id, action, timestamp, details FROM api_log_default "
+            "WHERE timestamp >= %s AND timestamp < %s",
+            [lower, upper],
+        )
+        cursor.execute("DELETE FROM api_log_default WHERE timestamp >= %s AND timestamp < %s", [lower, upper])
+        cursor.execute("ALTER TABLE api_log ATTACH PARTITION api_log_default DEFAULT")
+
+
+def ensure_log_partitions(months_ahead=2):
+    """Создание месячных секций журнала для текущего и следующих месяцев и для строк, попавших в DEFAULT."""
+    start = timezone.now().date().replace(day=1)
+    months = {_add_months(start, offset) for offset in range(months_ahead + 1)}
+    with connection.cursor() as cursor:
+        existing = set(_log_partitions(cursor))
+        cursor.execute("SELECT DISTINCT date_trunc('month', timestamp)::date FROM api_log_default")
+        months.update(month for (month,) in cursor.fetchall())
+        for lower in sorted(months):
+            if f"api_log_{lower:%Y_%m}" not in existing:
+                _create_log_partition(cursor, lower)
+
+
+def drop_expired_log_partitions(retention_months):
+    """Удаление секций, все строки которых старше срока хранения."""
+    cutoff = _add_months(timezone.now().date().replace(day=1), -retention_months)
+    with connection.cursor() as cursor:
+        for name in _log_partitions(cursor):
+            match = LOG_PARTITION_RE.match(name)
+            if match and _add_months(datetime.date(int(match[1]), int(match[2]), 1), 1) <= cutoff:
+                cursor.execute(f"ALTER TABLE api_log DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+```
+
+```python
+# api/management/commands/log_partitions.py
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = "Создание секций журнала на следующие месяцы, удаление секций и часовых агрегатов старше срока хранения"
+
+    def handle(self, *args, **options):
+        ensure_log_partitions()
+        drop_expired_log_partitions(getattr(settings, 'AUDIT_LOG', {}).get('RETENTION_MONTHS', 6))
+        # Часовые агрегаты биллинга (раздел 18); суточные хранятся бессрочно
+        days = getattr(settings, 'USAGE_ROLLUPS', {}).get('HOURLY_RETENTION_DAYS', 90)
+        UsageHourly.objects.filter(period_start__lt=timezone.now() - datetime.timedelta(days=days)).delete()
+```
+
+##### Тесты:
+```python
+import threading
+import time
+
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+
+class RecordingLogWriter(LogWriter):
+    """Писатель без базы: пакеты сохраняются в списке, запись можно задержать."""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.batches = []
+        self.writing = threading.Event()
+        self.written_batch = threading.Event()  # устанавливается после сохранения пакета
+        self.resume = threading.Event()
+        self.resume.set()
+
+    def _write(self, batch):
+        self.writing.set()
+        self.resume.wait(5)
+        self.batches.append(batch)
+        self.written_batch.set()
+
+    def written(self):
+        return [event for batch in self.batches for event in batch]
+
+
+class LogWriterTest(SimpleTestCase):
+    def stalled_writer(self, **options):
+        """Писатель, поток которого занят записью первого события, а очередь пуста."""
+        writer = RecordingLogWriter(batch_size=1, **options)
+        writer.resume.clear()
+        writer.put('first')
+        self.assertTrue(writer.writing.wait(5))
+        self.addCleanup(writer.stop)
+        self.addCleanup(writer.resume.set)
+        return writer
+
+    def test_full_queue_drops_events(self):
+        writer = self.stalled_writer(max_queue=2)
+        for event in ('second', 'third', 'fourth', 'fifth'):
+            writer.put(event)
+        self.assertEqual(writer.dropped, 2)
+        writer.resume.set()
+        writer.stop()
+        self.assertEqual(writer.written(), ['first', 'second', 'third'])
+
+    def test_block_overflow_waits_for_timeout(self):
+        writer = self.stalled_writer(max_queue=1, overflow='block', block_timeout=0.05)
+        writer.put('second')
+        started = time.monotonic()
+        writer.put('third')
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(writer.dropped, 1)
+
+    def test_batch_size_limits_batches(self):
+        writer = RecordingLogWriter(batch_size=3, flush_interval=0.5)
+        for number in range(7):
+            writer.put(number)
+        writer.stop()
+        self.assertEqual(writer.written(), list(range(7)))
+        self.assertLessEqual(max(len(batch) for batch in writer.batches), 3)
+
+    def test_partial_batch_written_after_flush_interval(self):
+        writer = RecordingLogWriter(batch_size=100, flush_interval=0.05)
+        self.addCleanup(writer.stop)
+        writer.put('only')
+        # Пакет не набран, но запись выполняется по истечении flush_interval, без остановки писателя
+        self.assertTrue(writer.written_batch.wait(1))
+        self.assertEqual(writer.batches, [['only']])
+
+    def test_stop_flushes_queue(self):
+        writer = RecordingLogWriter(batch_size=2, flush_interval=0.2)
+        for number in range(5):
+            writer.put(number)
+        writer.stop()
+        self.assertEqual(writer.written(), list(range(5)))
+
+
+class WriteLogBatchTest(TestCase):
+    def test_bulk_create_round_trip(self):
+        now = timezone.now()
+        batch = [(1, 'auth', now, {'username': 'tester'}), (2, 'compare', now, {'latency_ms': 12, 'cache_hit': True})]
+        write_log_batch(batch)
+        rows = Log.objects.order_by('api_key_id').values_list('api_key_id', 'action', 'timestamp', 'details')
+        self.assertEqual(list(rows), batch)
+```
+
+### 18. Биллинг и агрегаты использования
+
+#### Бизнес требования:
+- **Быстрые ответы биллинга**: `GET /api/v1/billing/{api_key}` опрашивается панелями мониторинга постоянно. Ответ не должен требовать просмотра журнала запросов или чтения строк APIKey.
+- **Агрегаты по часам и суткам**: Для каждого ключа хранятся суммы за час (`UsageHourly`) и за сутки (`UsageDaily`): число сравнений, ошибок и попаданий в кэш, входные (в том числе закэшированные провайдером) и выходные токены, суммарная и максимальная задержка.
+- **Инкрементальное обновление пакетами**: Агрегаты обновляются тем же фоновым потоком, что пишет журнал (раздел 17), в одной транзакции с пакетом событий. Каждой паре (ключ, период) соответствует один `UPSERT` с прибавлением сумм. Запрос сравнения не выполняет дополнительных обращений к базе.
+- **Условные запросы**: Ответ содержит `ETag`. Если данные не изменились, клиент с `If-None-Match` получает `304 Not Modified` без выборки строк агрегатов и без формирования тела.
+
+#### Описание работы функций:
+1. **`aggregate_usage(batch)`** суммирует события `compare` пакета журнала в памяти по (ключ, начало часа) и (ключ, начало суток). Границы периодов считаются в UTC.
+2. **`upsert_usage_rollups(model, rows)`** записывает суммы командой `INSERT ... ON CONFLICT (api_key_id, period_start) DO UPDATE`: счётчики прибавляются, максимум задержки берётся наибольший. Строки упорядочены по ключу и периоду, поэтому писатели журнала разных воркеров не блокируют друг друга взаимно. Записи одновременных пакетов складываются и не теряются.
+3. **`update_usage_rollups(batch)`** вызывается из `LogWriter._write` после `write_log_batch` в той же транзакции: при ошибке не записываются ни журнал, ни агрегаты.
+4. **`BillingView`**:
+   - Параметры запроса: `period` (`day` по умолчанию или `hour`), `from` и `to` (даты ISO 8601, включительно). По умолчанию возвращаются последние 30 суток или 48 часов.
+   - Ключ из пути должен совпадать с ключом токена, иначе 403. Владелец берётся из `key_id` токена, APIKey не загружается.
+   - `billing_etag` одним агрегирующим запросом по индексу `(api_key_id, period_start)` получает число строк и время последнего обновления в диапазоне. Проверку `If-None-Match` выполняет декоратор Django `condition`.
+   - Тело ответа: строки за период и итоги по ним. Средняя задержка вычисляется из суммы и числа сравнений.
+5. **Задержка данных**: Агрегаты отстают от запросов не больше чем на `AUDIT_LOG['FLUSH_INTERVAL']`. События, отброшенные при переполнении очереди журнала, в агрегаты не попадают. Для списания токенов по-прежнему используется `tokens_remaining` (раздел 4), агрегаты служат только для отчётов.
+6. **Заполнение и хранение**:
+   - `manage.py rebuild_usage_rollups --from ... --to ...` пересчитывает агрегаты закрытых суток по таблице Logs, например после включения агрегатов на существующей истории.
+   - Пересчитываются только сутки, за которые в Logs есть строки. Секции журнала удаляются через `RETENTION_MONTHS`, а суточные агрегаты хранятся бессрочно, поэтому агрегаты суток без журнала остаются как есть и не стираются пересчётом.
+   - Часовые агрегаты старше `USAGE_ROLLUPS['HOURLY_RETENTION_DAYS']` удаляются командой `log_partitions` (раздел 17). Суточные хранятся бессрочно.
+
+#### Настройки:
+```python
+USAGE_ROLLUPS = {
+    'HOURLY_RETENTION_DAYS': 90,
+    'DEFAULT_DAYS': 30,    # диапазон ответа биллинга по умолчанию для period=day
+    'DEFAULT_HOURS': 48,   # диапазон ответа биллинга по умолчанию для period=hour
+}
+```
+
+#### Пример реализации:
+```python
+from django.db import models
+
+
+class UsageRollup(models.Model):
+    """Суммы событий compare ключа за период."""
+    # Без ограничения внешнего ключа, как у Logs: агрегаты удалённых ключей остаются для отчётов
+    api_key = models.ForeignKey('APIKey', on_delete=models.DO_NOTHING, db_constraint=False)
+    period_start = models.DateTimeField()
+    requests = models.BigIntegerField(default=0)
+    errors = models.BigIntegerField(default=0)
+    cache_hits = models.BigIntegerField(default=0)
+    input_tokens = models.BigIntegerField(default=0)
+    cached_input_tokens = models.BigIntegerField(default=0)
+    output_tokens = models.BigIntegerField(default=0)
+    latency_ms_sum = models.BigIntegerField(default=0)
+    latency_ms_max = models.IntegerField(default=0)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        abstract = True
+        unique_together = [('api_key', 'period_start')]
+
+
+class UsageHourly(UsageRollup):
+    class Meta(UsageRollup.Meta):
+        db_table = 'api_usage_hourly'
+
+
+class UsageDaily(UsageRollup):
+    class Meta(UsageRollup.Meta):
+        db_table = 'api_usage_daily'
+```
+
+```python
+from django.db import connection
+from django.utils import timezone
+
+ROLLUP_SUMS = (
+    'requests', 'errors', 'cache_hits',
+    'input_tokens', 'cached_input_tokens', 'output_tokens', 'latency_ms_sum',
+)
+ROLLUP_COLUMNS = ('api_key_id', 'period_start') + ROLLUP_SUMS + ('latency_ms_max', 'updated_at')
+
+
+def aggregate_usage(batch):
+    """Суммы событий compare пакета журнала по (ключ, час) и (ключ, сутки)."""
+    hourly, daily = {}, {}
+    for api_key_id, action, timestamp, details in batch:
+        if action != 'compare':
+            continue
+        hour = timestamp.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+        latency = details.get('latency_ms', 0)
+        for rows, start in ((hourly, hour), (daily, hour.replace(hour=0))):
+            row = rows.get((api_key_id, start))
+            if row is None:
+                row = rows[(api_key_id, start)] = dict.fromkeys(ROLLUP_SUMS + ('latency_ms_max',), 0)
+            row['requests'] += 1
+            row['errors'] += 'error' in details
+            row['cache_hits'] += bool(details.get('cache_hit'))
+            row['input_tokens'] += details.get('input_tokens', 0)
+            row['cached_input_tokens'] += details.get('cached_input_tokens', 0)
+            row['output_tokens'] += details.get('output_tokens', 0)
+            row['latency_ms_sum'] += latency
+            row['latency_ms_max'] = max(row['latency_ms_max'], latency)
+    return hourly, daily
+
+
+def upsert_usage_rollups(model, rows):
+    """Прибавление сумм к агрегатам одним UPSERT на строку, без чтения в Python."""
+    if not rows:
+        return
+    # GREATEST в PostgreSQL, скалярный MAX в SQLite (базы разработки)
+    greatest = 'GREATEST' if connection.vendor == 'postgresql' else 'MAX'
+    increments = ', '.join(f"{name} = t.{name} + EXCLUDED.{name}" for name in ROLLUP_SUMS)
+    sql = (
+        f"INSERT INTO {model._meta.db_table} AS t ({', '.join(ROLLUP_COLUMNS)}) "
+        f"VALUES ({', '.join(['%s'] * len(ROLLUP_COLUMNS))}) "
+        f"ON CONFLICT (api_key_id, period_start) DO UPDATE SET {increments}, "
+        f"latency_ms_max = {greatest}(t.latency_ms_max, EXCLUDED.latency_ms_max), "
+        f"updated_at = EXCLUDED.updated_at"
+    )
+    adapt = connection.ops.adapt_datetimefield_value
+    now = adapt(timezone.now())
+    # Одинаковый порядок строк во всех воркерах исключает взаимные блокировки
+    params = [
+        (api_key_id, adapt(start), *(row[name] for name in ROLLUP_SUMS), row['latency_ms_max'], now)
+        for (api_key_id, start), row in sorted(rows.items())
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def update_usage_rollups(batch):
+    """Обновление часовых и суточных агрегатов по пакету журнала; вызывается из LogWriter._write."""
+    hourly, daily = aggregate_usage(batch)
+    upsert_usage_rollups(UsageHourly, hourly)
+    upsert_usage_rollups(UsageDaily, daily)
+```
+
+##### Эндпоинт биллинга:
+```python
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.http import condition
+
+BILLING_PERIODS = {'hour': UsageHourly, 'day': UsageDaily}
+
+
+class BillingRangeError(ValueError):
+    pass
+
+
+def billing_range(request):
+    """Модель агрегатов и границы [start, end) из параметров period, from и to."""
+    period = request.GET.get('period', 'day')
+    if period not in BILLING_PERIODS:
+        raise BillingRangeError("period must be 'hour' or 'day'")
+    options = getattr(settings, 'USAGE_ROLLUPS', {})
+    try:
+        end = request.GET.get('to')
+        end = datetime.date.fromisoformat(end) + datetime.timedelta(days=1) if end else None
+        start = request.GET.get('from')
+        start = datetime.date.fromisoformat(start) if start else None
+    except ValueError:
+        raise BillingRangeError('from and to must be ISO 8601 dates')
+    utc = datetime.timezone.utc
+    end = datetime.datetime.combine(end, datetime.time(), utc) if end else timezone.now()
+    if start:
+        start = datetime.datetime.combine(start, datetime.time(), utc)
+    elif period == 'hour':
+        start = end - datetime.timedelta(hours=options.get('DEFAULT_HOURS', 48))
+    else:
+        start = end - datetime.timedelta(days=options.get('DEFAULT_DAYS', 30))
+    return BILLING_PERIODS[period], start, end
+
+
+def billing_rows(request, api_key):
+    """Агрегаты ключа из токена за запрошенный диапазон; None, если запрос не авторизован."""
+    try:
+        claims = verify_token(request)
+        model, start, end = billing_range(request)
+    except (TokenError, BillingRangeError):
+        return None
+    if claims['api_key'] != api_key:
+        return None
+    return usage_rows(model, claims['key_id'], start, end)
+
+
+def usage_rows(model, key_id, start, end):
+    """Агрегаты ключа за диапазон [start, end)."""
+    return model.objects.filter(api_key_id=key_id, period_start__gte=start, period_start__lt=end)
+
+
+def billing_etag(request, api_key):
+    """ETag по числу строк и последнему обновлению агрегатов: один запрос без выборки строк."""
+    rows = billing_rows(request, api_key)
+    if rows is None:
+        # Без ETag декоратор передаёт запрос представлению, и оно возвращает ошибку
+        return None
+    state = rows.aggregate(count=Count('id'), updated=Max('updated_at'))
+    updated = state['updated'].timestamp() if state['updated'] else 0
+    return hashlib.sha1(f"{request.get_full_path()}:{state['count']}:{updated}".encode()).hexdigest()
+
+
+@method_decorator(condition(etag_func=billing_etag), name='get')
+class BillingView(View):
+    def get(self, request, api_key):
+        try:
+            claims = verify_token(request)
+        except TokenError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        if claims['api_key'] != api_key:
+            return JsonResponse({'error': 'Token does not belong to this API key'}, status=403)
+        try:
+            model, start, end = billing_range(request)
+        except BillingRangeError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        rows = usage_rows(model, claims['key_id'], start, end).order_by('period_start').values(
+            'period_start', *ROLLUP_SUMS, 'latency_ms_max',
+        )
+        totals = dict.fromkeys(ROLLUP_SUMS + ('latency_ms_max',), 0)
+        usage = []
+        for row in rows:
+            for name in ROLLUP_SUMS:
+                totals[name] += row[name]
+            totals['latency_ms_max'] = max(totals['latency_ms_max'], row['latency_ms_max'])
+            usage.append(billing_entry(row))
+        response = JsonResponse({
+            'api_key': api_key,
+            'period': request.GET.get('period', 'day'),
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'totals': billing_entry(totals),
+            'usage': usage,
+        })
+        # Клиент хранит ответ, но каждый раз проверяет его актуальность по ETag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+def billing_entry(row):
+    entry = {name: row[name] for name in ROLLUP_SUMS if name != 'latency_ms_sum'}
+    entry['latency_ms_avg'] = round(row['latency_ms_sum'] / row['requests']) if row['requests'] else 0
+    entry['latency_ms_max'] = row['latency_ms_max']
+    if 'period_start' in row:
+        entry['period_start'] = row['period_start'].isoformat()
+    return entry
+```
+
+```python
+# urls.py
+path('api/v1/billing/<str:api_key>', BillingView.as_view()),
+```
+
+##### Заполнение и хранение агрегатов:
+```python
+# api/management/commands/rebuild_usage_rollups.py
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import TruncDate
+
+
+class Command(BaseCommand):
+    help = "Пересчёт агрегатов использования закрытых суток по таблице Logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', type=datetime.date.fromisoformat, required=True)
+        parser.add_argument('--to', dest='end', type=datetime.date.fromisoformat, required=True)
+
+    def handle(self, *args, start, end, **options):
+        utc = datetime.timezone.utc
+        lower = datetime.datetime.combine(start, datetime.time(), utc)
+        upper = datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time(), utc)
+        if upper > timezone.now().replace(hour=0, minute=0, second=0, microsecond=0):
+            # Агрегаты текущих суток одновременно дополняет писатель журнала
+            self.stderr.write("Only closed days can be rebuilt")
+            return
+        # Журнал старше RETENTION_MONTHS удалён, а суточные агрегаты хранятся бессрочно:
+        # заменяются только сутки, за которые журнал есть, иначе пересчёт стёр бы историю биллинга
+        days = sorted(
+            Log.objects.filter(timestamp__gte=lower, timestamp__lt=upper)
+            .annotate(day=TruncDate('timestamp', tzinfo=utc))
+            .values_list('day', flat=True)
+            .distinct()
+        )
+        skipped = (end - start).days + 1 - len(days)
+        if skipped:
+            self.stderr.write(f"{skipped} day(s) without log rows were left unchanged")
+        events = (
+            Log.objects.filter(action='compare', timestamp__gte=lower, timestamp__lt=upper)
+            .values_list('api_key_id', 'action', 'timestamp', 'details')
+            .iterator(chunk_size=5000)
+        )
+        with transaction.atomic():
+            for day in days:
+                day_start = datetime.datetime.combine(day, datetime.time(), utc)
+                for model in (UsageHourly, UsageDaily):
+                    model.objects.filter(
+                        period_start__gte=day_start, period_start__lt=day_start + datetime.timedelta(days=1),
+                    ).delete()
+            hourly, daily = aggregate_usage(events)
+            upsert_usage_rollups(UsageHourly, hourly)
+            upsert_usage_rollups(UsageDaily, daily)
+```
+
+##### Тесты:
+```python
+import datetime
+import io
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+
+@override_settings(JWT_SIGNING_KEYS={'test': 'test-signing-key-0123456789abcdef'}, JWT_ACTIVE_KID='test', JWT_TTL=3600)
+class UsageRollupTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='tester')
+        typeid = TypeID.objects.create(scale='1', system='Эталон: ', user='Работа: ', model='gpt-4o', llm='openai')
+        self.api_key = APIKey.objects.create(
+            user=user, key='test-key', secret_key='secret', typeid=typeid,
+            llm_api_key='sk-test', tokens_remaining=1000000, status='active',
+        )
+        Subscription.objects.create(
+            api_key=self.api_key, type='basic', status='active',
+            start_date=datetime.date.today(), end_date=datetime.date.today() + datetime.timedelta(days=30),
+        )
+        token = issue_token(self.api_key, 'tester')
+        self.auth_headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+        self.now = timezone.now()
+
+    def event(self, latency_ms, **details):
+        return (self.api_key.pk, 'compare', self.now, {'latency_ms': latency_ms, **details})
+
+    def test_batches_are_added_to_rollups(self):
+        update_usage_rollups([
+            self.event(100, input_tokens=10, output_tokens=5),
+            self.event(20, cache_hit=True),
+            (self.api_key.pk, 'auth', self.now, {}),
+        ])
+        update_usage_rollups([self.event(300, input_tokens=7, output_tokens=1, error='ProviderUnavailable')])
+        for model in (UsageHourly, UsageDaily):
+            row = model.objects.get(api_key=self.api_key)
+            self.assertEqual((row.requests, row.errors, row.cache_hits), (3, 1, 1))
+            self.assertEqual((row.input_tokens, row.output_tokens), (17, 6))
+            self.assertEqual((row.latency_ms_sum, row.latency_ms_max), (420, 300))
+
+    def test_unchanged_billing_is_not_modified(self):
+        update_usage_rollups([self.event(100, input_tokens=10, output_tokens=5)])
+        response = self.client.get('/api/v1/billing/test-key', **self.auth_headers)
+        self.assertEqual(response.json()['totals']['input_tokens'], 10)
+        # Проверка ETag — один агрегирующий запрос, строки агрегатов не выбираются
+        with self.assertNumQueries(1):
+            cached = self.client.get('/api/v1/billing/test-key', HTTP_IF_NONE_MATCH=response['ETag'], **self.auth_headers)
+        self.assertEqual(cached.status_code, 304)
+        update_usage_rollups([self.event(50)])
+        changed = self.client.get('/api/v1/billing/test-key', HTTP_IF_NONE_MATCH=response['ETag'], **self.auth_headers)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json()['totals']['requests'], 2)
+
+    def test_other_key_is_forbidden(self):
+        response = self.client.get('/api/v1/billing/other-key', **self.auth_headers)
+        self.assertEqual(response.status_code, 403)
+
+    def test_rebuild_keeps_days_without_logs(self):
+        today = self.now.replace(hour=0, minute=0, second=0, microsecond=0)
+        expired, logged = today - datetime.timedelta(days=3), today - datetime.timedelta(days=2)
+        # Журнал за expired уже удалён по сроку хранения, агрегат остался
+        UsageDaily.objects.create(api_key=self.api_key, period_start=expired, requests=5, updated_at=self.now)
+        UsageDaily.objects.create(api_key=self.api_key, period_start=logged, requests=9, updated_at=self.now)
+        Log.objects.create(api_key=self.api_key, action='compare', timestamp=logged, details={'latency_ms': 10})
+        call_command(
+            'rebuild_usage_rollups', '--from', expired.date().isoformat(), '--to', logged.date().isoformat(),
+            stderr=io.StringIO(),
+        )
+        self.assertEqual(UsageDaily.objects.get(period_start=expired).requests, 5)
+        self.assertEqual(UsageDaily.objects.get(period_start=logged).requests, 1)
+```
+
+### 19. Метрики и профилирование
+
+#### Бизнес требования:
+- **Время по участкам запроса**: Нужно видеть, сколько времени сравнение тратит на проверку JWT, обращения к базе, извлечение текста и запрос к провайдеру. Эти участки измеряются прямо в коде и попадают в гистограммы задержки.
+- **Метки**: Гистограммы и счётчики размечены провайдером (`llm`), моделью (`model`) и TypeID. Участки без TypeID (авторизация, извлечение текста, списание токенов) имеют пустые метки.
+- **Счётчики**: Учитываются токены провайдера (входные, из них закэшированные, выходные), неудачные попытки обращения к провайдеру по типу ошибки и сравнения по результату: `llm`, `cache` (попадание в кэш), `prefilter` (локальная оценка), `error`.
+- **Эндпоинт `/metrics`**: Метрики отдаются в текстовом формате Prometheus. Доступ закрыт токеном `METRICS_TOKEN`.
+- **Профилирование по запросу**: Администратор может включить сэмплирующий профилировщик для отдельного запроса заголовком `X-Profile`. Остальные запросы не замедляются.
+
+#### Описание работы функций:
+1. **`span(name, typeid=None)`** — контекстный менеджер: измеряет участок по `time.perf_counter` и записывает длительность в гистограмму `cvscore_span_seconds`. Запись стоит единицы микросекунд, поэтому участки измеряются всегда, без сэмплирования.
+2. **`timed(name)`** — декоратор на основе `span`. Если у функции есть аргумент `typeid`, метки берутся из него. Измеряемые участки:
+
+   | Участок | Функция |
+   |---|---|
+   | `auth` | `handle_auth_request` |
+   | `jwt_verify` | `verify_token` |
+   | `api_key_lookup` | `resolve_api_key` |
+   | `reference_lookup` | `get_reference_prompt` |
+   | `decode_file` | `decode_file` |
+   | `compare` | `compare_texts_llm` |
+   | `provider_call` | `_call_with_retries` (с метками фактической, в том числе резервной, модели) |
+   | `token_usage` | `update_token_usage` |
+
+3. **`record_comparison`** вызывается из `log_comparison` (раздел 17). Поэтому счётчики сравнений и токенов покрывают все пути: синхронное, пакетное и потоковое сравнение, кэш и локальную оценку. Если ответ дала резервная модель (`usage.fallback_used`), сравнение и токены учитываются с её метками `llm` и `model`, метка `typeid` остаётся прежней.
+4. **`record_provider_error`** вызывается при каждой неудачной попытке в `_call_with_retries` и `stream_llm_report`. Повторы видны в метриках, даже если запрос в итоге выполнен.
+5. **Несколько процессов**: Если задана переменная окружения `PROMETHEUS_MULTIPROC_DIR` (gunicorn с несколькими воркерами), `/metrics` собирает значения всех воркеров через `MultiProcessCollector`.
+6. **`ProfilingMiddleware`**:
+   - Заголовок `X-Profile` учитывается, только если профилирование включено в `PROFILING` и запрос сделан администратором: пользователь сессии с `is_staff` или значение заголовка совпадает с `PROFILING['TOKEN']`.
+   - Запрос выполняется под сэмплирующим профилировщиком `pyinstrument`. Отчёт в HTML сохраняется в `PROFILING['DIR']`, его идентификатор возвращается в заголовке `X-Profile-Id`.
+   - Для потоковых ответов профилировщик останавливается при закрытии ответа (`call_on_close`, раздел 14): после выдачи последнего фрагмента или при разрыве соединения.
+   - Профилируется поток запроса. Работа в пулах потоков (пакетное сравнение, хеджирование) видна только как ожидание.
+   - Если профилирование выключено, миддлваре исключается Django при старте (`MiddlewareNotUsed`), и `pyinstrument` не нужен.
+
+#### Настройки:
+```python
+# pip install prometheus-client; pyinstrument — только при включённом профилировании
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # Bearer токен сборщика Prometheus
+PROFILING = {
+    'ENABLED': False,
+    'TOKEN': os.environ.get('PROFILING_TOKEN'),  # значение заголовка X-Profile для администраторов
+    'INTERVAL': 0.001,                           # интервал сэмплирования, секунды
+    'DIR': '/var/tmp/cvscore-profiles',
+}
+MIDDLEWARE = [
+    # ...
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.metrics.ProfilingMiddleware',           # до AdmissionControlMiddleware, чтобы профиль включал проверку доступа
+    'api.ratelimit.AdmissionControlMiddleware',
+]
+```
+
+#### Пример реализации:
+```python
+# api/metrics.py
+import functools
+import hmac
+import inspect
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.views import View
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+
+LABELS = ('llm', 'model', 'typeid')
+
+SPAN_SECONDS = Histogram(
+    'cvscore_span_seconds', 'Длительность участков обработки запроса', ('span',) + LABELS,
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+PROVIDER_TOKENS = Counter(
+    'cvscore_provider_tokens', 'Токены провайдера LLM (input, cached_input, output)', LABELS + ('kind',),
+)
+PROVIDER_ERRORS = Counter(
+    'cvscore_provider_errors', 'Неудачные попытки обращения к провайдеру LLM', LABELS + ('error',),
+)
+COMPARISONS = Counter(
+    'cvscore_comparisons', 'Сравнения по результату (llm, cache, prefilter, error)', LABELS + ('result',),
+)
+
+
+def typeid_labels(typeid):
+    if typeid is None:
+        return '', '', ''
+    return typeid.llm, typeid.model, str(getattr(typeid, 'pk', ''))
+
+
+@contextmanager
+def span(name, typeid=None):
+    """Участок обработки запроса: длительность записывается в гистограмму и при исключении."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.labels(name, *typeid_labels(typeid)).observe(time.perf_counter() - started)
+
+
+def timed(name):
+    """Декоратор span; метки берутся из аргумента typeid функции, если он есть."""
+    def decorator(func):
+        parameters = list(inspect.signature(func).parameters)
+        position = parameters.index('typeid') if 'typeid' in parameters else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            typeid = kwargs.get('typeid')
+            if position is not None and position < len(args):
+                typeid = args[position]
+            with span(name, typeid):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_comparison(typeid, usage=None, cache_hit=False, verdict=None, error=None):
+    labels = typeid_labels(typeid)
+    result = 'error' if error else 'cache' if cache_hit else 'prefilter' if verdict else 'llm'
+    COMPARISONS.labels(*labels, result).inc()
+    if usage is not None:
+        for kind, tokens in usage.as_dict().items():
+            if tokens:
+                PROVIDER_TOKENS.labels(*labels, kind.removesuffix('_tokens')).inc(tokens)
+
+
+def record_provider_error(typeid, error):
+    PROVIDER_ERRORS.labels(*typeid_labels(typeid), type(error).__name__).inc()
+
+
+def metrics_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Значения воркеров хранятся в файлах каталога и суммируются при каждом сборе
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+class MetricsView(View):
+    def get(self, request):
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+        if not token or scheme != 'Bearer' or not hmac.compare_digest(value.encode(), token.encode()):
+            return HttpResponse(status=403)
+        return HttpResponse(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+```
+
+```python
+# urls.py
+path('metrics', MetricsView.as_view()),
+```
+
+##### Профилирование запроса:
+```python
+def profiling_requested(request):
+    """Заголовок X-Profile действует только для администраторов."""
+    value = request.headers.get('X-Profile')
+    if not value:
+        return False
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    token = settings.PROFILING.get('TOKEN')
+    return bool(token) and hmac.compare_digest(value.encode(), token.encode())
+
+
+class ProfilingMiddleware:
+    """Сэмплирующий профилировщик отдельных запросов по заголовку X-Profile."""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING', {}).get('ENABLED'):
+            raise MiddlewareNotUsed
+        # Необязательная зависимость: нужна только при включённом профилировании
+        from pyinstrument import Profiler
+        self.profiler_class = Profiler
+        self.get_response = get_response
+        os.makedirs(settings.PROFILING['DIR'], exist_ok=True)
+
+    def __call__(self, request):
+        if not profiling_requested(request):
+            return self.get_response(request)
+
+        profiler = self.profiler_class(interval=settings.PROFILING.get('INTERVAL', 0.001))
+        profile_id = uuid.uuid4().hex
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self.save(profiler, profile_id)
+            raise
+        response['X-Profile-Id'] = profile_id
+        if response.streaming:
+            # Отчёт потокового ответа формируется при его закрытии, в том числе при разрыве до первого фрагмента
+            call_on_close(response, lambda: self.save(profiler, profile_id))
+        else:
+            self.save(profiler, profile_id)
+        return response
+
+    @staticmethod
+    def save(profiler, profile_id):
+        profiler.stop()
+        path = os.path.join(settings.PROFILING['DIR'], f"{profile_id}.html")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+```
+
+##### Тесты:
+```python
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase, override_settings
+from prometheus_client import REGISTRY
+
+
+class MetricsTest(SimpleTestCase):
+    typeid = SimpleNamespace(pk=7, llm='fake', model='primary')
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, {'llm': 'fake', 'model': 'primary', 'typeid': '7', **labels}) or 0
+
+    def test_span_labels_from_typeid_argument(self):
+        @timed('test_span')
+        def work(reference, typeid):
+            return reference
+
+        before = self.sample('cvscore_span_seconds_count', span='test_span')
+        work('a', self.typeid)
+        work('b', typeid=self.typeid)
+        self.assertEqual(self.sample('cvscore_span_seconds_count', span='test_span'), before + 2)
+
+    def test_comparison_counters(self):
+        before = {
+            'cache': self.sample('cvscore_comparisons_total', result='cache'),
+            'output': self.sample('cvscore_provider_tokens_total', kind='output'),
+        }
+        record_comparison(self.typeid, cache_hit=True)
+        record_comparison(self.typeid, LLMUsage(input_tokens=10, output_tokens=4))
+        self.assertEqual(self.sample('cvscore_comparisons_total', result='cache'), before['cache'] + 1)
+        self.assertEqual(self.sample('cvscore_provider_tokens_total', kind='output'), before['output'] + 4)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_metrics_endpoint_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with span('metrics_test'):
+            pass
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'cvscore_span_seconds_bucket{', response.content)
+```
+
+### 20. Нагрузочное тестирование и бенчмарки
+
+#### Бизнес требования:
+- **Измерения без затрат на провайдера**: Пропускная способность и задержка цепочки загрузка → авторизация → сравнение измеряются без обращения к настоящим OpenAI и Gemini. Запросы к LLM обслуживает локальный mock сервер, совместимый с обоими API.
+- **Управляемое поведение провайдера**: Задержка mock сервера задаётся логнормальным распределением (медиана и разброс), скорость потоковой выдачи — в токенах в секунду. Доля ошибок (429 с `Retry-After`, 500, 503) и доля зависших запросов настраиваются. Генератор случайных чисел с seed делает прогоны воспроизводимыми.
+- **Корпус документов**: Набор .txt, .docx и .pdf трёх размеров (около 5 тыс., 100 тыс. и 2 млн символов) генерируется детерминированно. Для каждого эталона есть его редакция для сравнения. Файлы корпуса не хранятся в репозитории: генератор даёт побайтно одинаковый результат, а `manifest.json` содержит их SHA-256.
+- **Сравнимые отчёты**: Бенчмарк нагружает `UploadReferenceTextView` и `CompareTextView` на фиксированной параллельности. Он сообщает p50/p95/p99 задержки, запросы в секунду и среднее число запросов к базе для каждого шага, а также пиковый RSS процесса. Результат сохраняется в JSON вместе с коммитом и сравнивается с прогоном базового коммита.
+
+#### Описание работы функций:
+1. **Mock сервер** (`bench/mock_llm.py`) работает только на стандартной библиотеке (`ThreadingHTTPServer`):
+   - OpenAI: `POST /v1/chat/completions`, обычный и потоковый (`stream`, итоговый чанк с `usage`) ответ.
+   - Gemini: `POST /v1beta/models/{model}:generateContent`, `:streamGenerateContent` и `POST /v1beta/cachedContents`.
+   - Повторно присланный префикс промпта (первое сообщение) учитывается как закэшированные токены, как у кэша провайдера (раздел 10).
+   - `GET /stats` возвращает число ответов по исходу. Бенчмарк сохраняет эти числа в отчёт.
+2. **Генератор корпуса** (`bench/make_corpus.py`) не требует зависимостей:
+   - .docx собирается из минимального пакета OOXML с постоянной датой записей архива. Разрывы страниц размечены так, чтобы python-docx делил текст на страницы (раздел 9).
+   - .pdf записывается со стандартным шрифтом Helvetica и извлекается pypdf. Стандартные шрифты PDF не содержат кириллицы, поэтому текст PDF латинский.
+3. **Команда `manage.py benchmark`**:
+   - Запускается только с настройками, где задан `BENCHMARK`: отдельная база и адреса провайдеров, указывающие на mock сервер. Команда создаёт ключи и тексты, поэтому с рабочими настройками она завершается ошибкой.
+   - Каждый из `--concurrency` потоков получает свой API ключ и повторяет цикл `POST /api/v1/auth` → `POST /api/v1/reference` → `POST /api/v1/compare/{id}` через `django.test.Client`. Запросы проходят все миддлваре, включая лимиты (раздел 14); сетевой стек HTTP сервера в замер не входит.
+   - Запросы к базе считаются `connection.execute_wrapper` отдельно для каждого шага. Запись журнала фоновым потоком (раздел 17) в счётчик не попадает.
+   - `--cache cold` (по умолчанию) отключает кэш сравнений и перед загрузкой удаляет эталон ключа с тем же SHA-256 (вне замера). Так каждый шаг выполняет полную работу: извлечение текста, сигнатуру MinHash и вызов провайдера. `--cache warm` измеряет повторные запросы.
+   - Первые `--warmup` секунд не учитываются.
+   - `ru_maxrss` — пик за всё время жизни процесса, поэтому каждый прогон запускается отдельной командой.
+4. **Сравнение коммитов**: С `--baseline` команда завершается ошибкой, если p50/p95/p99 какого-либо шага или пиковый RSS выросли больше чем на `--max-regression`, или если выросло число запросов к базе на шаг. Сравнивать имеет смысл прогоны с одинаковыми параметрами mock сервера и команды; параметры команды сохраняются в отчёте.
+
+#### Настройки:
+```python
+# cvscore/settings_bench.py
+from .settings import *  # noqa: F401,F403
+
+DATABASES['default']['NAME'] = os.environ.get('BENCH_DB_NAME', 'cvscore_bench')
+ALLOWED_HOSTS = ['testserver']  # django.test.Client
+MOCK_LLM_URL = os.environ.get('MOCK_LLM_URL', 'http://127.0.0.1:8090')
+LLM_PROVIDERS = {
+    'openai': {'base_url': f'{MOCK_LLM_URL}/v1', 'timeout': 30, 'max_connections': 64},
+    'local': {'base_url': f'{MOCK_LLM_URL}/v1', 'timeout': 30, 'max_connections': 64},
+    'gemini': {'base_url': MOCK_LLM_URL, 'timeout': 30, 'context_cache_min_tokens': 4096},
+}
+LLM_PROVIDER_LIMITS = {}  # лимиты аккаунта провайдера не применяются к mock серверу
+BENCHMARK = {'MOCK_URL': MOCK_LLM_URL}
+```
+
+Запуск:
+```bash
+python bench/make_corpus.py bench/corpus
+python bench/mock_llm.py --port 8090 --latency-median 0.8 --latency-sigma 0.4 --error-rate 0.01 --seed 1 &
+export DJANGO_SETTINGS_MODULE=cvscore.settings_bench
+python manage.py migrate
+git checkout main && python manage.py benchmark --concurrency 8 --duration 60 --output bench/results/main.json
+git checkout feature && python manage.py benchmark --concurrency 8 --duration 60 \
+    --output bench/results/feature.json --baseline bench/results/main.json
+```
+
+Пример отчёта:
+```
+step     requests errors   req/s  p50, ms  p95, ms  p99, ms queries
+auth          472      0     7.9      4.1      9.8     14.2     1.0
+upload        472      0     7.9     61.3    187.5    240.9     4.0
+compare       471      5     7.8    902.6   1710.4   2315.0     5.0
+flows/s: 7.8, peak RSS: 212 MB (at start 96 MB)
+```
+
+#### Пример реализации:
+```python
+"""Локальный mock сервер API OpenAI и Gemini для нагрузочных тестов без обращения к провайдерам.
+
+Запуск: python bench/mock_llm.py --port 8090 --latency-median 0.8 --latency-sigma 0.5 --error-rate 0.02
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GEMINI_PATH = re.compile(r'^/v1beta/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$')
+ERROR_STATUS = {429: 'RESOURCE_EXHAUSTED', 500: 'INTERNAL', 503: 'UNAVAILABLE'}
+
+
+class MockBehaviour:
+    """Распределения задержки и ошибок; общий генератор с seed делает прогоны воспроизводимыми."""
+
+    def __init__(self, latency_median=0.5, latency_sigma=0.5, error_rate=0.0, error_statuses=(429, 503),
+                 stall_rate=0.0, stall_seconds=120, tokens_per_second=200, report_words=120, seed=1):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.tokens_per_second = tokens_per_second
+        self.report = ' '.join(f"difference-{i}" for i in range(report_words))
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._prefixes = set()
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """Задержка до первого байта (логнормальное распределение с медианой latency_median) и исход запроса."""
+        with self._lock:
+            latency = 0.0
+            if self.latency_median > 0:
+                latency = self._random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+            if self._random.random() < self.stall_rate:
+                outcome = 'stall'
+            elif self._random.random() < self.error_rate:
+                outcome = self._random.choice(self.error_statuses)
+            else:
+                outcome = 200
+            self.stats[str(outcome)] += 1
+        return latency, outcome
+
+    def cached_tokens(self, prefix):
+        """Имитация кэша префикса у провайдера: повторный префикс считается закэшированным."""
+        digest = hashlib.sha256(prefix.encode('utf-8')).digest()
+        with self._lock:
+            seen = digest in self._prefixes
+            self._prefixes.add(digest)
+        return len(prefix) // 4 if seen else 0
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    behaviour = None  # MockBehaviour, задаётся в make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self._send_json(200, dict(self.behaviour.stats))
+        self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path, _, query = self.path.partition('?')
+        if path == '/v1/chat/completions':
+            return self._respond(body, openai=True, stream=body.get('stream', False))
+        if path == '/v1beta/cachedContents':
+            expires = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600))
+            name = 'cachedContents/' + hashlib.sha256(json.dumps(body).encode()).hexdigest()[:16]
+            return self._send_json(200, {'name': name, 'model': body.get('model', ''), 'expireTime': expires})
+        match = GEMINI_PATH.match(path)
+        if match:
+            return self._respond(body, openai=False, stream=match['method'] == 'streamGenerateContent')
+        self._send_json(404, {'error': {'message': f'Unknown path {path}'}})
+
+    def _respond(self, body, openai, stream):
+        latency, outcome = self.behaviour.sample()
+        if outcome == 'stall':
+            # Зависший провайдер: клиент должен прервать запрос по своему таймауту
+            time.sleep(self.behaviour.stall_seconds)
+            self.close_connection = True
+            return
+        time.sleep(latency)
+        if outcome != 200:
+            return self._send_error(outcome, openai)
+
+        prefix, prompt = self._prompt(body, openai)
+        prompt_tokens = len(prompt) // 4
+        cached_tokens = self.behaviour.cached_tokens(prefix)
+        words = self.behaviour.report.split(' ')
+        if not stream:
+            return self._send_json(200, self._payload(' '.join(words), openai, prompt_tokens, cached_tokens, len(words)))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        delay = 1 / self.behaviour.tokens_per_second if self.behaviour.tokens_per_second else 0
+        try:
+            for i, word in enumerate(words):
+                last = i == len(words) - 1
+                text = word if last else word + ' '
+                usage = (prompt_tokens, cached_tokens, len(words)) if last and not openai else None
+                self._send_event(self._delta(text, openai, usage))
+                time.sleep(delay)
+            if openai:
+                self._send_event({'choices': [], 'usage': self._openai_usage(prompt_tokens, cached_tokens, len(words))})
+                self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент прервал поток (разрыв соединения или таймаут)
+            pass
+
+    @staticmethod
+    def _prompt(body, openai):
+        """Эталонная часть промпта (первое сообщение) и весь промпт."""
+        if openai:
+            parts = [message.get('content') or '' for message in body.get('messages', [])]
+        else:
+            parts = [part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', [])]
+        return (parts[0] if parts else ''), ''.join(parts)
+
+    @staticmethod
+    def _openai_usage(prompt_tokens, cached_tokens, completion_tokens):
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached_tokens},
+        }
+
+    def _payload(self, text, openai, prompt_tokens, cached_tokens, output_tokens):
+        if openai:
+            return {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'mock',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': self._openai_usage(prompt_tokens, cached_tokens, output_tokens),
+            }
+        return self._delta(text, openai, (prompt_tokens, cached_tokens, output_tokens))
+
+    def _delta(self, text, openai, usage=None):
+        if openai:
+            return {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': 'mock',
+                'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}],
+            }
+        payload = {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}, 'index': 0}]}
+        if usage is not None:
+            prompt_tokens, cached_tokens, output_tokens = usage
+            payload['candidates'][0]['finishReason'] = 'STOP'
+            payload['usageMetadata'] = {
+                'promptTokenCount': prompt_tokens,
+                'cachedContentTokenCount': cached_tokens,
+                'candidatesTokenCount': output_tokens,
+                'totalTokenCount': prompt_tokens + output_tokens,
+            }
+        return payload
+
+    def _send_error(self, status, openai):
+        message = f"Injected mock error {status}"
+        if openai:
+            payload = {'error': {'message': message, 'type': 'mock_error', 'code': status}}
+        else:
+            payload = {'error': {'code': status, 'message': message, 'status': ERROR_STATUS.get(status, 'UNKNOWN')}}
+        headers = {'Retry-After': '1'} if status == 429 else {}
+        self._send_json(status, payload, headers)
+
+    def _send_event(self, payload):
+        self.wfile.write(b'data: ' + json.dumps(payload).encode('utf-8') + b'\n\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(host='127.0.0.1', port=8090, **behaviour):
+    """Сервер с собственным экземпляром MockBehaviour; port=0 — свободный порт (для тестов)."""
+    handler = type('Handler', (MockLLMHandler,), {'behaviour': MockBehaviour(**behaviour)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-median', type=float, default=0.5, help='медиана задержки до первого байта, с')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='разброс логнормального распределения')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-statuses', default='429,503', help='коды ошибок через запятую, выбираются равновероятно')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='доля запросов без ответа')
+    parser.add_argument('--tokens-per-second', type=float, default=200, help='скорость потоковой выдачи')
+    parser.add_argument('--report-words', type=int, default=120)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    server = make_server(
+        args.host, args.port,
+        latency_median=args.latency_median, latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(',')], stall_rate=args.stall_rate,
+        tokens_per_second=args.tokens_per_second, report_words=args.report_words, seed=args.seed,
+    )
+    print(f"Mock LLM server on http://{args.host}:{server.server_port} (OpenAI: /v1, Gemini: /v1beta)")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
+```
+
+```python
+"""Генерация воспроизводимого корпуса документов .txt, .docx и .pdf разных размеров для бенчмарков.
+
+Запуск: python bench/make_corpus.py bench/corpus
+Для каждого формата и размера создаются эталон и его редакция (изменено около 5% слов).
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import zipfile
+from xml.sax.saxutils import escape
+
+SEED = 20240601
+EDIT_RATIO = 0.05
+SIZES = {'small': 5_000, 'medium': 100_000, 'large': 2_000_000}  # символов текста
+WORDS = (
+    'договор сторона обязательство срок оплата услуга качество работа результат акт приёмка исполнитель '
+    'заказчик требование стоимость порядок условие ответственность гарантия изменение расторжение уведомление '
+    'документ раздел пункт приложение согласование проект этап график отчёт проверка соответствие стандарт '
+    'объём поставка товар претензия неустойка возмещение убыток спор суд закон право основание решение'
+).split()
+# Стандартные шрифты PDF не содержат кириллицы, а генератор не встраивает шрифты
+LATIN_WORDS = (
+    'agreement party obligation term payment service quality work result act acceptance contractor customer '
+    'requirement cost procedure condition liability warranty change termination notice document section clause '
+    'annex approval project stage schedule report review compliance standard volume delivery goods claim penalty'
+).split()
+PAGE_CHARS = 3000
+ZIP_DATE = (2024, 1, 1, 0, 0, 0)  # постоянная дата записей архива: одинаковые байты .docx при каждой генерации
+
+
+def make_paragraphs(rng, words, chars):
+    paragraphs, total, section = [], 0, 0
+    while total < chars:
+        if len(paragraphs) % 12 == 0:
+            section += 1
+            paragraphs.append(f"{section}. {rng.choice(words).capitalize()}")
+        paragraph = ' '.join(rng.choice(words) for _ in range(rng.randint(40, 120))).capitalize() + '.'
+        paragraphs.append(paragraph)
+        total += len(paragraph)
+    return paragraphs
+
+
+def edit_paragraphs(rng, paragraphs, words):
+    """Редакция документа: замена около EDIT_RATIO слов, заголовки разделов сохраняются."""
+    edited = []
+    for paragraph in paragraphs:
+        tokens = paragraph.split(' ')
+        if len(tokens) > 3:
+            for i in range(len(tokens)):
+                if rng.random() < EDIT_RATIO:
+                    tokens[i] = rng.choice(words)
+        edited.append(' '.join(tokens))
+    return edited
+
+
+def paginate(paragraphs):
+    pages, page, size = [], [], 0
+    for paragraph in paragraphs:
+        if size + len(paragraph) > PAGE_CHARS and page:
+            pages.append(page)
+            page, size = [], 0
+        page.append(paragraph)
+        size += len(paragraph)
+    return pages + [page] if page else pages
+
+
+def write_txt(path, paragraphs):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n\n'.join(paragraphs))
+
+
+def write_docx(path, paragraphs):
+    """Минимальный пакет OOXML с разрывами страниц между страницами текста."""
+    body = []
+    for number, page in enumerate(paginate(paragraphs)):
+        if number:
+            # Явный разрыв и отметка отрисованного разрыва, по которой python-docx делит текст на страницы
+            body.append('<w:p><w:r><w:br w:type="page"/><w:lastRenderedPageBreak/></w:r></w:p>')
+        body.extend(f'<w:p><w:r><w:t xml:space="preserve">{escape(p)}</w:t></w:r></w:p>' for p in page)
+    parts = {
+        '[Content_Types].xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ),
+        '_rels/.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="word/document.xml" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+            '</Relationships>'
+        ),
+        'word/document.xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{''.join(body)}</w:body></w:document>"
+        ),
+    }
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in parts.items():
+            archive.writestr(zipfile.ZipInfo(name, ZIP_DATE), content)
+
+
+def _pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_pdf(path, paragraphs, line_chars=90, lines_per_page=50):
+    """Минимальный PDF со шрифтом Helvetica: текст страниц извлекается pypdf."""
+    lines = []
+    for paragraph in paragraphs:
+        words, line = paragraph.split(' '), ''
+        for word in words:
+            if len(line) + len(word) + 1 > line_chars:
+                lines.append(line)
+                line = ''
+            line = f"{line} {word}" if line else word
+        lines.extend([line, ''])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+
+    # 1 — каталог, 2 — дерево страниц, 3 — шрифт, далее пары (страница, содержимое)
+    objects = [None, None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>']
+    kids = []
+    for page in pages:
+        stream = 'BT /F1 10 Tf 14 TL 50 800 Td ' + ' '.join(f"({_pdf_text(line)}) '" for line in page) + ' ET'
+        stream = stream.encode('latin-1')
+        page_id = len(objects) + 1
+        kids.append(f"{page_id} 0 R")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>".encode()
+        )
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>".encode()
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        f.writelines(b'%010d 00000 n \n' % offset for offset in offsets)
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+
+
+WRITERS = {'.txt': (write_txt, WORDS), '.docx': (write_docx, WORDS), '.pdf': (write_pdf, LATIN_WORDS)}
+
+
+def sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def main(directory):
+    os.makedirs(directory, exist_ok=True)
+    manifest = []
+    for extension, (write, words) in WRITERS.items():
+        for size, chars in SIZES.items():
+            rng = random.Random(f"{SEED}:{extension}:{size}")
+            reference = make_paragraphs(rng, words, chars)
+            entry = {'format': extension, 'size': size}
+            for role, paragraphs in (('reference', reference), ('compare', edit_paragraphs(rng, reference, words))):
+                name = f"{size}-{role}{extension}"
+                write(os.path.join(directory, name), paragraphs)
+                entry[role] = {'file': name, 'sha256': sha256(os.path.join(directory, name))}
+            manifest.append(entry)
+            print(f"{extension:6} {size:7} {entry['reference']['file']}, {entry['compare']['file']}")
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({'seed': SEED, 'pairs': manifest}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'corpus'))
+```
+
+```python
+# api/management/commands/benchmark.py
+"""Нагрузочный прогон auth → загрузка эталона → сравнение на фиксированной параллельности.
+
+Отчёт: p50/p95/p99 задержки, запросы в секунду и запросы к базе по шагам, пиковый RSS процесса.
+"""
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import resource
+import statistics
+import subprocess
+import threading
+import time
+import urllib.request
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+STEPS = ('auth', 'upload', 'compare')
+LATENCY_METRICS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+class QueryCounter:
+    """execute_wrapper подключения потока: число запросов к базе текущего шага."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class BenchWorker(threading.Thread):
+    """Один клиент: свой API ключ и последовательные циклы auth → upload → compare."""
+
+    def __init__(self, api_key, pairs, corpus, offset, warmup_until, deadline, cold):
+        super().__init__(name=f"bench-{offset}")
+        self.api_key = api_key
+        self.pairs = pairs
+        self.corpus = corpus
+        self.offset = offset  # воркеры начинают с разных пар корпуса
+        self.warmup_until = warmup_until
+        self.deadline = deadline
+        self.cold = cold
+        self.samples = []  # (шаг, секунды, статус, запросы к базе)
+        self.flows = 0
+        self.counter = QueryCounter()
+
+    def run(self):
+        client = Client()
+        signature = hmac.new(
+            self.api_key.secret_key.encode(), f"{self.api_key.key}.bench".encode(), hashlib.sha256,
+        ).hexdigest()
+        auth_payload = {'api_key': self.api_key.key, 'signature': signature, 'username': 'bench'}
+        try:
+            # Подключение к базе у каждого потока своё, поэтому счётчик видит только запросы этого воркера
+            with connection.execute_wrapper(self.counter):
+                index = self.offset
+                while time.monotonic() < self.deadline:
+                    self.flow(client, auth_payload, self.pairs[index % len(self.pairs)])
+                    index += 1
+        finally:
+            connection.close()
+
+    def flow(self, client, auth_payload, pair):
+        record = time.monotonic() >= self.warmup_until
+        response = self.step('auth', record, lambda: client.post('/api/v1/auth', auth_payload, content_type='application/json'))
+        if response.status_code != 200:
+            return
+        headers = {'HTTP_AUTHORIZATION': f"Bearer {response.json()['token']}", 'HTTP_X_API_KEY': self.api_key.key}
+        if self.cold:
+            # Без дедупликации: эталон каждый раз извлекается и сохраняется заново (вне замера)
+            Text.objects.filter(api_key=self.api_key, content_hash=pair['reference']['sha256']).delete()
+        response = self.step('upload', record, lambda: self.post_file(client, '/api/v1/reference', pair['reference'], headers))
+        if response.status_code not in (200, 201):
+            return
+        url = f"/api/v1/compare/{response.json()['reference_id']}"
+        response = self.step('compare', record, lambda: self.post_file(client, url, pair['compare'], headers))
+        if record and response.status_code == 200:
+            self.flows += 1
+
+    def post_file(self, client, url, document, headers):
+        with open(os.path.join(self.corpus, document['file']), 'rb') as f:
+            return client.post(url, {'file': f}, **headers)
+
+    def step(self, name, record, request):
+        self.counter.count = 0
+        started = time.perf_counter()
+        response = request()
+        elapsed = time.perf_counter() - started
+        if record:
+            self.samples.append((name, elapsed, response.status_code, self.counter.count))
+        return response
+
+
+def percentiles(values):
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+def peak_rss_mb():
+    # ru_maxrss — пик за всё время жизни процесса (Linux: килобайты), поэтому каждый прогон — новый процесс
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def mock_stats():
+    """Число ответов mock сервера по исходу: показывает, сколько ошибок было внесено за прогон."""
+    try:
+        with urllib.request.urlopen(settings.BENCHMARK['MOCK_URL'] + '/stats', timeout=5) as response:
+            return json.load(response)
+    except OSError:
+        return None
+
+
+def create_bench_keys(count, llm, prefilter):
+    typeid = TypeID.objects.create(
+        scale='1', system='Сравните документ с эталоном и перечислите расхождения.\n\nЭталон:\n',
+        user='\n\nДокумент:\n', model='mock-model', llm=llm, description='benchmark',
+        # Без локальной оценки все сравнения доходят до провайдера (mock сервера)
+        prefilter_identical=0.98 if prefilter else None, prefilter_unrelated=0.05 if prefilter else None,
+        rate_limit_rpm=10 ** 6, max_concurrency=10 ** 4,
+    )
+    run = uuid.uuid4().hex[:8]
+    api_keys = []
+    for number in range(count):
+        user = User.objects.create(username=f"bench-{run}-{number}")
+        api_key = APIKey.objects.create(
+            user=user, key=f"bench-{run}-{number}", secret_key=os.urandom(32).hex(), typeid=typeid,
+            llm_api_key='mock', tokens_remaining=10 ** 12, token_limit=10 ** 12, status='active',
+        )
+        Subscription.objects.create(
+            api_key=api_key, type='benchmark', status='active',
+            start_date=datetime.date.today(), end_date=datetime.date.today() + datetime.timedelta(days=1),
+        )
+        api_keys.append(api_key)
+    return typeid, api_keys
+
+
+def summarize(workers, seconds):
+    samples = defaultdict(list)
+    for worker in workers:
+        for sample in worker.samples:
+            samples[sample[0]].append(sample)
+    steps = {}
+    for name in STEPS:
+        step = samples[name]
+        ok = [sample for sample in step if sample[2] < 400]
+        p50, p95, p99 = percentiles([sample[1] * 1000 for sample in ok])
+        steps[name] = {
+            'requests': len(step),
+            'errors': len(step) - len(ok),
+            'rps': len(ok) / seconds,
+            'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+            'db_queries': statistics.fmean(sample[3] for sample in step) if step else 0.0,
+        }
+    return {'flows_per_second': sum(worker.flows for worker in workers) / seconds, 'steps': steps}
+
+
+def regressions(result, baseline, threshold):
+    """Ухудшения относительно прогона базового коммита: задержки и RSS больше порога, рост числа запросов."""
+    found = []
+    for name, step in result['steps'].items():
+        base = baseline['steps'].get(name)
+        if not base:
+            continue
+        for metric in LATENCY_METRICS:
+            if base[metric] and step[metric] > base[metric] * (1 + threshold):
+                found.append(f"{name} {metric}: {base[metric]:.1f} -> {step[metric]:.1f}")
+        if step['db_queries'] > base['db_queries'] + 0.5:
+            found.append(f"{name} db_queries: {base['db_queries']:.1f} -> {step['db_queries']:.1f}")
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + threshold):
+        found.append(f"peak_rss_mb: {baseline['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f}")
+    return found
+
+
+class Command(BaseCommand):
+    help = "Нагрузочный прогон auth → загрузка эталона → сравнение против mock сервера LLM"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', default='bench/corpus')
+        parser.add_argument('--sizes', default='small,medium', help='размеры документов корпуса через запятую')
+        parser.add_argument('--formats', default='.txt,.docx,.pdf')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=60, help='длительность замера, секунды')
+        parser.add_argument('--warmup', type=float, default=5, help='прогрев без записи результатов, секунды')
+        parser.add_argument('--llm', default='openai', choices=('openai', 'local', 'gemini'))
+        parser.add_argument('--cache', default='cold', choices=('cold', 'warm'),
+                            help='cold — без кэша сравнений и дедупликации эталонов')
+        parser.add_argument('--prefilter', action='store_true', help='включить локальную оценку сходства (раздел 13)')
+        parser.add_argument('--output', help='файл JSON с результатами прогона')
+        parser.add_argument('--baseline', help='результаты базового коммита для сравнения')
+        parser.add_argument('--max-regression', type=float, default=0.10)
+
+    def handle(self, *args, **options):
+        if not hasattr(settings, 'BENCHMARK'):
+            # Прогон создаёт ключи и тексты: только с настройками бенчмарка (отдельная база и mock сервер)
+            raise CommandError("BENCHMARK settings are missing; use DJANGO_SETTINGS_MODULE=cvscore.settings_bench")
+        with open(os.path.join(options['corpus'], 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        sizes, formats = options['sizes'].split(','), options['formats'].split(',')
+        pairs = [pair for pair in manifest['pairs'] if pair['size'] in sizes and pair['format'] in formats]
+        if not pairs:
+            raise CommandError("No corpus documents match --sizes and --formats")
+
+        if options['cache'] == 'cold':
+            get_comparison_cache().backend = LRUCacheBackend(max_entries=0)
+        typeid, api_keys = create_bench_keys(options['concurrency'], options['llm'], options['prefilter'])
+        start_rss = peak_rss_mb()
+        warmup_until = time.monotonic() + options['warmup']
+        deadline = warmup_until + options['duration']
+        workers = [
+            BenchWorker(api_key, pairs, options['corpus'], number, warmup_until, deadline, options['cache'] == 'cold')
+            for number, api_key in enumerate(api_keys)
+        ]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            APIKey.objects.filter(typeid=typeid).delete()
+            User.objects.filter(username__in=[api_key.key for api_key in api_keys]).delete()
+            typeid.delete()
+
+        result = {
+            'commit': git_commit(),
+            'options': {name: options[name] for name in (
+                'sizes', 'formats', 'concurrency', 'duration', 'warmup', 'llm', 'cache', 'prefilter')},
+            'corpus_seed': manifest['seed'],
+            'start_rss_mb': start_rss,
+            'peak_rss_mb': peak_rss_mb(),
+            'mock': mock_stats(),
+            **summarize(workers, options['duration']),
+        }
+        self.report(result)
+        if options['output']:
+            os.makedirs(os.path.dirname(options['output']) or '.', exist_ok=True)
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                found = regressions(result, json.load(f), options['max_regression'])
+            if found:
+                raise CommandError("Regressions against baseline:\n  " + "\n  ".join(found))
+            self.stdout.write("No regressions against baseline")
+
+    def report(self, result):
+        self.stdout.write(f"{'step':8} {'requests':>8} {'errors':>6} {'req/s':>7} "
+                          f"{'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8} {'queries':>7}")
+        for name, step in result['steps'].items():
+            self.stdout.write(
+                f"{name:8} {step['requests']:8d} {step['errors']:6d} {step['rps']:7.1f} "
+                f"{step['p50_ms']:8.1f} {step['p95_ms']:8.1f} {step['p99_ms']:8.1f} {step['db_queries']:7.1f}"
+            )
+        self.stdout.write(f"flows/s: {result['flows_per_second']:.1f}, "
+                          f"peak RSS: {result['peak_rss_mb']:.0f} MB (at start {result['start_rss_mb']:.0f} MB)")
+```
+
+Адрес Gemini задаётся в `LLM_PROVIDERS['gemini']['base_url']` (раздел 11); без него используется API Google.
+
+##### Тесты:
+Адаптеры провайдеров проверяются против mock сервера настоящими SDK, без подмены клиентов:
+```python
+import threading
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from bench.mock_llm import make_server
+
+
+class MockLLMServerTest(SimpleTestCase):
+    typeid = SimpleNamespace(system='Эталон: ', user='Работа: ', model='mock-model', llm='local')
+    reference = ReferencePrompt(prefix='Эталон: ' + 'текст ' * 200, prefix_tokens=300, digest='a' * 64)
+
+    def serve(self, **behaviour):
+        server = make_server(port=0, latency_median=0, report_words=5, **behaviour)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    def test_openai_compatible_round_trip(self):
+        provider = OpenAICompatibleProvider('mock', base_url=self.serve() + '/v1', timeout=5)
+        report, first = provider.complete(self.reference, 'работа', self.typeid)
+        _, second = provider.complete(self.reference, 'другая работа', self.typeid)
+        self.assertEqual(report, 'difference-0 difference-1 difference-2 difference-3 difference-4')
+        self.assertEqual((first.output_tokens, first.cached_input_tokens), (5, 0))
+        self.assertGreater(second.cached_input_tokens, 0)
+
+    def test_stream_reports_usage(self):
+        provider = OpenAICompatibleProvider('mock', base_url=self.serve() + '/v1', timeout=5)
+        usage = LLMUsage()
+        deltas = list(provider.stream(self.reference, 'работа', self.typeid, usage))
+        self.assertEqual(len(deltas), 5)
+        self.assertEqual(usage.output_tokens, 5)
+
+    def test_injected_errors_are_transient(self):
+        provider = OpenAICompatibleProvider('mock', base_url=self.serve(error_rate=1.0, error_statuses=[503]) + '/v1', timeout=5)
+        with self.assertRaises(Exception) as raised:
+            provider.complete(self.reference, 'работа', self.typeid)
+        self.assertTrue(is_transient(raised.exception))
+```
+
+### 21. Компактное хранение эталонных текстов
+
+#### Бизнес требования:
+- **Сжатое хранение**: Извлечённый текст эталона хранится сжатым (zstd, уровень 3 по умолчанию). Обычный текст документов сжимается в 3–5 раз, поэтому многомегабайтные эталоны занимают меньше места в базе, в резервных копиях и в сетевом трафике между приложением и базой.
+- **Файловое хранилище**: Вместо столбца базы сжатый текст можно хранить в файловом хранилище (локальный каталог или общий том). Адаптер хранилища подключается через настройки, по тому же принципу, что и провайдеры LLM (раздел 11). Так можно подключить объектное хранилище без изменения кода представлений.
+- **Отложенная загрузка**: Запросы метаданных (проверка владельца, списки в админке, поиск по `content_hash`, каскадное удаление) никогда не читают тело текста. Текст читается только при сборке промпта эталона (раздел 4), один раз на время жизни записи в кэше промптов.
+- **Чтение через mmap**: Большие тексты из файлового хранилища читаются через `mmap`: страницы файла берутся из кэша ОС, общего для всех воркеров. Сжатые данные распаковываются без промежуточной копии в памяти процесса, а несжатый текст декодируется прямо из отображения.
+- **Админка**: Список текстов показывает только метаданные (`only()`). Страница текста откладывает загрузку тела (`defer()`) и показывает начало текста, распакованное частично.
+
+#### Описание работы функций:
+1. **Поля `Text`**:
+   - `body` (сжатый текст в базе) или `body_path` (путь в файловом хранилище), `compression` (`zstd`, `zlib` или `none`).
+   - `body_size` — размер после сжатия, `text_length` — длина в символах.
+   - `text_hash` — SHA-256 текста в UTF-8. Используется как `digest` промпта эталона, поэтому текст не хэшируется повторно при каждой сборке промпта.
+   - Способ сжатия записан в каждой строке, поэтому после смены настроек старые записи читаются без миграции.
+2. **Совместимость**: `text` — свойство модели. `Text.objects.create(text=...)` в загрузке эталона (раздел 4) работает без изменений: текст сжимается и сохраняется в `save()`. Чтение `obj.text` загружает и распаковывает тело отдельным запросом.
+3. **Менеджер `TextManager`** откладывает `body` во всех запросах модели. Он же назначен базовым менеджером (`base_manager_name`), поэтому тело не загружается и при обращении через связи и при каскадном удалении ключа.
+4. **`encode_text(text)`** возвращает значения полей хранения. **`decode_text(body, body_path, compression)`** восстанавливает текст. **`preview_text(..., chars)`** распаковывает только начало текста (потоковый распаковщик zstd или `max_length` для zlib).
+5. **`FileSystemTextStorage`**:
+   - Файлы адресуются хэшем текста и способом сжатия (`ab/abcdef….zstd`). Одинаковые тексты разных ключей хранятся одним файлом.
+   - Запись атомарна (временный файл и `os.replace`), читатели не видят частично записанный файл.
+   - Файлы не меньше `MMAP_THRESHOLD` читаются через `mmap`.
+   - Файлы, на которые не ссылается ни одна запись, удаляет команда `manage.py prune_text_files`. Она не трогает файлы моложе суток, поэтому не удаляет файл параллельной загрузки, запись которой ещё не сохранена.
+   - Повторное сохранение уже существующего файла обновляет время его изменения (`os.utime`). Старый файл, который переиспользует новая загрузка, снова считается молодым. Перед удалением команда заново проверяет ссылки в Texts и время изменения файла.
+6. **Миграция**: Существующие тексты сжимаются пакетами по 500 записей, затем столбец `text` удаляется.
+
+#### Настройки:
+```python
+# pip install zstandard — для COMPRESSION = 'zstd'
+TEXT_STORAGE = {
+    'COMPRESSION': 'zstd',      # 'zstd', 'zlib' или 'none'
+    'LEVEL': 3,
+    'LOCATION': None,           # каталог файлового хранилища; None — сжатый текст в столбце Texts.body
+    'BACKEND': 'api.text_storage.FileSystemTextStorage',
+    'MMAP_THRESHOLD': 8 * 1024 * 1024,  # байт; файлы не меньше порога читаются через mmap
+}
+```
+
+#### Пример реализации:
+```python
+# api/text_storage.py
+import hashlib
+import mmap
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+def _zstd():
+    # Необязательная зависимость: нужна только для записей со сжатием zstd
+    import zstandard
+    return zstandard
+
+
+def compress(data, codec, level=3):
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor(level=level).compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    return data
+
+
+def decompress(buffer, codec):
+    """Распаковка из bytes, memoryview или mmap без предварительного копирования входа."""
+    if codec == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(buffer)
+    if codec == 'zlib':
+        return zlib.decompress(buffer)
+    return buffer
+
+
+class FileSystemTextStorage:
+    """Сжатые тексты в каталоге; крупные файлы читаются через mmap."""
+
+    def __init__(self, location, mmap_threshold=8 * 1024 * 1024):
+        self.location = location
+        self.mmap_threshold = mmap_threshold
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+    def save(self, name, data):
+        path = self.path(name)
+        try:
+            # Существующий файл переиспользуется: время изменения обновляется, иначе prune_text_files
+            # мог бы удалить старый файл до сохранения ссылающейся на него записи
+            os.utime(path)
+            return name
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        return name
+
+    @contextmanager
+    def open(self, name):
+        with open(self.path(name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size < self.mmap_threshold:
+                yield f.read()
+                return
+            # Страницы файла берутся из кэша ОС, сжатые данные не копируются в память процесса
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def delete(self, name, older_than=None):
+        """Удаление файла; с older_than файл, изменённый после этого момента, остаётся."""
+        path = self.path(name)
+        try:
+            if older_than is not None and os.path.getmtime(path) >= older_than:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def listdir(self):
+        """Имена файлов хранилища и время их изменения."""
+        for directory, _, files in os.walk(self.location):
+            for file in files:
+                path = os.path.join(directory, file)
+                yield os.path.relpath(path, self.location), os.path.getmtime(path)
+
+
+def text_storage_options():
+    return getattr(settings, 'TEXT_STORAGE', {})
+
+
+def get_file_storage():
+    """Файловое хранилище из настроек или None, если тексты хранятся в базе."""
+    options = text_storage_options()
+    if not options.get('LOCATION'):
+        return None
+    storage_class = import_string(options.get('BACKEND', 'api.text_storage.FileSystemTextStorage'))
+    return storage_class(options['LOCATION'], mmap_threshold=options.get('MMAP_THRESHOLD', 8 * 1024 * 1024))
+
+
+def encode_text(text):
+    """Значения полей хранения Text для текста: хэш, длина, сжатое тело в базе или в файле."""
+    options = text_storage_options()
+    codec = options.get('COMPRESSION', 'zstd')
+    data = text.encode('utf-8')
+    text_hash = hashlib.sha256(data).hexdigest()
+    body = compress(data, codec, options.get('LEVEL', 3))
+    fields = {
+        'text_hash': text_hash,
+        'text_length': len(text),
+        'body_size': len(body),
+        'compression': codec,
+        'body': body,
+        'body_path': '',
+    }
+    storage = get_file_storage()
+    if storage is not None:
+        fields['body'] = None
+        fields['body_path'] = storage.save(f"{text_hash[:2]}/{text_hash}.{codec}", body)
+    return fields
+
+
+@contextmanager
+def open_body(body, body_path):
+    if body_path:
+        storage = get_file_storage()
+        if storage is None:
+            # Каталог нельзя убирать из настроек, пока на его файлы ссылаются записи
+            raise ImproperlyConfigured("TEXT_STORAGE['LOCATION'] is required to read texts stored in files")
+        with storage.open(body_path) as buffer:
+            yield buffer
+    else:
+        yield body
+
+
+def decode_text(body, body_path, compression):
+    with open_body(body, body_path) as buffer:
+        # str() декодирует прямо из буфера (в том числе из mmap) без промежуточной копии bytes
+        return str(decompress(buffer, compression), 'utf-8')
+
+
+def preview_text(body, body_path, compression, chars=2000):
+    """Начало текста: распаковывается не больше 4 * chars байт (максимум UTF-8 на символ)."""
+    limit = 4 * chars
+    with open_body(body, body_path) as buffer:
+        if compression == 'zstd':
+            data = _zstd().ZstdDecompressor().stream_reader(buffer).read(limit)
+        elif compression == 'zlib':
+            data = zlib.decompressobj().decompress(buffer, limit)
+        else:
+            data = bytes(buffer[:limit])
+    # Последний символ может быть обрезан посередине
+    return data.decode('utf-8', errors='ignore')[:chars]
+```
+
+##### Админка:
+```python
+from django.contrib import admin
+
+from .models import Text
+from .text_storage import preview_text
+
+TEXT_LIST_FIELDS = (
+    'id', 'text_length', 'body_size', 'compression', 'created_at',
+    'api_key', 'api_key__key', 'api_key__user', 'api_key__user__username',
+)
+
+
+@admin.register(Text)
+class TextAdmin(admin.ModelAdmin):
+    list_display = ['id', 'api_key', 'text_length', 'body_size', 'compression', 'created_at']
+    list_filter = ['compression']
+    search_fields = ['content_hash', 'api_key__key']
+    readonly_fields = [
+        'content_hash', 'text_hash', 'text_length', 'body_size', 'compression', 'body_path', 'text_preview',
+    ]
+    exclude = ['signature']
+
+    def get_queryset(self, request):
+        # Менеджер модели уже откладывает body; в списке загружаются только отображаемые столбцы
+        queryset = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name.endswith('_changelist'):
+            queryset = queryset.select_related('api_key__user').only(*TEXT_LIST_FIELDS)
+        return queryset
+
+    @admin.display(description='Начало текста')
+    def text_preview(self, obj):
+        body, body_path, compression = Text.objects.values_list('body', 'body_path', 'compression').get(pk=obj.pk)
+        return preview_text(body, body_path, compression)
+```
+
+##### Миграция и обслуживание файлов:
+```python
+# api/migrations/00xx_text_storage.py
+from django.db import migrations, models
+
+from api.text_storage import encode_text
+
+STORAGE_FIELDS = ['text_hash', 'text_length', 'body_size', 'compression', 'body', 'body_path']
+
+
+def compress_existing_texts(apps, schema_editor):
+    Text = apps.get_model('api', 'Text')
+    pending = Text.objects.filter(text_hash='').only('id', 'text').order_by('id')
+    batch = list(pending[:500])
+    while batch:
+        for row in batch:
+            for name, value in encode_text(row.text).items():
+                setattr(row, name, value)
+        Text.objects.bulk_update(batch, STORAGE_FIELDS)
+        batch = list(pending[:500])
+
+
+class Migration(migrations.Migration):
+    dependencies = [('api', '00xx_previous')]
+    operations = [
+        migrations.AddField('text', 'text_hash', models.CharField(max_length=64, default='')),
+        migrations.AddField('text', 'text_length', models.IntegerField(default=0)),
+        migrations.AddField('text', 'body_size', models.IntegerField(default=0)),
+        migrations.AddField('text', 'compression', models.CharField(max_length=8, default='none')),
+        migrations.AddField('text', 'body', models.BinaryField(null=True, editable=False)),
+        migrations.AddField('text', 'body_path', models.CharField(max_length=255, blank=True, default='')),
+        migrations.RunPython(compress_existing_texts, migrations.RunPython.noop),
+        migrations.RemoveField('text', 'text'),
+        migrations.AlterModelOptions('text', {'base_manager_name': 'objects'}),
+    ]
+```
+
+```python
+# api/management/commands/prune_text_files.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import Text
+from api.text_storage import get_file_storage
+
+MIN_AGE = 24 * 60 * 60  # секунды: файл загрузки, запись которой ещё не сохранена, не удаляется
+
+
+class Command(BaseCommand):
+    help = "Удаление файлов текстов, на которые не ссылается ни одна запись Texts"
+
+    def handle(self, *args, **options):
+        storage = get_file_storage()
+        if storage is None:
+            return
+        referenced = set(Text.objects.exclude(body_path='').values_list('body_path', flat=True).iterator())
+        cutoff = time.time() - MIN_AGE
+        removed = 0
+        for name, modified in storage.listdir():
+            if name in referenced or modified >= cutoff:
+                continue
+            # Список ссылок мог устареть за время обхода: новая загрузка могла переиспользовать файл
+            if Text.objects.filter(body_path=name).exists():
+                continue
+            if storage.delete(name, older_than=cutoff):
+                removed += 1
+        self.stdout.write(f"Removed {removed} unreferenced text files")
+```
+
+##### Тесты:
+```python
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+
+class TextStorageTest(TestCase):
+    text = 'Раздел 1. Исполнитель обязуется выполнить работы в срок. ' * 5000
+
+    def setUp(self):
+        reference_cache.clear()
+        user = User.objects.create(username='tester')
+        typeid = TypeID.objects.create(scale='1', system='Эталон: ', user='Работа: ', model='gpt-4o', llm='openai')
+        self.api_key = APIKey.objects.create(
+            user=user, key='test-key', secret_key='secret', typeid=typeid, llm_api_key='sk-test', status='active',
+        )
+
+    def create(self):
+        return Text.objects.create(api_key=self.api_key, text=self.text, content_hash='a' * 64)
+
+    def test_text_is_compressed_and_read_back(self):
+        created = self.create()
+        self.assertLess(created.body_size, len(self.text.encode('utf-8')) // 3)
+        self.assertEqual(Text.objects.get(pk=created.pk).text, self.text)
+
+    def test_metadata_queries_do_not_load_body(self):
+        self.create()
+        with CaptureQueriesContext(connection) as queries:
+            list(Text.objects.all())
+            list(self.api_key.text_set.all())
+            Text.objects.only('id', 'api_key').get(api_key=self.api_key)
+        self.assertFalse(any('"body"' in query['sql'] for query in queries.captured_queries))
+
+    def test_filesystem_storage_with_mmap(self):
+        with tempfile.TemporaryDirectory() as location:
+            with override_settings(TEXT_STORAGE={'LOCATION': location, 'COMPRESSION': 'zstd', 'MMAP_THRESHOLD': 1}):
+                created = self.create()
+                self.assertIsNone(created.body)
+                self.assertTrue(created.body_path.endswith('.zstd'))
+                self.assertEqual(Text.objects.get(pk=created.pk).text, self.text)
+                prompt = get_reference_prompt(created.pk, self.api_key.typeid)
+                self.assertEqual(prompt.digest, hashlib.sha256(self.text.encode('utf-8')).hexdigest())
+
+    def test_prune_keeps_reused_files(self):
+        with tempfile.TemporaryDirectory() as location:
+            storage = FileSystemTextStorage(location)
+            expired = time.time() - 2 * 24 * 60 * 60
+            for name in ('ab/reused.zstd', 'cd/orphan.zstd'):
+                storage.save(name, b'data')
+                os.utime(storage.path(name), (expired, expired))
+            # Новая загрузка переиспользует старый файл, её запись ещё не сохранена
+            storage.save('ab/reused.zstd', b'data')
+            with override_settings(TEXT_STORAGE={'LOCATION': location}):
+                call_command('prune_text_files', stdout=io.StringIO())
+            self.assertTrue(os.path.exists(storage.path('ab/reused.zstd')))
+            self.assertFalse(os.path.exists(storage.path('cd/orphan.zstd')))
+```
+
+### Дополнительные замечания:
+
+1. **Обработка ошибок**:
+   - Необходимо добавить обработку ошибок для каждого из вызовов LLM, чтобы предотвратить сбои приложения из-за возможных исключений при генерации контента.
+
+2. **Тестирование**:
+   - Проверьте форматы возвращаемых данных, так как предположения о структуре ответа могут отличаться.
+
+3. **Хранение API ключей для LMM**:
+   - Хранение ключей для LLM в файле env.
+
+
+База данных должна обеспечивать хранение данных о пользователях, API ключах, конфигурациях моделей (TypeID), текстах для сравнения, и информации о подписках. Использование PostgreSQL обеспечит необходимую гибкость и масштабируемость. Предлагаемая структура базы данных:
+
+### Таблицы базы данных:
+
+1. **Users**
+   - **id** (PK)
+   - **username** (VARCHAR)
+   - **email** (VARCHAR)
+   - **hashed_password** (VARCHAR)
+   - **created_at** (TIMESTAMP)
+   - **updated_at** (TIMESTAMP)
+
+2. **APIKeys**
+   - **id** (PK)
+   - **user_id** (FK to Users)
+   - **key** (VARCHAR) - сам API ключ
+   - **secret_key** (VARCHAR) - секретный ключ для HMAC
+   - **typeid_id** (FK to TypeIDs)
+   - **created_at** (TIMESTAMP)
+   - **updated_at** (TIMESTAMP)
+   - **status** (ENUM: 'active', 'inactive') - статус ключа
+   - **tokens_remaining (INTEGER) - количество оставшихся токенов. Списывается атомарным условным UPDATE по фактическому расходу токенов провайдера.
+   - **token_limit (INTEGER) - лимит токенов, обновляемый через систему биллинга или административный интерфейс.
+   - **llm_api_key (VARCHAR) - API ключ, используемый для взаимодействия с сервисами LLM.
+   - **input_tokens_used**, **cached_input_tokens_used**, **output_tokens_used** (BIGINT) - накопительный расход входных токенов, входных токенов из кэша провайдера и выходных токенов для биллинга.
+   - **rate_limit_rpm** (INTEGER, NULL) - лимит запросов в минуту; если не задан, используется значение TypeID
+   - **max_concurrency** (INTEGER, NULL) - лимит одновременно выполняемых запросов; если не задан, используется значение TypeID
+
+
+3. **TypeIDs**
+   - **id** (PK)
    - **scale** (VARCHAR) - параметр масштабирования модели
    - **system** (TEXT) - системные настройки
    - **user** (TEXT) - пользовательские настройки
    - **model** (VARCHAR) - модель LLM
    - **llm** (VARCHAR) - провайдер LLM (например, OpenAI, Gemini)
    - **description** (TEXT) - описание конфигурации
+   - **chunking** (ENUM: 'none', 'headings', 'paragraphs') - режим сравнения больших документов по фрагментам
+   - **chunk_tokens** (INTEGER) - бюджет токенов на один фрагмент (эталон и сравниваемый текст вместе)
+   - **merge_prompt** (TEXT) - промпт объединения отчётов по фрагментам; если пуст, отчёты объединяются без LLM
+   - **prefilter_identical** (FLOAT, NULL) - порог сходства по фразам, начиная с которого документ считается копией эталона и LLM не вызывается
+   - **prefilter_unrelated** (FLOAT, NULL) - порог сходства по словарю, ниже которого документ считается не относящимся к эталону и LLM не вызывается
+   - **fallback_llm** (VARCHAR) - резервный провайдер LLM на время недоступности основного; пусто — тот же провайдер
+   - **fallback_model** (VARCHAR) - резервная модель; если не заданы ни fallback_llm, ни fallback_model, резервирование выключено
+   - **rate_limit_rpm** (INTEGER, NULL) - лимит запросов в минуту по умолчанию для ключей этого TypeID
+   - **max_concurrency** (INTEGER, NULL) - лимит одновременно выполняемых запросов по умолчанию для ключей этого TypeID
    - **created_at** (TIMESTAMP)
    - **updated_at** (TIMESTAMP)
 
 4. **Texts**
    - **id** (PK)
    - **api_key_id** (FK to APIKeys)
-   - **text** (TEXT) - содержимое текста
+   - **text_hash** (CHAR(64)) - SHA-256 извлечённого текста в UTF-8
+   - **text_length** (INTEGER) - длина текста в символах
+   - **compression** (VARCHAR) - способ сжатия тела: 'zstd', 'zlib' или 'none'
+   - **body** (BYTEA, NULL) - сжатый текст при хранении в базе; не загружается запросами метаданных
+   - **body_path** (VARCHAR) - путь к сжатому тексту в файловом хранилище; пусто, если текст хранится в body
+   - **body_size** (INTEGER) - размер тела после сжатия, байт
+   - **content_hash** (CHAR(64), NULL для эталонов, загруженных до дедупликации) - SHA-256 исходного файла, уникален в пределах api_key_id; повторная загрузка того же файла возвращает существующую запись
+   - **signature** (BYTEA, NULL) - MinHash сигнатура текста для локальной оценки сходства, вычисляется при загрузке
    - **created_at** (TIMESTAMP)
    - **updated_at** (TIMESTAMP)
 
@@ -502,12 +6333,35 @@ def enforce_subscription_and_tokens(request):
    - **end_date** (DATE)
    - **status** (ENUM: 'active', 'inactive') - статус подписки
 
-6. **Logs** (опционально)
-   - **id** (PK)
+6. **Logs** (опционально) - секционирована по месяцам по полю timestamp, секции старше срока хранения удаляются
+   - **id** (BIGINT; PK вместе с timestamp, как требует секционирование)
+   - **api_key_id** (BIGINT, ссылка на APIKeys без ограничения внешнего ключа)
+   - **action** (VARCHAR) - тип действия: 'auth', 'reference_upload', 'compare'
+   - **timestamp** (TIMESTAMPTZ) - время действия
+   - **details** (JSONB) - детали действия: только идентификаторы и числа (задержка, токены, попадание в кэш, тип ошибки)
+
+7. **CompareJobs**
+   - **id** (PK, UUID) - идентификатор задачи, возвращаемый клиенту
    - **api_key_id** (FK to APIKeys)
-   - **action** (TEXT) - описание действия
-   - **timestamp** (TIMESTAMP) - время действия
-   - **details** (JSON) - детали действия в формате JSON
+   - **reference_id** (FK to Texts)
+   - **file_path** (VARCHAR) - путь к загруженному файлу для сравнения
+   - **callback_url** (VARCHAR, NULL) - адрес для уведомления о завершении
+   - **status** (ENUM: 'queued', 'running', 'done', 'failed') - статус задачи
+   - **report** (TEXT, NULL) - результат сравнения
+   - **local_score** (JSON, NULL) - локальная оценка сходства с эталоном
+   - **error** (TEXT, NULL) - описание ошибки
+   - **created_at** (TIMESTAMP)
+   - **started_at** (TIMESTAMP, NULL) - время перевода задачи в `running`
+   - **finished_at** (TIMESTAMP, NULL)
+
+8. **UsageHourly**, **UsageDaily** - агрегаты использования ключа за час и за сутки (UTC)
+   - **id** (PK)
+   - **api_key_id** (BIGINT, ссылка на APIKeys без ограничения внешнего ключа)
+   - **period_start** (TIMESTAMPTZ) - начало часа или суток; уникален вместе с api_key_id
+   - **requests**, **errors**, **cache_hits** (BIGINT) - число сравнений, из них завершённых ошибкой и отданных из кэша
+   - **input_tokens**, **cached_input_tokens**, **output_tokens** (BIGINT) - расход токенов провайдера
+   - **latency_ms_sum** (BIGINT), **latency_ms_max** (INTEGER) - суммарная и максимальная задержка сравнений
+   - **updated_at** (TIMESTAMPTZ) - время последнего пакета; используется для ETag ответа биллинга
 
 ### Взаимодействие таблиц:
 
@@ -517,5 +6371,7 @@ def enforce_subscription_and_tokens(request):
 - **Texts** связана с **APIKeys**, хранит тексты, загруженные пользователями для сравнения.
 - **Subscriptions** связана с **APIKeys**, управляет информацией о подписках пользователей на сервисы.
 - **Logs** (опционально) может использоваться для аудита и мониторинга действий в системе.
+- **CompareJobs** связана с **APIKeys** и **Texts**, хранит состояние и результаты асинхронных сравнений.
+- **UsageHourly** и **UsageDaily** ссылаются на **APIKeys**, обновляются пакетами вместе с **Logs** и служат единственным источником данных эндпоинта биллинга.
 
 Эта структура позволяет поддерживать гибкую работу API, обеспечивая надёжное разграничение доступа и управление ресурсами.